@@ -1,10 +1,23 @@
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
+import asyncio
 import os
+import threading
+import time
 from models import User, UserRole
 
+# PyJWT decodes HS256 noticeably faster than python-jose; use it when installed
+try:
+    import jwt as pyjwt
+    if not hasattr(pyjwt, "PyJWTError"):
+        pyjwt = None
+except ImportError:
+    pyjwt = None
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -19,6 +32,73 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+# bcrypt takes ~250ms of CPU per call, so async endpoints run it on a small
+# dedicated pool instead of the event loop. The pool size caps how many
+# hashes run at once; further calls queue until a worker frees up.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 4))
+_password_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
+)
+_password_metrics_lock = threading.Lock()
+_password_metrics = {
+    "completed": 0,
+    "failed": 0,
+    "in_flight": 0,
+    "queued": 0,
+    "total_wait_seconds": 0.0,
+    "total_run_seconds": 0.0,
+    "max_wait_seconds": 0.0,
+}
+
+def _update_password_metrics(**changes):
+    with _password_metrics_lock:
+        for key, value in changes.items():
+            if key == "max_wait_seconds":
+                _password_metrics[key] = max(_password_metrics[key], value)
+            else:
+                _password_metrics[key] += value
+
+def _timed_password_job(func, args, submitted_at):
+    started_at = time.perf_counter()
+    wait = started_at - submitted_at
+    _update_password_metrics(queued=-1, in_flight=1, total_wait_seconds=wait, max_wait_seconds=wait)
+    try:
+        result = func(*args)
+        _update_password_metrics(completed=1)
+        return result
+    except Exception:
+        _update_password_metrics(failed=1)
+        raise
+    finally:
+        _update_password_metrics(in_flight=-1, total_run_seconds=time.perf_counter() - started_at)
+
+async def run_password_job(func, *args):
+    """Run a password hashing function on the password pool without blocking the event loop"""
+    _update_password_metrics(queued=1)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _password_executor, _timed_password_job, func, args, time.perf_counter()
+    )
+
+async def verify_password_async(plain_password, hashed_password):
+    return await run_password_job(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await run_password_job(get_password_hash, password)
+
+def password_hash_metrics() -> dict:
+    """Snapshot of password pool activity for monitoring"""
+    with _password_metrics_lock:
+        metrics = dict(_password_metrics)
+    finished = metrics["completed"] + metrics["failed"]
+    metrics["workers"] = PASSWORD_HASH_WORKERS
+    metrics["avg_wait_seconds"] = metrics["total_wait_seconds"] / finished if finished else 0.0
+    metrics["avg_run_seconds"] = metrics["total_run_seconds"] / finished if finished else 0.0
+    return metrics
+
+def shutdown_password_pool():
+    _password_executor.shutdown(wait=False)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -29,18 +109,66 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(token: str):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        role: str = payload.get("role")
-        user_id: str = payload.get("user_id")
-        if username is None:
+# Verified tokens are cached so repeat requests skip signature verification.
+# Entries are keyed on the raw token and dropped once the token expires.
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 2048))
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+def decode_token_claims(token: str):
+    """Verify a token's signature and expiry and return its payload, or None"""
+    if pyjwt is not None:
+        try:
+            return pyjwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except pyjwt.PyJWTError:
             return None
-        return {"username": username, "role": role, "user_id": user_id}
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         return None
 
+def _cached_claims(token: str):
+    with _token_cache_lock:
+        entry = _token_cache.get(token)
+        if entry is None:
+            return None
+        claims, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del _token_cache[token]
+            return None
+        _token_cache.move_to_end(token)
+        return claims
+
+def _cache_claims(token: str, claims: dict, expires_at):
+    with _token_cache_lock:
+        _token_cache[token] = (claims, expires_at)
+        _token_cache.move_to_end(token)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+def clear_token_cache():
+    with _token_cache_lock:
+        _token_cache.clear()
+
+def verify_token(token: str):
+    claims = _cached_claims(token)
+    if claims is not None:
+        return dict(claims)
+    
+    payload = decode_token_claims(token)
+    if payload is None:
+        return None
+    username: str = payload.get("sub")
+    role: str = payload.get("role")
+    user_id: str = payload.get("user_id")
+    if username is None:
+        return None
+    
+    claims = {"username": username, "role": role, "user_id": user_id}
+    if TOKEN_CACHE_SIZE > 0:
+        _cache_claims(token, claims, payload.get("exp"))
+    return dict(claims)
+
 # Role-based access control
 def check_permission(user_role: str, required_roles: list):
     """Check if user role has permission to access resource"""
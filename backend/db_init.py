@@ -7,11 +7,12 @@ Creates all necessary MongoDB collections with indexes
 import asyncio
 import os
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.errors import OperationFailure
 import bcrypt
 from datetime import datetime
 import logging
 
+from deps.indexes import ensure_indexes
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -57,19 +58,23 @@ async def init_database():
     
     logger.info(f"Initializing database: {db_name}")
     
-    # ===== CREATE COLLECTIONS WITH INDEXES =====
+    # ===== CREATE INDEXES =====
+    
+    # Every index lives in the registry shared with server.py startup
+    logger.info("Applying index registry...")
+    index_drift = await ensure_indexes(db)
+    if index_drift:
+        for collection, report in index_drift.items():
+            logger.warning(f"Index drift on {collection}: {report}")
+    else:
+        logger.info("✅ All registry indexes present")
+    
+    # ===== SEED COLLECTIONS =====
     
     # 1. Departments Collection
-    logger.info("Creating departments collection...")
+    logger.info("Seeding departments collection...")
     departments_collection = db.departments
     
-    # Create unique index on slug
-    try:
-        await departments_collection.create_index("slug", unique=True)
-        logger.info("✅ Created unique index on departments.slug")
-    except OperationFailure as e:
-        logger.warning(f"Index creation failed: {e}")
-    
     # Insert all departments
     departments_to_insert = []
     for dept in DEPARTMENTS:
@@ -88,111 +93,11 @@ async def init_database():
     else:
         logger.info(f"ℹ️ Departments already exist ({existing_count} documents)")
     
-    # 2. Users Collection
-    logger.info("Creating users collection...")
     users_collection = db.users
-    
-    # Create unique index on username
-    try:
-        await users_collection.create_index("username", unique=True)
-        logger.info("✅ Created unique index on users.username")
-    except OperationFailure as e:
-        logger.warning(f"Index creation failed: {e}")
-    
-    # Create compound index on roles and active status
-    try:
-        await users_collection.create_index([("roles", 1), ("active", 1)])
-        logger.info("✅ Created compound index on users.roles and active")
-    except OperationFailure as e:
-        logger.warning(f"Index creation failed: {e}")
-    
-    # 3. Doctors Collection
-    logger.info("Creating doctors collection...")
     doctors_collection = db.doctors
-    
-    # Create indexes
-    try:
-        await doctors_collection.create_index("user_id")
-        await doctors_collection.create_index("department_id")
-        await doctors_collection.create_index([("department_id", 1), ("active", 1)])
-        logger.info("✅ Created indexes on doctors collection")
-    except OperationFailure as e:
-        logger.warning(f"Index creation failed: {e}")
-    
-    # 4. Nurses Collection
-    logger.info("Creating nurses collection...")
     nurses_collection = db.nurses
     
-    # Create indexes
-    try:
-        await nurses_collection.create_index("user_id")
-        await nurses_collection.create_index("department_id")
-        await nurses_collection.create_index([("department_id", 1), ("active", 1)])
-        logger.info("✅ Created indexes on nurses collection")
-    except OperationFailure as e:
-        logger.warning(f"Index creation failed: {e}")
-    
-    # 5. Patients Collection
-    logger.info("Creating patients collection...")
-    patients_collection = db.patients
-    
-    # Create unique index on opd_no
-    try:
-        await patients_collection.create_index("opd_no", unique=True)
-        logger.info("✅ Created unique index on patients.opd_no")
-    except OperationFailure as e:
-        logger.warning(f"Index creation failed: {e}")
-    
-    # Create index on phone for quick patient lookup
-    try:
-        await patients_collection.create_index("phone")
-        logger.info("✅ Created index on patients.phone")
-    except OperationFailure as e:
-        logger.warning(f"Index creation failed: {e}")
-    
-    # 6. Encounters Collection
-    logger.info("Creating encounters collection...")
-    encounters_collection = db.encounters
-    
-    # Create indexes
-    try:
-        await encounters_collection.create_index("patient_id")
-        await encounters_collection.create_index("department_id")
-        await encounters_collection.create_index("created_by")
-        await encounters_collection.create_index([("patient_id", 1), ("created_at", -1)])
-        logger.info("✅ Created indexes on encounters collection")
-    except OperationFailure as e:
-        logger.warning(f"Index creation failed: {e}")
-    
-    # 7. Vitals Collection
-    logger.info("Creating vitals collection...")
-    vitals_collection = db.vitals
-    
-    # Create indexes
-    try:
-        await vitals_collection.create_index("patient_id")
-        await vitals_collection.create_index("recorded_by")
-        await vitals_collection.create_index([("patient_id", 1), ("recorded_at", -1)])
-        logger.info("✅ Created indexes on vitals collection")
-    except OperationFailure as e:
-        logger.warning(f"Index creation failed: {e}")
-    
-    # 8. Consult Requests Collection
-    logger.info("Creating consult_requests collection...")
-    consult_requests_collection = db.consult_requests
-    
-    # Create indexes
-    try:
-        await consult_requests_collection.create_index("patient_id")
-        await consult_requests_collection.create_index("from_department_id")
-        await consult_requests_collection.create_index("to_department_id")
-        await consult_requests_collection.create_index("status")
-        await consult_requests_collection.create_index([("to_department_id", 1), ("status", 1)])
-        logger.info("✅ Created indexes on consult_requests collection")
-    except OperationFailure as e:
-        logger.warning(f"Index creation failed: {e}")
-    
-    # 9. OPD Counter Collection (for unique OPD numbers)
+    # 2. OPD Counter Collection (for unique OPD numbers)
     logger.info("Creating opd_counter collection...")
     opd_counter_collection = db.opd_counter
     
@@ -0,0 +1,109 @@
+# deps/auth.py
+"""
+Authenticated user dependency for pharmacy routers
+Verifies the JWT issued by /api/auth/login and resolves the user's active
+status and roles. User lookups are cached in-process for a short TTL so
+billing calls do not pay a MongoDB round trip per request; deactivations
+take effect within USER_CACHE_TTL_SECONDS (immediately on this worker when
+invalidate_user_cache is called).
+"""
+
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Depends, HTTPException, status
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+
+from auth import verify_token
+from deps.db import get_database
+
+USER_CACHE_TTL_SECONDS = int(os.environ.get("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_ENTRIES = 1000
+
+# Login roles (models.UserRole) mapped to the role names the pharmacy routers check
+ROLE_ALIASES = {
+    "pharmacy": "pharmacist",
+    "nursing": "nurse",
+}
+
+security = HTTPBearer()
+
+# user_id -> (expires_at, resolved user or None for unknown/inactive users)
+_user_cache: Dict[str, Tuple[float, Optional[Dict]]] = {}
+
+def normalize_role(role: str) -> str:
+    return ROLE_ALIASES.get(role, role)
+
+def _resolve_roles(user: Dict) -> List[str]:
+    """Roles from either user schema: a single "role" or a "roles" list"""
+    roles = user.get("roles") or []
+    if user.get("role"):
+        roles = [user["role"]] + [role for role in roles if role != user["role"]]
+    return [normalize_role(str(getattr(role, "value", role))) for role in roles]
+
+def _is_active(user: Dict) -> bool:
+    if "status" in user:
+        return user["status"] == "active"
+    return bool(user.get("active", True))
+
+async def _load_user(user_id: str, username: str) -> Optional[Dict]:
+    query = {"id": user_id} if user_id else {"username": username}
+    user = await get_database().users.find_one(
+        query, {"id": 1, "username": 1, "role": 1, "roles": 1, "status": 1, "active": 1}
+    )
+    if not user or not _is_active(user):
+        return None
+
+    roles = _resolve_roles(user)
+    return {
+        "user_id": user.get("id") or str(user["_id"]),
+        "username": user["username"],
+        # Admin wins when a user holds several roles
+        "role": "admin" if "admin" in roles else (roles[0] if roles else ""),
+        "roles": roles,
+    }
+
+async def get_cached_user(user_id: str, username: str) -> Optional[Dict]:
+    """Resolve an active user through the TTL cache"""
+    key = user_id or f"username:{username}"
+    now = time.monotonic()
+
+    entry = _user_cache.get(key)
+    if entry and entry[0] > now:
+        return entry[1]
+
+    user = await _load_user(user_id, username)
+    if len(_user_cache) >= USER_CACHE_MAX_ENTRIES:
+        for stale_key in [k for k, (expires_at, _) in _user_cache.items() if expires_at <= now]:
+            del _user_cache[stale_key]
+        if len(_user_cache) >= USER_CACHE_MAX_ENTRIES:
+            _user_cache.clear()
+    _user_cache[key] = (now + USER_CACHE_TTL_SECONDS, user)
+    return user
+
+def invalidate_user_cache(user_id: Optional[str] = None):
+    """Forget a cached user (or everyone) after a status or role change"""
+    if user_id is None:
+        _user_cache.clear()
+    else:
+        _user_cache.pop(user_id, None)
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict:
+    """Get the active user behind the request's bearer token"""
+    token_data = verify_token(credentials.credentials)
+    if not token_data:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    user = await get_cached_user(token_data.get("user_id"), token_data["username"])
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found or inactive",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return dict(user, roles=list(user["roles"]))
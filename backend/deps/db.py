@@ -17,10 +17,14 @@ if parent_dir not in sys.path:
 # Database instance will be set by the main server
 _database = None
 
+# Whether the server can run multi-document transactions (replica set or mongos)
+_transactions_supported = None
+
 def set_database(database_instance):
     """Set the database instance from the main server"""
-    global _database
+    global _database, _transactions_supported
     _database = database_instance
+    _transactions_supported = None
 
 def get_database():
     """Get the database instance"""
@@ -34,6 +38,26 @@ def get_database():
             pass
     return _database
 
+async def supports_transactions():
+    """Check once whether the connected server accepts multi-document transactions"""
+    global _transactions_supported
+    if _transactions_supported is None:
+        hello = await get_database().command("hello")
+        _transactions_supported = bool(hello.get("setName") or hello.get("msg") == "isdbgrid")
+    return _transactions_supported
+
+async def run_in_transaction(callback):
+    """
+    Run callback(session) inside a multi-document transaction
+    Standalone servers (local development) cannot run transactions, so the
+    callback is awaited with session=None and writes are applied one by one
+    """
+    if not await supports_transactions():
+        return await callback(None)
+    
+    async with await get_database().client.start_session() as session:
+        return await session.with_transaction(callback)
+
 # Database manager class for pharmacy operations
 class DatabaseManager:
     @property
@@ -44,6 +68,10 @@ class DatabaseManager:
         """Check if database is connected"""
         return get_database() is not None
     
+    async def run_in_transaction(self, callback):
+        """Run callback(session) inside a multi-document transaction"""
+        return await run_in_transaction(callback)
+    
     # Collection shortcuts for pharmacy operations
     @property
     def suppliers(self):
@@ -95,6 +123,16 @@ class DatabaseManager:
         db = get_database()
         return db.stock_ledger if db is not None else None
     
+    @property
+    def stock_balances(self):
+        db = get_database()
+        return db.stock_balances if db is not None else None
+    
+    @property
+    def stock_reservations(self):
+        db = get_database()
+        return db.stock_reservations if db is not None else None
+    
     @property
     def returns(self):
         db = get_database()
@@ -109,6 +147,26 @@ class DatabaseManager:
     def audits(self):
         db = get_database()
         return db.audits if db is not None else None
+    
+    @property
+    def gst_monthly_rollups(self):
+        db = get_database()
+        return db.gst_monthly_rollups if db is not None else None
+    
+    @property
+    def sales_daily(self):
+        db = get_database()
+        return db.sales_daily if db is not None else None
+    
+    @property
+    def near_expiry_snapshot(self):
+        db = get_database()
+        return db.near_expiry_snapshot if db is not None else None
+    
+    @property
+    def snapshot_runs(self):
+        db = get_database()
+        return db.snapshot_runs if db is not None else None
 
 # Create a global instance
 db_manager = DatabaseManager()
@@ -0,0 +1,179 @@
+# deps/expiry.py
+"""
+Near-expiry snapshot for the NearExpiryManagement screen
+near_expiry_snapshot holds one document per batch with stock that expires
+within NEAR_EXPIRY_HORIZON_MONTHS, with product details, stock, values and
+the expiry colour worked out once per run. A background task rebuilds it
+every night at NEAR_EXPIRY_SNAPSHOT_HOUR (local time); the first read of a
+new day, or an explicit refresh, rebuilds it on demand. Each run is
+recorded in snapshot_runs, so a day with nothing near expiry still counts
+as snapshotted.
+"""
+
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from pymongo import ReplaceOne
+
+from deps.db import db
+from deps.rollups import REPORT_UTC_OFFSET_MINUTES, business_day, local_time
+from deps.stock import BATCH_SCOPE
+from utils.gst import EXPIRY_COLOR_BANDS, expiry_cutoff, get_expiry_color
+from utils.money import money_fields, to_paise
+
+# Furthest ahead the snapshot looks; the screen offers up to 24 months
+NEAR_EXPIRY_HORIZON_MONTHS = int(os.environ.get("NEAR_EXPIRY_HORIZON_MONTHS", "24"))
+
+# Local hour of the nightly rebuild
+NEAR_EXPIRY_SNAPSHOT_HOUR = int(os.environ.get("NEAR_EXPIRY_SNAPSHOT_HOUR", "1"))
+
+# snapshot_runs document recording the latest rebuild
+SNAPSHOT_RUN_ID = "near_expiry"
+
+_rebuild_lock = asyncio.Lock()
+_scheduler_task: Optional[asyncio.Task] = None
+
+def expiry_today() -> datetime:
+    """Today's local date and time; expiry colours and cutoffs count months from it"""
+    return local_time(datetime.utcnow())
+
+def expiry_color_expression(expiry_field: str, today: datetime) -> Dict:
+    """Aggregation counterpart of get_expiry_color for a YYYY-MM expiry field"""
+    return {"$switch": {
+        "branches": [
+            {"case": {"$lte": [expiry_field, expiry_cutoff(today, months)]}, "then": color}
+            for color, months in EXPIRY_COLOR_BANDS
+        ],
+        "default": "ok"
+    }}
+
+def snapshot_document(item: Dict, snapshot_at: datetime, today: datetime) -> Dict:
+    """Snapshot row for one batch balance joined with its batch and product"""
+    batch = item["batch"]
+    product = item["product"]
+    current_stock = item["qty"]
+    return {
+        "_id": item["batch_id"],
+        "batch_id": item["batch_id"],
+        "batch_no": batch["batch_no"],
+        "product_id": item["product_id"],
+        "product_name": f"{product['brand_name']} {product['strength']} {product['form']}",
+        "chemical_name": product["chemical_name"],
+        "company_name": product.get("company_name", ""),
+        "schedule_symbol": product["schedule_symbol"],
+        "expiry": batch["expiry"],
+        "expiry_color": get_expiry_color(batch["expiry"], today),
+        "days_to_expiry": (datetime.strptime(batch["expiry"], "%Y-%m") - today).days,
+        "current_stock": current_stock,
+        "mrp": batch["mrp"],
+        "cost_per_unit": batch["effective_cost_per_unit"],
+        **money_fields({
+            "cost_value": to_paise(current_stock * batch["effective_cost_per_unit"]),
+            "mrp_value": to_paise(current_stock * batch["mrp"])
+        }),
+        "rack_id": batch.get("rack_id"),
+        "supplier_id": batch["supplier_id"],
+        "snapshot_date": business_day(snapshot_at),
+        "snapshot_at": snapshot_at
+    }
+
+async def rebuild_near_expiry_snapshot(chunk_size: int = 1000) -> int:
+    """Rewrite near_expiry_snapshot from batch balances; returns the number of batches in it"""
+    async with _rebuild_lock:
+        return await _rebuild_snapshot(chunk_size)
+
+async def _rebuild_snapshot(chunk_size: int = 1000) -> int:
+    """Rebuild body; callers hold _rebuild_lock"""
+    snapshot_at = datetime.utcnow()
+    today = expiry_today()
+    cutoff = expiry_cutoff(today, NEAR_EXPIRY_HORIZON_MONTHS)
+
+    # Start from batch balances with stock, so the ledger is never scanned
+    pipeline = [
+        {"$match": {"scope": BATCH_SCOPE, "qty": {"$gt": 0}}},
+        {"$lookup": {
+            "from": "batches",
+            "localField": "batch_id",
+            "foreignField": "_id",
+            "as": "batch"
+        }},
+        {"$unwind": "$batch"},
+        {"$match": {"batch.status": "APPROVED", "batch.expiry": {"$lte": cutoff}}},
+        {"$lookup": {
+            "from": "products",
+            "localField": "product_id",
+            "foreignField": "_id",
+            "as": "product"
+        }},
+        {"$unwind": "$product"}
+    ]
+
+    writes = []
+    async for item in db.stock_balances.aggregate(pipeline):
+        document = snapshot_document(item, snapshot_at, today)
+        writes.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+    for start in range(0, len(writes), chunk_size):
+        await db.near_expiry_snapshot.bulk_write(writes[start:start + chunk_size], ordered=False)
+
+    # Batches sold out, disposed or past the horizon since the last run
+    await db.near_expiry_snapshot.delete_many({"snapshot_at": {"$lt": snapshot_at}})
+    await db.snapshot_runs.replace_one(
+        {"_id": SNAPSHOT_RUN_ID},
+        {"snapshot_at": snapshot_at, "snapshot_date": business_day(snapshot_at), "batches": len(writes)},
+        upsert=True
+    )
+    return len(writes)
+
+async def _taken_today() -> Optional[datetime]:
+    """When today's snapshot was taken (local business day), or None"""
+    run = await db.snapshot_runs.find_one({"_id": SNAPSHOT_RUN_ID})
+    if run and run["snapshot_date"] == business_day(datetime.utcnow()):
+        return run["snapshot_at"]
+    return None
+
+async def ensure_near_expiry_snapshot() -> datetime:
+    """Rebuild the snapshot if it was not taken today (local time); returns when it was taken"""
+    snapshot_at = await _taken_today()
+    if snapshot_at:
+        return snapshot_at
+
+    async with _rebuild_lock:
+        # Requests queued behind the first rebuild of the day find it done
+        snapshot_at = await _taken_today()
+        if snapshot_at:
+            return snapshot_at
+        await _rebuild_snapshot()
+    return await _taken_today()
+
+def seconds_until_next_run(now: datetime) -> float:
+    """Seconds from a UTC instant to the next local NEAR_EXPIRY_SNAPSHOT_HOUR"""
+    offset = timedelta(minutes=REPORT_UTC_OFFSET_MINUTES)
+    local_now = now + offset
+    next_run = local_now.replace(hour=NEAR_EXPIRY_SNAPSHOT_HOUR, minute=0, second=0, microsecond=0)
+    if next_run <= local_now:
+        next_run += timedelta(days=1)
+    return (next_run - local_now).total_seconds()
+
+async def _run_nightly():
+    while True:
+        await asyncio.sleep(seconds_until_next_run(datetime.utcnow()))
+        try:
+            count = await rebuild_near_expiry_snapshot()
+            logging.info(f"Near-expiry snapshot rebuilt with {count} batches")
+        except Exception as e:
+            logging.error(f"Error rebuilding near-expiry snapshot: {e}")
+
+def start_near_expiry_scheduler():
+    """Start the nightly rebuild on the running event loop (once per process)"""
+    global _scheduler_task
+    if _scheduler_task is None or _scheduler_task.done():
+        _scheduler_task = asyncio.get_running_loop().create_task(_run_nightly())
+
+def stop_near_expiry_scheduler():
+    global _scheduler_task
+    if _scheduler_task is not None:
+        _scheduler_task.cancel()
+        _scheduler_task = None
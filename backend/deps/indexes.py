@@ -0,0 +1,237 @@
+# deps/indexes.py
+"""
+Central index registry for EHR and pharmacy collections
+Every query the routers run against a non-trivial collection should be
+covered by an entry here. server.py applies the registry at startup and
+logs any drift between the registry and the live database.
+"""
+
+import logging
+from typing import Dict, List
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+INDEX_REGISTRY: Dict[str, List[IndexModel]] = {
+    # ===== EHR =====
+    "users": [
+        IndexModel([("username", ASCENDING)], unique=True),
+        IndexModel([("id", ASCENDING)]),
+        IndexModel([("roles", ASCENDING), ("active", ASCENDING)]),
+    ],
+    "departments": [
+        IndexModel([("id", ASCENDING)]),
+        IndexModel([("name", ASCENDING)]),
+        IndexModel([("slug", ASCENDING)], unique=True),
+    ],
+    "doctors": [
+        IndexModel([("id", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING)]),
+        IndexModel([("department_id", ASCENDING)]),
+        IndexModel([("department_id", ASCENDING), ("active", ASCENDING)]),
+    ],
+    "nurses": [
+        IndexModel([("user_id", ASCENDING)]),
+        IndexModel([("department_id", ASCENDING)]),
+        IndexModel([("department_id", ASCENDING), ("active", ASCENDING)]),
+    ],
+    "doctor_profiles": [
+        IndexModel([("doctor_id", ASCENDING)]),
+    ],
+    "patients": [
+        IndexModel([("id", ASCENDING)]),
+        IndexModel([("phone_number", ASCENDING)]),
+        IndexModel([("opd_number", ASCENDING)]),
+        IndexModel([("created_at", DESCENDING)]),
+    ],
+    "encounters": [
+        IndexModel([("patient_id", ASCENDING)]),
+        IndexModel([("department_id", ASCENDING)]),
+        IndexModel([("created_by", ASCENDING)]),
+        IndexModel([("patient_id", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+    "vitals": [
+        IndexModel([("patient_id", ASCENDING)]),
+        IndexModel([("recorded_by", ASCENDING)]),
+        IndexModel([("patient_id", ASCENDING), ("recorded_at", DESCENDING)]),
+    ],
+    "consult_requests": [
+        IndexModel([("patient_id", ASCENDING)]),
+        IndexModel([("from_department_id", ASCENDING)]),
+        IndexModel([("to_department_id", ASCENDING)]),
+        IndexModel([("status", ASCENDING)]),
+        IndexModel([("to_department_id", ASCENDING), ("status", ASCENDING)]),
+    ],
+    "appointments": [
+        IndexModel([("id", ASCENDING)]),
+        IndexModel([("appointment_date", ASCENDING), ("appointment_time", ASCENDING)]),
+        IndexModel([("doctor_id", ASCENDING), ("appointment_date", ASCENDING)]),
+    ],
+    "vital_signs": [
+        IndexModel([("recorded_at", DESCENDING)]),
+        IndexModel([("patient_id", ASCENDING), ("recorded_at", DESCENDING)]),
+        IndexModel([("opd_number", ASCENDING), ("recorded_at", DESCENDING)]),
+    ],
+    "consultations": [
+        IndexModel([("consultation_date", DESCENDING)]),
+        IndexModel([("patient_id", ASCENDING), ("consultation_date", DESCENDING)]),
+    ],
+    "lab_tests": [
+        IndexModel([("id", ASCENDING)]),
+    ],
+    "lab_orders": [
+        IndexModel([("id", ASCENDING)]),
+        IndexModel([("created_at", DESCENDING)]),
+    ],
+    "lab_results": [
+        IndexModel([("created_at", DESCENDING)]),
+    ],
+    "medications": [
+        IndexModel([("id", ASCENDING)]),
+    ],
+    "prescriptions": [
+        IndexModel([("id", ASCENDING)]),
+        IndexModel([("prescribed_date", DESCENDING)]),
+    ],
+    "nursing_procedures": [
+        IndexModel([("performed_at", DESCENDING)]),
+    ],
+    "bills": [
+        IndexModel([("created_at", DESCENDING)]),
+    ],
+    "sequences": [
+        IndexModel([("type", ASCENDING), ("year", ASCENDING), ("date", ASCENDING)], unique=True),
+    ],
+
+    # ===== PHARMACY =====
+    "products": [
+        IndexModel([("brand_name", ASCENDING), ("strength", ASCENDING), ("form", ASCENDING)]),
+        IndexModel([("chemical_name", ASCENDING)]),
+        IndexModel([("schedule_symbol", ASCENDING)]),
+        IndexModel([("hsn", ASCENDING)]),
+    ],
+    "chemical_schedules": [
+        IndexModel([("chemical_name_norm", ASCENDING)], unique=True),
+    ],
+    "batches": [
+        IndexModel([("expiry", ASCENDING), ("status", ASCENDING)]),
+        IndexModel([("product_id", ASCENDING), ("expiry", ASCENDING)]),
+        IndexModel([("rack_id", ASCENDING)]),
+    ],
+    "stock_ledger": [
+        IndexModel([("batch_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("product_id", ASCENDING)]),
+        IndexModel([("ref_type", ASCENDING), ("ref_id", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING)]),
+    ],
+    "stock_balances": [
+        IndexModel([("scope", ASCENDING), ("product_id", ASCENDING), ("qty", ASCENDING)]),
+        IndexModel([("batch_id", ASCENDING)]),
+    ],
+    "stock_reservations": [
+        IndexModel([("cart_id", ASCENDING)]),
+        IndexModel([("expires_at", ASCENDING)]),
+    ],
+    "purchases": [
+        IndexModel([("batch_ids", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("approved_at", ASCENDING)]),
+        IndexModel([("supplier_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING)]),
+    ],
+    "sales": [
+        IndexModel([("date_time", DESCENDING)]),
+        IndexModel([("bill_no", ASCENDING)]),
+        IndexModel([("patient.phone", ASCENDING), ("date_time", DESCENDING)]),
+        IndexModel([("created_at", ASCENDING)]),
+    ],
+    "sale_items": [
+        IndexModel([("sale_id", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING)]),
+    ],
+    "payments": [
+        IndexModel([("sale_id", ASCENDING)]),
+        IndexModel([("received_at", ASCENDING)]),
+    ],
+    "returns": [
+        IndexModel([("sale_id", ASCENDING)]),
+        IndexModel([("date_time", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("date_time", ASCENDING)]),
+    ],
+    "disposals": [
+        IndexModel([("created_at", DESCENDING)]),
+        IndexModel([("batch_id", ASCENDING)]),
+    ],
+    "near_expiry_snapshot": [
+        IndexModel([("expiry_color", ASCENDING), ("rack_id", ASCENDING), ("schedule_symbol", ASCENDING)]),
+        IndexModel([("expiry", ASCENDING)]),
+        IndexModel([("rack_id", ASCENDING), ("expiry", ASCENDING)]),
+        IndexModel([("snapshot_at", DESCENDING)]),
+    ],
+    "audits": [
+        IndexModel([("entity", ASCENDING), ("entity_id", ASCENDING)]),
+    ],
+}
+
+
+def _key_of(keys) -> tuple:
+    """Normalize an index key spec to a hashable tuple of (field, direction)"""
+    return tuple(
+        (field, int(direction) if isinstance(direction, (int, float)) else direction)
+        for field, direction in keys
+    )
+
+
+def registry_key_specs() -> Dict[str, Dict[tuple, dict]]:
+    """Registry as {collection: {key spec: options}} for comparisons and tests"""
+    specs = {}
+    for collection, models in INDEX_REGISTRY.items():
+        specs[collection] = {}
+        for model in models:
+            document = model.document
+            specs[collection][_key_of(document["key"].items())] = {
+                "unique": bool(document.get("unique", False))
+            }
+    return specs
+
+
+async def check_index_drift(database) -> Dict[str, Dict[str, list]]:
+    """
+    Compare the registry with the live database
+    Returns {collection: {"missing": [...], "extra": [...], "mismatched": [...]}}
+    for every collection that differs
+    """
+    drift = {}
+    for collection, expected in registry_key_specs().items():
+        info = await database[collection].index_information()
+        live = {
+            _key_of(index["key"]): {"unique": bool(index.get("unique", False))}
+            for name, index in info.items()
+            if name != "_id_"
+        }
+
+        report = {
+            "missing": [list(key) for key in expected if key not in live],
+            "extra": [list(key) for key in live if key not in expected],
+            "mismatched": [
+                list(key) for key, options in expected.items()
+                if key in live and live[key] != options
+            ],
+        }
+        if any(report.values()):
+            drift[collection] = report
+    return drift
+
+
+async def ensure_indexes(database) -> Dict[str, Dict[str, list]]:
+    """Create every registry index (a no-op for ones that exist) and return the remaining drift"""
+    for collection, models in INDEX_REGISTRY.items():
+        # One at a time so a single conflicting index does not block the rest
+        for model in models:
+            try:
+                await database[collection].create_indexes([model])
+            except OperationFailure as e:
+                # Conflicting options or duplicate data; reported as drift below
+                logging.warning(f"Index creation failed for {collection}: {e}")
+
+    return await check_index_drift(database)
@@ -0,0 +1,56 @@
+# deps/product_search.py
+"""
+Process-wide product search index for the billing screen
+The index is built from the products collection on first use and rebuilt
+by the first search after it is older than PRODUCT_SEARCH_TTL_SECONDS,
+which picks up products written by other workers or scripts. Products
+created through this worker are indexed immediately via index_product.
+"""
+
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from deps.db import get_database
+from utils.search import FILTER_FIELDS, SEARCH_FIELDS, ProductSearchIndex
+
+PRODUCT_SEARCH_TTL_SECONDS = int(os.environ.get("PRODUCT_SEARCH_TTL_SECONDS", "300"))
+
+_index: Optional[ProductSearchIndex] = None
+_built_at = 0.0
+_build_lock = asyncio.Lock()
+
+async def _build_index() -> ProductSearchIndex:
+    projection = {field: 1 for field in (*SEARCH_FIELDS, *FILTER_FIELDS)}
+    products = await get_database().products.find({}, projection).to_list(length=None)
+    # Building 50k products takes about a second of CPU; keep it off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, ProductSearchIndex.from_products, products)
+
+async def get_search_index() -> ProductSearchIndex:
+    """The current index, (re)building it when missing or stale"""
+    global _index, _built_at
+    if _index is not None and time.monotonic() - _built_at < PRODUCT_SEARCH_TTL_SECONDS:
+        return _index
+
+    async with _build_lock:
+        # Another request may have rebuilt it while we waited
+        if _index is None or time.monotonic() - _built_at >= PRODUCT_SEARCH_TTL_SECONDS:
+            _index = await _build_index()
+            _built_at = time.monotonic()
+    return _index
+
+async def search_product_ids(query: str, limit: int = 20, filters: Optional[Dict[str, Any]] = None) -> List[Any]:
+    """Ranked _ids of products matching a search box query (and filters, see FILTER_FIELDS)"""
+    index = await get_search_index()
+    return index.search(query, limit, filters)
+
+def index_product(product: Dict):
+    """Add or refresh one product after it is written"""
+    if _index is not None:
+        _index.add(product)
+
+def invalidate_search_index():
+    """Force a rebuild on the next search (e.g. after bulk imports)"""
+    global _built_at
+    _built_at = 0.0
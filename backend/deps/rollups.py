@@ -0,0 +1,264 @@
+# deps/rollups.py
+"""
+Daily sales rollup for dashboards
+sales_daily holds one document per local business day, keyed "YYYY-MM-DD".
+create_sale and create_return $inc it alongside the sale or return they
+write, so a dashboard over any range reads one small document per day
+instead of every sale. rebuild_sales_daily recomputes it from the source
+collections (backfill, or repair after a failed write).
+
+Document shape (all money in integer paise):
+    sales_count, lines_count, items_count, revenue_paise, taxable_paise,
+    cgst_paise, sgst_paise, igst_paise, discount_paise,
+    returns_count, returned_items_count, refund_paise,
+    payments: {mode: paise},
+    products: {product_id: {qty, net_paise, returned_qty, refund_paise}}
+"""
+
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import ReplaceOne
+
+from deps.db import db
+from utils.money import stored_paise, stored_paise_expression
+
+# Business days and filing months follow Indian Standard Time, while documents store UTC
+REPORT_UTC_OFFSET_MINUTES = int(os.environ.get("REPORT_UTC_OFFSET_MINUTES", "330"))
+
+DAY_FORMAT = "%Y-%m-%d"
+
+# Sale totals rolled up per day: rollup field -> key in sale["totals"]
+SALE_TOTAL_FIELDS = {
+    "revenue_paise": "net",
+    "taxable_paise": "taxable",
+    "cgst_paise": "cgst",
+    "sgst_paise": "sgst",
+    "igst_paise": "igst",
+    "discount_paise": "discount_on_mrp",
+}
+
+def report_timezone() -> str:
+    """UTC offset in the "+HH:MM" form aggregation date operators accept"""
+    sign = "-" if REPORT_UTC_OFFSET_MINUTES < 0 else "+"
+    hours, minutes = divmod(abs(REPORT_UTC_OFFSET_MINUTES), 60)
+    return f"{sign}{hours:02d}:{minutes:02d}"
+
+def local_time(moment: datetime) -> datetime:
+    """Local (report timezone) wall-clock time of a UTC timestamp"""
+    return moment + timedelta(minutes=REPORT_UTC_OFFSET_MINUTES)
+
+def business_day(moment: datetime) -> str:
+    """Local business day ("YYYY-MM-DD") of a UTC timestamp"""
+    return local_time(moment).strftime(DAY_FORMAT)
+
+def days_between(start_day: str, end_day: str) -> List[str]:
+    current = datetime.strptime(start_day, DAY_FORMAT)
+    last = datetime.strptime(end_day, DAY_FORMAT)
+    days = []
+    while current <= last:
+        days.append(current.strftime(DAY_FORMAT))
+        current += timedelta(days=1)
+    return days
+
+def day_expression(date_field: str) -> Dict:
+    return {"$dateToString": {"format": DAY_FORMAT, "date": date_field, "timezone": report_timezone()}}
+
+def _add(increments: Dict[str, int], field: str, amount: int):
+    if amount:
+        increments[field] = increments.get(field, 0) + amount
+
+def sale_increments(sale: Dict, sale_items: Iterable[Dict], payments: Iterable[Dict]) -> Dict[str, int]:
+    """$inc document adding one sale to its day"""
+    increments = {"sales_count": 1}
+    for field, total in SALE_TOTAL_FIELDS.items():
+        _add(increments, field, stored_paise(sale["totals"], total))
+
+    for item in sale_items:
+        prefix = f"products.{item['product_id']}"
+        _add(increments, "lines_count", 1)
+        _add(increments, "items_count", item["nos"])
+        _add(increments, f"{prefix}.qty", item["nos"])
+        _add(increments, f"{prefix}.net_paise", stored_paise(item, "net"))
+
+    for payment in payments:
+        for mode in payment["split"]:
+            _add(increments, f"payments.{mode}", stored_paise(payment, "amount"))
+    return increments
+
+def return_increments(return_doc: Dict, sold_items: Dict[str, Dict]) -> Dict[str, int]:
+    """$inc document adding one approved return to its day; sold_items maps sale_item_id -> sale item"""
+    increments = {"returns_count": 1}
+    _add(increments, "refund_paise", stored_paise(return_doc["totals"], "net_refund"))
+    for item in return_doc["items"]:
+        prefix = f"products.{sold_items[item['sale_item_id']]['product_id']}"
+        _add(increments, "returned_items_count", item["qty_returned"])
+        _add(increments, f"{prefix}.returned_qty", item["qty_returned"])
+        _add(increments, f"{prefix}.refund_paise", stored_paise(item, "net_refund"))
+    return increments
+
+async def _apply(day: str, increments: Dict[str, int], session=None):
+    await db.sales_daily.update_one(
+        {"_id": day},
+        {
+            "$inc": increments,
+            "$set": {"updated_at": datetime.utcnow()},
+            "$setOnInsert": {"date": day}
+        },
+        upsert=True,
+        session=session
+    )
+
+async def record_sale(sale: Dict, sale_items: Iterable[Dict], payments: Iterable[Dict], session=None):
+    """Add a newly written sale to sales_daily (pass the sale's session to commit together)"""
+    await _apply(business_day(sale["created_at"]), sale_increments(sale, sale_items, payments), session)
+
+async def record_return(return_doc: Dict, sold_items: Dict[str, Dict], session=None):
+    """Add an approved return to the day it was raised"""
+    await _apply(business_day(return_doc["date_time"]), return_increments(return_doc, sold_items), session)
+
+def _empty_day(day: str) -> Dict:
+    return {
+        "_id": day,
+        "date": day,
+        "sales_count": 0,
+        "lines_count": 0,
+        "items_count": 0,
+        **{field: 0 for field in SALE_TOTAL_FIELDS},
+        "returns_count": 0,
+        "returned_items_count": 0,
+        "refund_paise": 0,
+        "payments": {},
+        "products": {}
+    }
+
+def _product(day_doc: Dict, product_id: str) -> Dict:
+    return day_doc["products"].setdefault(
+        product_id, {"qty": 0, "net_paise": 0, "returned_qty": 0, "refund_paise": 0}
+    )
+
+async def compute_sales_daily(start: Optional[datetime] = None, end: Optional[datetime] = None) -> Dict[str, Dict]:
+    """sales_daily documents computed from sales, sale_items, payments and returns"""
+    def window(field: str) -> Dict:
+        bounds = {}
+        if start is not None:
+            bounds["$gte"] = start
+        if end is not None:
+            bounds["$lt"] = end
+        return {field: bounds} if bounds else {}
+
+    days: Dict[str, Dict] = {}
+    def day_doc(day: str) -> Dict:
+        if day not in days:
+            days[day] = _empty_day(day)
+        return days[day]
+
+    async for row in db.sales.aggregate([
+        {"$match": window("created_at")},
+        {"$group": {
+            "_id": day_expression("$created_at"),
+            "sales_count": {"$sum": 1},
+            **{
+                field: {"$sum": stored_paise_expression(f"$totals.{total}")}
+                for field, total in SALE_TOTAL_FIELDS.items()
+            }
+        }}
+    ]):
+        doc = day_doc(row.pop("_id"))
+        doc.update(row)
+
+    async for row in db.sale_items.aggregate([
+        {"$match": window("created_at")},
+        {"$group": {
+            "_id": {"day": day_expression("$created_at"), "product_id": "$product_id"},
+            "lines": {"$sum": 1},
+            "qty": {"$sum": "$nos"},
+            "net_paise": {"$sum": stored_paise_expression("$net")}
+        }}
+    ]):
+        doc = day_doc(row["_id"]["day"])
+        doc["lines_count"] += row["lines"]
+        doc["items_count"] += row["qty"]
+        product = _product(doc, row["_id"]["product_id"])
+        product["qty"] += row["qty"]
+        product["net_paise"] += row["net_paise"]
+
+    async for row in db.payments.aggregate([
+        {"$match": window("received_at")},
+        {"$project": {"received_at": 1, "amount": 1, "amount_paise": 1, "split": {"$objectToArray": "$split"}}},
+        {"$unwind": "$split"},
+        {"$group": {
+            "_id": {"day": day_expression("$received_at"), "mode": "$split.k"},
+            "paise": {"$sum": stored_paise_expression("$amount")}
+        }}
+    ]):
+        day_doc(row["_id"]["day"])["payments"][row["_id"]["mode"]] = row["paise"]
+
+    approved_returns = {"status": "APPROVED", **window("date_time")}
+    async for row in db.returns.aggregate([
+        {"$match": approved_returns},
+        {"$group": {
+            "_id": day_expression("$date_time"),
+            "returns_count": {"$sum": 1},
+            "refund_paise": {"$sum": stored_paise_expression("$totals.net_refund")}
+        }}
+    ]):
+        doc = day_doc(row.pop("_id"))
+        doc.update(row)
+
+    async for row in db.returns.aggregate([
+        {"$match": approved_returns},
+        {"$unwind": "$items"},
+        {"$lookup": {
+            "from": "sale_items",
+            "localField": "items.sale_item_id",
+            "foreignField": "_id",
+            "as": "sale_item"
+        }},
+        {"$unwind": "$sale_item"},
+        {"$group": {
+            "_id": {"day": day_expression("$date_time"), "product_id": "$sale_item.product_id"},
+            "returned_qty": {"$sum": "$items.qty_returned"},
+            "refund_paise": {"$sum": stored_paise_expression("$items.net_refund")}
+        }}
+    ]):
+        doc = day_doc(row["_id"]["day"])
+        doc["returned_items_count"] += row["returned_qty"]
+        product = _product(doc, row["_id"]["product_id"])
+        product["returned_qty"] += row["returned_qty"]
+        product["refund_paise"] += row["refund_paise"]
+
+    return days
+
+async def rebuild_sales_daily(
+    start_day: Optional[str] = None,
+    end_day: Optional[str] = None,
+    chunk_size: int = 500
+) -> int:
+    """
+    Rewrite sales_daily for a range of local days (all days when open-ended);
+    returns the number of day documents written
+    Run while billing is idle - sales posted mid-rebuild can be counted twice
+    """
+    offset = timedelta(minutes=REPORT_UTC_OFFSET_MINUTES)
+    start = datetime.strptime(start_day, DAY_FORMAT) - offset if start_day else None
+    end = datetime.strptime(end_day, DAY_FORMAT) + timedelta(days=1) - offset if end_day else None
+
+    now = datetime.utcnow()
+    days = await compute_sales_daily(start, end)
+    writes = [
+        ReplaceOne({"_id": day}, {**doc, "updated_at": now}, upsert=True)
+        for day, doc in days.items()
+    ]
+    for position in range(0, len(writes), chunk_size):
+        await db.sales_daily.bulk_write(writes[position:position + chunk_size], ordered=False)
+
+    # Days in the range with no sales or returns left behind them
+    stale = {"updated_at": {"$lt": now}}
+    if start_day:
+        stale.setdefault("_id", {})["$gte"] = start_day
+    if end_day:
+        stale.setdefault("_id", {})["$lte"] = end_day
+    await db.sales_daily.delete_many(stale)
+    return len(days)
@@ -0,0 +1,90 @@
+# deps/sequences.py
+"""
+Atomic counters for OPD, token and bill numbers
+Each counter is one document in the sequences collection, identified by its
+filter (e.g. {"type": "opd", "year": 2025}) and holding the last issued
+value in "current". Values are issued with a single find_one_and_update
+$inc, so concurrent callers can never receive the same number.
+
+Counters listed in SEQUENCE_LEASED_TYPES are leased in blocks: a worker
+reserves SEQUENCE_LEASE_BLOCK_SIZE numbers with one round trip and hands
+them out from memory. Leased numbers stay unique across workers but may
+be issued out of order between workers and leave gaps on restart, so
+counters that must be contiguous (bill numbers) should not be leased.
+"""
+
+import asyncio
+import os
+from typing import Dict, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from deps.db import get_database
+
+LEASE_BLOCK_SIZE = int(os.environ.get("SEQUENCE_LEASE_BLOCK_SIZE", "50"))
+LEASED_TYPES = {
+    name.strip() for name in os.environ.get("SEQUENCE_LEASED_TYPES", "").split(",") if name.strip()
+}
+
+# Attempts when two callers race to create the same counter document
+UPSERT_RETRIES = 3
+
+async def increment_sequence(counter: Dict, amount: int = 1, database=None) -> int:
+    """
+    Atomically add amount to a counter and return its new value
+    The counter document is created on first use
+    """
+    database = database if database is not None else get_database()
+    
+    for attempt in range(UPSERT_RETRIES):
+        try:
+            sequence_doc = await database.sequences.find_one_and_update(
+                counter,
+                {"$inc": {"current": amount}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return sequence_doc["current"]
+        except DuplicateKeyError:
+            # Another caller created the document first; the retry increments it
+            if attempt == UPSERT_RETRIES - 1:
+                raise
+
+class SequenceAllocator:
+    """Issues counter values, leasing blocks in memory for leased counter types"""
+    
+    def __init__(self, block_size: int = LEASE_BLOCK_SIZE, leased_types=None, database=None):
+        self.block_size = max(block_size, 1)
+        self.leased_types = set(LEASED_TYPES if leased_types is None else leased_types)
+        self.database = database
+        self._blocks: Dict[tuple, list] = {}
+        self._lock = asyncio.Lock()
+    
+    async def next_value(self, counter: Dict) -> int:
+        """Return the next value of a counter"""
+        if counter.get("type") not in self.leased_types or self.block_size == 1:
+            return await increment_sequence(counter, database=self.database)
+        
+        key = tuple(sorted(counter.items()))
+        async with self._lock:
+            block = self._blocks.get(key)
+            if not block or block[0] > block[1]:
+                # Drop exhausted blocks (e.g. yesterday's tokens) before leasing a new one
+                self._blocks = {k: b for k, b in self._blocks.items() if b[0] <= b[1]}
+                end = await increment_sequence(counter, self.block_size, database=self.database)
+                block = [end - self.block_size + 1, end]
+                self._blocks[key] = block
+            
+            value = block[0]
+            block[0] += 1
+            return value
+
+_allocator: Optional[SequenceAllocator] = None
+
+async def next_sequence(counter: Dict) -> int:
+    """Next value of a counter from this process's shared allocator"""
+    global _allocator
+    if _allocator is None:
+        _allocator = SequenceAllocator()
+    return await _allocator.next_value(counter)
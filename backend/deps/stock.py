@@ -0,0 +1,468 @@
+# deps/stock.py
+"""
+Materialized stock balances for pharmacy routers
+stock_balances holds one document per batch and one per product, kept in step
+with stock_ledger by $inc on every ledger write, so stock checks are a single
+point lookup instead of a scan over the batch's ledger history
+
+Batch balances also carry a `reserved` quantity held by carts being built at
+the billing counters; available stock is qty - reserved
+"""
+
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from pymongo import UpdateOne
+
+from deps.db import db
+from utils.joins import fetch_by_ids
+
+BATCH_SCOPE = "BATCH"
+PRODUCT_SCOPE = "PRODUCT"
+
+# How long a cart may hold stock before the reservation lapses
+RESERVATION_TTL_SECONDS = int(os.getenv("STOCK_RESERVATION_TTL_SECONDS", 600))
+
+
+class InsufficientStockError(Exception):
+    """Raised when a guarded decrement finds less available stock than requested"""
+    
+    def __init__(self, batch_id: str, requested: int):
+        self.batch_id = batch_id
+        self.requested = requested
+        super().__init__(f"Insufficient stock for batch {batch_id}")
+
+
+class InsufficientProductStockError(Exception):
+    """Raised when a product's sellable batches cannot cover a FEFO allocation"""
+    
+    def __init__(self, product_id: str, requested: int, available: int):
+        self.product_id = product_id
+        self.requested = requested
+        self.available = available
+        super().__init__(f"Insufficient stock for product {product_id}")
+
+
+def batch_balance_id(batch_id: str) -> str:
+    """Balance document id for a batch"""
+    return f"{BATCH_SCOPE}:{batch_id}"
+
+
+def product_balance_id(product_id: str) -> str:
+    """Balance document id for a product"""
+    return f"{PRODUCT_SCOPE}:{product_id}"
+
+
+def ledger_delta(entry: Dict) -> int:
+    """Net quantity change of a stock ledger row"""
+    return entry.get("qty_in", 0) - entry.get("qty_out", 0)
+
+
+def build_balance_updates(entries: Iterable[Dict], include_batches: bool = True) -> List[UpdateOne]:
+    """
+    Collapse ledger rows into one $inc per batch and per product
+    Balance documents are upserted so the first movement creates them
+    """
+    batch_deltas: Dict[str, Dict] = {}
+    product_deltas: Dict[str, int] = {}
+
+    for entry in entries:
+        delta = ledger_delta(entry)
+        batch = batch_deltas.setdefault(
+            entry["batch_id"], {"product_id": entry["product_id"], "qty": 0}
+        )
+        batch["qty"] += delta
+        product_deltas[entry["product_id"]] = product_deltas.get(entry["product_id"], 0) + delta
+
+    now = datetime.utcnow()
+    updates = []
+    for batch_id, batch in (batch_deltas.items() if include_batches else ()):
+        updates.append(UpdateOne(
+            {"_id": batch_balance_id(batch_id)},
+            {
+                "$inc": {"qty": batch["qty"]},
+                "$set": {"updated_at": now},
+                "$setOnInsert": {
+                    "scope": BATCH_SCOPE,
+                    "batch_id": batch_id,
+                    "product_id": batch["product_id"]
+                }
+            },
+            upsert=True
+        ))
+    for product_id, qty in product_deltas.items():
+        updates.append(UpdateOne(
+            {"_id": product_balance_id(product_id)},
+            {
+                "$inc": {"qty": qty},
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"scope": PRODUCT_SCOPE, "product_id": product_id}
+            },
+            upsert=True
+        ))
+    return updates
+
+
+async def post_ledger_entries(entries: List[Dict], session=None):
+    """Insert stock ledger rows and apply their quantities to stock_balances"""
+    if not entries:
+        return
+    await db.stock_ledger.insert_many(entries, session=session)
+    await db.stock_balances.bulk_write(build_balance_updates(entries), ordered=False, session=session)
+
+
+def available_at_least(qty: int, held: int = 0) -> Dict:
+    """Balance filter matching only when unreserved stock (plus stock held by the caller) covers qty"""
+    return {"$expr": {"$gte": [
+        {"$add": [{"$subtract": ["$qty", {"$ifNull": ["$reserved", 0]}]}, held]},
+        qty
+    ]}}
+
+
+async def post_outgoing_ledger_entries(entries: List[Dict], held: Optional[Dict[str, int]] = None,
+                                       session=None):
+    """
+    Post outgoing ledger rows with one guarded decrement per batch
+    A batch is only decremented while its available stock - plus whatever this
+    caller already holds in reservations (`held`) - covers the request, so
+    concurrent counters cannot drive stock negative. Held quantities are
+    released from `reserved` as they are consumed.
+    """
+    held = dict(held or {})
+    outgoing: Dict[str, int] = {}
+    for entry in entries:
+        outgoing[entry["batch_id"]] = outgoing.get(entry["batch_id"], 0) - ledger_delta(entry)
+    
+    taken = []
+    try:
+        for batch_id, qty in outgoing.items():
+            batch_held = held.pop(batch_id, 0)
+            result = await db.stock_balances.update_one(
+                {"_id": batch_balance_id(batch_id), **available_at_least(qty, batch_held)},
+                {"$inc": {"qty": -qty, "reserved": -batch_held}, "$set": {"updated_at": datetime.utcnow()}},
+                session=session
+            )
+            if result.modified_count != 1:
+                raise InsufficientStockError(batch_id, qty)
+            taken.append((batch_id, qty, batch_held))
+        
+        await db.stock_ledger.insert_many(entries, session=session)
+    except Exception:
+        # Without a transaction nothing rolls back for us
+        if session is None:
+            for batch_id, qty, batch_held in taken:
+                await db.stock_balances.update_one(
+                    {"_id": batch_balance_id(batch_id)},
+                    {"$inc": {"qty": qty, "reserved": batch_held}}
+                )
+        raise
+    
+    await db.stock_balances.bulk_write(
+        build_balance_updates(entries, include_batches=False), ordered=False, session=session
+    )
+    
+    # Held stock on batches that did not make it onto the bill goes back on the shelf
+    for batch_id, batch_held in held.items():
+        await db.stock_balances.update_one(
+            {"_id": batch_balance_id(batch_id)}, {"$inc": {"reserved": -batch_held}}, session=session
+        )
+
+
+async def reserve_stock(cart_id: str, batch_id: str, qty: int, user_id: str,
+                        ttl_seconds: int = RESERVATION_TTL_SECONDS) -> Dict:
+    """Hold qty of a batch for a cart until the sale is billed or the reservation lapses"""
+    await release_expired_reservations()
+    
+    result = await db.stock_balances.update_one(
+        {"_id": batch_balance_id(batch_id), **available_at_least(qty)},
+        {"$inc": {"reserved": qty}, "$set": {"updated_at": datetime.utcnow()}}
+    )
+    if result.modified_count != 1:
+        raise InsufficientStockError(batch_id, qty)
+    
+    now = datetime.utcnow()
+    reservation_id = str(uuid.uuid4())
+    reservation = {
+        "_id": reservation_id,
+        "id": reservation_id,
+        "cart_id": cart_id,
+        "batch_id": batch_id,
+        "qty": qty,
+        "created_by": user_id,
+        "created_at": now,
+        "expires_at": now + timedelta(seconds=ttl_seconds)
+    }
+    try:
+        await db.stock_reservations.insert_one(reservation)
+    except Exception:
+        await _release_reserved(batch_id, qty)
+        raise
+    return reservation
+
+
+async def _release_reserved(batch_id: str, qty: int):
+    await db.stock_balances.update_one(
+        {"_id": batch_balance_id(batch_id)}, {"$inc": {"reserved": -qty}}
+    )
+
+
+async def _release_matching(query: Dict) -> int:
+    """Delete reservations one at a time so each is released exactly once"""
+    released = 0
+    while True:
+        reservation = await db.stock_reservations.find_one_and_delete(query)
+        if not reservation:
+            return released
+        await _release_reserved(reservation["batch_id"], reservation["qty"])
+        released += 1
+
+
+async def release_reservation(reservation_id: str) -> bool:
+    """Release a single reservation; False if it was already billed or released"""
+    return await _release_matching({"_id": reservation_id}) > 0
+
+
+async def release_cart(cart_id: str) -> int:
+    """Release every reservation held by a cart"""
+    return await _release_matching({"cart_id": cart_id})
+
+
+async def release_expired_reservations() -> int:
+    """Return stock held by lapsed reservations to the shelf"""
+    return await _release_matching({"expires_at": {"$lte": datetime.utcnow()}})
+
+
+async def claim_cart_reservations(cart_id: str, session=None) -> List[Dict]:
+    """Remove a cart's live reservations so their quantities can be billed"""
+    claimed = []
+    while True:
+        reservation = await db.stock_reservations.find_one_and_delete(
+            {"cart_id": cart_id, "expires_at": {"$gt": datetime.utcnow()}}, session=session
+        )
+        if not reservation:
+            return claimed
+        claimed.append(reservation)
+
+
+def held_quantities(reservations: Iterable[Dict]) -> Dict[str, int]:
+    """Total reserved quantity per batch"""
+    held: Dict[str, int] = {}
+    for reservation in reservations:
+        held[reservation["batch_id"]] = held.get(reservation["batch_id"], 0) + reservation["qty"]
+    return held
+
+
+async def get_batch_stock(batch_id: str, session=None) -> int:
+    """Current stock of a single batch"""
+    balance = await db.stock_balances.find_one(
+        {"_id": batch_balance_id(batch_id)}, {"qty": 1}, session=session
+    )
+    return balance["qty"] if balance else 0
+
+
+async def get_product_stock(product_id: str, session=None) -> int:
+    """Current stock of a single product across all its batches"""
+    balance = await db.stock_balances.find_one(
+        {"_id": product_balance_id(product_id)}, {"qty": 1}, session=session
+    )
+    return balance["qty"] if balance else 0
+
+
+async def get_available_stocks(batch_ids: Iterable[str], session=None) -> Dict[str, int]:
+    """Unreserved stock for many batches with one $in lookup"""
+    batch_ids = list(batch_ids)
+    stocks = {batch_id: 0 for batch_id in batch_ids}
+    cursor = db.stock_balances.find(
+        {"_id": {"$in": [batch_balance_id(b) for b in batch_ids]}},
+        {"batch_id": 1, "qty": 1, "reserved": 1},
+        session=session
+    )
+    async for balance in cursor:
+        stocks[balance["batch_id"]] = balance["qty"] - balance.get("reserved", 0)
+    return stocks
+
+
+async def get_batch_stocks(batch_ids: Iterable[str], session=None) -> Dict[str, int]:
+    """Current stock for many batches with one $in lookup; missing batches are 0"""
+    batch_ids = list(batch_ids)
+    stocks = {batch_id: 0 for batch_id in batch_ids}
+    cursor = db.stock_balances.find(
+        {"_id": {"$in": [batch_balance_id(b) for b in batch_ids]}},
+        {"batch_id": 1, "qty": 1},
+        session=session
+    )
+    async for balance in cursor:
+        stocks[balance["batch_id"]] = balance["qty"]
+    return stocks
+
+
+async def get_product_stocks(product_ids: Iterable[str], session=None) -> Dict[str, int]:
+    """Current stock for many products with one $in lookup; missing products are 0"""
+    product_ids = list(product_ids)
+    stocks = {product_id: 0 for product_id in product_ids}
+    cursor = db.stock_balances.find(
+        {"_id": {"$in": [product_balance_id(p) for p in product_ids]}},
+        {"product_id": 1, "qty": 1},
+        session=session
+    )
+    async for balance in cursor:
+        stocks[balance["product_id"]] = balance["qty"]
+    return stocks
+
+
+async def allocate_fefo(demands: Sequence[Tuple[str, int]], session=None) -> List[List[Tuple[str, int]]]:
+    """
+    Pick batches first-expiry-first-out for (product_id, qty) demands
+    Candidates are the products' batch balances with unreserved stock, read
+    with one $in query and ordered by batch expiry; unapproved and expired
+    batches are skipped. Demands for the same product draw on one pool in
+    order. Returns a [(batch_id, qty), ...] split per demand.
+    
+    This only plans the split - stock is taken by the guarded decrement when
+    the sale commits, so callers re-allocate on InsufficientStockError.
+    """
+    product_ids = list({product_id for product_id, _ in demands})
+    available: Dict[str, int] = {}
+    batch_products: Dict[str, str] = {}
+    cursor = db.stock_balances.find(
+        {"scope": BATCH_SCOPE, "product_id": {"$in": product_ids}, "qty": {"$gt": 0}},
+        {"batch_id": 1, "product_id": 1, "qty": 1, "reserved": 1},
+        session=session
+    )
+    async for balance in cursor:
+        free = balance["qty"] - balance.get("reserved", 0)
+        if free > 0:
+            available[balance["batch_id"]] = free
+            batch_products[balance["batch_id"]] = balance["product_id"]
+    
+    batches = await fetch_by_ids(
+        db.batches, list(available), projection={"expiry": 1, "status": 1}, session=session
+    )
+    
+    # Expiry is YYYY-MM; a batch is sellable through its expiry month
+    current_month = datetime.utcnow().strftime("%Y-%m")
+    pools: Dict[str, List[str]] = {}
+    for batch_id, batch in batches.items():
+        if batch.get("status") == "APPROVED" and batch.get("expiry", "") >= current_month:
+            pools.setdefault(batch_products[batch_id], []).append(batch_id)
+    for pool in pools.values():
+        pool.sort(key=lambda batch_id: (batches[batch_id]["expiry"], batch_id))
+    
+    allocations = []
+    for product_id, qty in demands:
+        pool = pools.get(product_id, [])
+        split = []
+        remaining = qty
+        while remaining > 0 and pool:
+            batch_id = pool[0]
+            take = min(remaining, available[batch_id])
+            split.append((batch_id, take))
+            remaining -= take
+            available[batch_id] -= take
+            if available[batch_id] == 0:
+                pool.pop(0)
+        if remaining > 0:
+            raise InsufficientProductStockError(product_id, qty, qty - remaining)
+        allocations.append(split)
+    return allocations
+
+
+async def compute_ledger_balances() -> Dict[str, Dict]:
+    """Recompute every balance document from stock_ledger with one grouped aggregation"""
+    pipeline = [
+        {
+            "$group": {
+                "_id": "$batch_id",
+                "product_id": {"$first": "$product_id"},
+                "qty": {"$sum": {"$subtract": [
+                    {"$ifNull": ["$qty_in", 0]},
+                    {"$ifNull": ["$qty_out", 0]}
+                ]}}
+            }
+        }
+    ]
+
+    balances: Dict[str, Dict] = {}
+    async for row in db.stock_ledger.aggregate(pipeline, allowDiskUse=True):
+        batch_id, product_id = row["_id"], row["product_id"]
+        balances[batch_balance_id(batch_id)] = {
+            "scope": BATCH_SCOPE, "batch_id": batch_id, "product_id": product_id, "qty": row["qty"]
+        }
+        product = balances.setdefault(product_balance_id(product_id), {
+            "scope": PRODUCT_SCOPE, "product_id": product_id, "qty": 0
+        })
+        product["qty"] += row["qty"]
+    return balances
+
+
+async def verify_stock_balances() -> List[Dict]:
+    """Compare stock_balances with stock_ledger and return every mismatch"""
+    expected = await compute_ledger_balances()
+    drift = []
+
+    async for balance in db.stock_balances.find({}, {"qty": 1}):
+        wanted = expected.pop(balance["_id"], None)
+        wanted_qty = wanted["qty"] if wanted else 0
+        if balance["qty"] != wanted_qty:
+            drift.append({"_id": balance["_id"], "stored": balance["qty"], "ledger": wanted_qty})
+
+    for balance_id, wanted in expected.items():
+        if wanted["qty"] != 0:
+            drift.append({"_id": balance_id, "stored": None, "ledger": wanted["qty"]})
+
+    return drift
+
+
+async def rebuild_stock_balances(chunk_size: int = 1000, prune: bool = True) -> int:
+    """
+    Rewrite stock_balances from stock_ledger; returns the number of balance documents
+    Run while billing is idle - movements posted mid-rebuild can be overwritten
+    prune=False keeps balances the rebuild did not touch (nothing to prune on first build)
+    """
+    now = datetime.utcnow()
+    balances = await compute_ledger_balances()
+
+    # Reserved quantities are owned by stock_reservations, not the ledger
+    reserved = {}
+    async for row in db.stock_reservations.aggregate([
+        {"$group": {"_id": "$batch_id", "qty": {"$sum": "$qty"}}}
+    ]):
+        reserved[batch_balance_id(row["_id"])] = row["qty"]
+    for balance_id, balance in balances.items():
+        if balance["scope"] == BATCH_SCOPE:
+            balance["reserved"] = reserved.get(balance_id, 0)
+
+    updates = [
+        UpdateOne({"_id": balance_id}, {"$set": {**balance, "updated_at": now}}, upsert=True)
+        for balance_id, balance in balances.items()
+    ]
+    for start in range(0, len(updates), chunk_size):
+        await db.stock_balances.bulk_write(updates[start:start + chunk_size], ordered=False)
+
+    # Balances not touched by this rebuild have no ledger rows left behind them
+    if prune:
+        await db.stock_balances.delete_many({"updated_at": {"$lt": now}})
+    return len(balances)
+
+async def ensure_stock_balances() -> int:
+    """
+    Build stock_balances on startup when a database has ledger rows but no
+    balances yet (upgrading from ledger-only stock); guarded sales see zero
+    stock until then. Returns the number of balances built (0 when none were needed)
+    """
+    if await db.stock_balances.find_one({}, {"_id": 1}):
+        return 0
+    if not await db.stock_ledger.find_one({}, {"_id": 1}):
+        return 0
+
+    logging.warning(
+        "stock_balances is empty but stock_ledger has movements; rebuilding balances "
+        "from the ledger before serving (python rebuild_stock_balances.py does the same offline)"
+    )
+    # Several workers may start together; without pruning their rebuilds cannot remove each other's writes
+    count = await rebuild_stock_balances(prune=False)
+    logging.warning(f"Rebuilt {count} stock balance documents from stock_ledger")
+    return count
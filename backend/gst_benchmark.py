@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the invoice-level GST engine
+Compares per-line float calculation (calc_sale_mrp_inclusive and friends)
+with calc_sale_invoice / calc_purchase_invoice on large synthetic invoices.
+Usage: python gst_benchmark.py [--lines N] [--repeat N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+# Add backend directory to path
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, backend_dir)
+
+from utils.gst import (
+    calc_purchase_invoice, calc_purchase_line, calc_sale_invoice,
+    calc_sale_mrp_inclusive, calc_sale_rate_exclusive
+)
+
+GST_RATES = [0, 5, 12, 18, 28]
+
+def sale_lines(count: int) -> list:
+    random.seed(42)
+    return [
+        {
+            "qty": random.randint(1, 30),
+            "pricing_mode": random.choice(["MRP_INC", "MRP_INC", "RATE_EX"]),
+            "mrp": round(random.uniform(5, 900), 2),
+            "mrp_discount_pct": random.choice([0, 5, 7.5, 10]),
+            "rate_ex_tax": round(random.uniform(4, 800), 2),
+            "gst_rate": random.choice(GST_RATES)
+        }
+        for _ in range(count)
+    ]
+
+def purchase_lines(count: int) -> list:
+    random.seed(7)
+    return [
+        {
+            "billed_qty": random.randint(1, 500),
+            "free_qty": random.randint(0, 20),
+            "trade_price_ex": round(random.uniform(2, 700), 2),
+            "gst_rate": random.choice(GST_RATES),
+            "scheme_pct": random.choice([0, 2.5, 5]),
+            "cash_pct": random.choice([0, 1, 2])
+        }
+        for _ in range(count)
+    ]
+
+def per_line_sale(lines: list):
+    net = 0.0
+    for line in lines:
+        if line["pricing_mode"] == "MRP_INC":
+            calc = calc_sale_mrp_inclusive(True, line["qty"], line["mrp"], line["mrp_discount_pct"], line["gst_rate"])
+        else:
+            calc = calc_sale_rate_exclusive(True, line["qty"], line["rate_ex_tax"], line["gst_rate"])
+        net += calc["net"]
+    return round(net, 2)
+
+def per_line_purchase(lines: list):
+    net = 0.0
+    for line in lines:
+        net += calc_purchase_line(
+            True, line["billed_qty"], line["free_qty"], line["trade_price_ex"],
+            line["gst_rate"], line["scheme_pct"], line["cash_pct"]
+        )["row_net"]
+    return round(net, 2)
+
+def report(label: str, func, repeat: int, line_count: int):
+    seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+    print(f"{label:<34} {seconds * 1000:8.1f} ms  ({seconds / line_count * 1e6:.2f} µs/line)")
+
+def main(line_count: int, repeat: int):
+    sales = sale_lines(line_count)
+    purchases = purchase_lines(line_count)
+    
+    print(f"{line_count} line invoices, best of {repeat}")
+    report("sale: per-line float", lambda: per_line_sale(sales), repeat, line_count)
+    report("sale: invoice engine (paise)", lambda: calc_sale_invoice(True, sales), repeat, line_count)
+    report("purchase: per-line float", lambda: per_line_purchase(purchases), repeat, line_count)
+    report("purchase: invoice engine (paise)", lambda: calc_purchase_invoice(True, purchases), repeat, line_count)
+    
+    # Float accumulation vs exact paise totals
+    float_net = per_line_sale(sales)
+    paise_net = calc_sale_invoice(True, sales)["totals"]["net"]
+    print(f"sale net: float {float_net:.2f} vs paise {paise_net / 100:.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.lines, args.repeat)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Index registry test
+Checks that every indexed field is one the code writes to that collection,
+applies INDEX_REGISTRY to a scratch database and checks that the live
+indexes match it exactly (nothing missing, extra or with other options),
+then checks the configured database without changing it.
+Usage: python index_registry_test.py [--skip-live]
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import sys
+import uuid
+from pathlib import Path
+from motor.motor_asyncio import AsyncIOMotorClient
+
+# Add backend directory to path
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, backend_dir)
+
+from deps.indexes import check_index_drift, ensure_indexes, registry_key_specs
+
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/unicare_ehr")
+
+# Files that define indexes rather than read or write the collections
+INDEX_SOURCES = {"deps/indexes.py", "db_init.py", "index_registry_test.py"}
+
+def test_indexed_fields_are_written() -> bool:
+    """
+    Every indexed field appears as a document key ("field" or field: / field=)
+    in the modules that use its collection; an index on a field nothing writes
+    indexes every document as null, and a unique one rejects the second insert
+    """
+    sources = {
+        path.relative_to(backend_dir).as_posix(): path.read_text(encoding="utf-8")
+        for path in Path(backend_dir).rglob("*.py")
+    }
+    ok = True
+    for collection, specs in registry_key_specs().items():
+        users = [
+            text for path, text in sources.items()
+            if path not in INDEX_SOURCES and re.search(rf"\.{collection}\b|[\"']{collection}[\"']", text)
+        ]
+        if not users:
+            print(f"ℹ️ {collection}: not used by the backend; indexes kept for db_init")
+            continue
+        code = "\n".join(users)
+        for key in specs:
+            for field, _ in key:
+                name = re.escape(field.split(".")[0])
+                if not re.search(rf"[\"']{name}[\"']|\b{name}\s*[:=]", code):
+                    print(f"❌ {collection}: index on {field}, which the code never writes")
+                    ok = False
+    if ok:
+        print("✅ Every indexed field is written by the code using its collection")
+    return ok
+
+def print_drift(drift: dict):
+    for collection, report in sorted(drift.items()):
+        for kind, keys in report.items():
+            for key in keys:
+                print(f"   {collection}: {kind} {key}")
+
+async def test_scratch_database(client) -> bool:
+    """A fresh database ends up with exactly the registry's indexes"""
+    name = f"index_registry_test_{uuid.uuid4().hex[:8]}"
+    database = client[name]
+    try:
+        await ensure_indexes(database)
+        # A second run must be a no-op that leaves no drift
+        drift = await ensure_indexes(database)
+        expected = sum(len(specs) for specs in registry_key_specs().values())
+        if drift:
+            print("❌ Scratch database drifted from the registry:")
+            print_drift(drift)
+            return False
+        print(f"✅ Scratch database has all {expected} registry indexes and no others")
+        return True
+    finally:
+        await client.drop_database(name)
+
+async def test_live_database(client) -> bool:
+    """The configured database carries no index the registry does not declare"""
+    drift = await check_index_drift(client.get_default_database())
+    if drift:
+        print("❌ Live database differs from the registry:")
+        print_drift(drift)
+        return False
+    print("✅ Live database matches the registry")
+    return True
+
+async def main(args) -> int:
+    client = AsyncIOMotorClient(MONGO_URL)
+    try:
+        ok = test_indexed_fields_are_written()
+        ok &= await test_scratch_database(client)
+        if not args.skip_live:
+            ok &= await test_live_database(client)
+        return 0 if ok else 1
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--skip-live", action="store_true", help="only test against a scratch database")
+    sys.exit(asyncio.run(main(parser.parse_args())))
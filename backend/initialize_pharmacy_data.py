@@ -16,6 +16,8 @@ backend_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, backend_dir)
 
 from utils.gst import calc_purchase_line
+from deps.db import set_database
+from deps.stock import rebuild_stock_balances
 
 # Database setup
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/unicare_ehr")
@@ -347,6 +349,10 @@ async def main():
     await create_products()
     purchase = await create_sample_purchase()
     
+    # Sample ledger rows are written directly, so bring balances in step
+    set_database(db)
+    await rebuild_stock_balances()
+    
     print("\n📊 Summary:")
     print(f"   - 2 Suppliers (Kerala + Mumbai for GST testing)")
     print(f"   - 3 Racks (A1, A2, B1)")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Backfill or verify sale_items.returned_qty from the returns collection
+Sale items written before returned_qty was maintained start at 0; run this
+once after upgrading so returnable quantities account for earlier returns
+Usage: python rebuild_returned_quantities.py [--verify]
+"""
+
+import asyncio
+import os
+import sys
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+# Add backend directory to path
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, backend_dir)
+
+from deps.db import db, set_database
+
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/unicare_ehr")
+
+async def returned_quantities() -> dict:
+    """{sale_item_id: quantity returned} summed over every return"""
+    totals = {}
+    async for row in db.returns.aggregate([
+        {"$unwind": "$items"},
+        {"$group": {"_id": "$items.sale_item_id", "qty": {"$sum": "$items.qty_returned"}}}
+    ]):
+        totals[row["_id"]] = row["qty"]
+    return totals
+
+async def find_drift(totals: dict) -> list:
+    drift = []
+    cursor = db.sale_items.find(
+        {"$or": [{"_id": {"$in": list(totals)}}, {"returned_qty": {"$gt": 0}}]},
+        {"returned_qty": 1}
+    )
+    async for item in cursor:
+        expected = totals.get(item["_id"], 0)
+        if item.get("returned_qty", 0) != expected:
+            drift.append((item["_id"], item.get("returned_qty", 0), expected))
+    return drift
+
+async def main(verify_only: bool) -> int:
+    client = AsyncIOMotorClient(MONGO_URL)
+    set_database(client.get_default_database())
+    
+    try:
+        drift = await find_drift(await returned_quantities())
+        if verify_only:
+            if not drift:
+                print("✅ sale_items.returned_qty matches returns")
+                return 0
+            
+            print(f"❌ {len(drift)} sale item(s) out of step with returns:")
+            for sale_item_id, stored, expected in drift:
+                print(f"   - {sale_item_id}: stored={stored} returns={expected}")
+            return 1
+        
+        updates = [
+            UpdateOne({"_id": sale_item_id}, {"$set": {"returned_qty": expected}})
+            for sale_item_id, _, expected in drift
+        ]
+        for start in range(0, len(updates), 1000):
+            await db.sale_items.bulk_write(updates[start:start + 1000], ordered=False)
+        print(f"✅ Updated returned_qty on {len(updates)} sale item(s)")
+        return 0
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main("--verify" in sys.argv[1:])))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Backfill or repair the sales_daily rollup from sales, payments and returns
+Usage: python rebuild_sales_daily.py [--from YYYY-MM-DD] [--to YYYY-MM-DD]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from motor.motor_asyncio import AsyncIOMotorClient
+
+# Add backend directory to path
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, backend_dir)
+
+from deps.db import set_database
+from deps.rollups import rebuild_sales_daily
+
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/unicare_ehr")
+
+async def main(start_day: str, end_day: str) -> int:
+    client = AsyncIOMotorClient(MONGO_URL)
+    set_database(client.get_default_database())
+    
+    try:
+        count = await rebuild_sales_daily(start_day, end_day)
+        span = f"{start_day or 'first sale'} to {end_day or 'today'}"
+        print(f"✅ Rebuilt {count} sales_daily documents ({span})")
+        return 0
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the sales_daily rollup")
+    parser.add_argument("--from", dest="start_day", help="first local day (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="end_day", help="last local day (YYYY-MM-DD)")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.start_day, args.end_day)))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Rebuild or verify the stock_balances collection from stock_ledger
+Usage: python rebuild_stock_balances.py [--verify]
+"""
+
+import asyncio
+import os
+import sys
+from motor.motor_asyncio import AsyncIOMotorClient
+
+# Add backend directory to path
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, backend_dir)
+
+from deps.db import set_database
+from deps.stock import rebuild_stock_balances, verify_stock_balances
+
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/unicare_ehr")
+
+async def main(verify_only: bool) -> int:
+    client = AsyncIOMotorClient(MONGO_URL)
+    set_database(client.get_default_database())
+    
+    try:
+        if verify_only:
+            drift = await verify_stock_balances()
+            if not drift:
+                print("✅ stock_balances matches stock_ledger")
+                return 0
+            
+            print(f"❌ {len(drift)} balance(s) out of step with stock_ledger:")
+            for row in drift:
+                print(f"   - {row['_id']}: stored={row['stored']} ledger={row['ledger']}")
+            return 1
+        
+        count = await rebuild_stock_balances()
+        print(f"✅ Rebuilt {count} stock balance documents from stock_ledger")
+        return 0
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main("--verify" in sys.argv[1:])))
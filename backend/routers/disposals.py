@@ -1,25 +1,23 @@
 # routers/disposals.py
-from fastapi import APIRouter, HTTPException, Depends, status
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Depends, Body, Response, status
+from typing import Dict, List, Optional
 from datetime import datetime
 import uuid
 import logging
 
+from deps.auth import get_current_user
 from deps.db import db
+from deps.stock import (
+    InsufficientStockError, build_balance_updates, post_outgoing_ledger_entries, get_batch_stock
+)
+from utils.joins import fetch_by_ids
+from utils.pagination import NEXT_CURSOR_HEADER, InvalidCursorError, ascending_page_stages, split_page
 from models import Disposal, DisposalCreate
-from utils.gst import calc_itc_reversal
+from utils.money import (
+    div_round, money_fields, paise_expression, stored_paise_expression, to_paise, to_rupees
+)
 
 router = APIRouter(prefix="/api/pharmacy/disposals", tags=["disposals"])
-security = HTTPBearer()
-
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get current user from JWT token"""
-    return {
-        "user_id": "current_user_id",
-        "username": "current_user",
-        "role": "pharmacist"
-    }
 
 def check_pharmacy_access(user_role: str):
     """Check pharmacy access"""
@@ -51,16 +49,21 @@ async def get_disposals(
         if reason:
             query["reason"] = reason
         
-        disposals_cursor = db.disposals.find(query).sort("created_at", -1)
-        disposals = []
+        disposals = await db.disposals.find(query).sort("created_at", -1).to_list(length=None)
+        
+        # Get batch and product details with one query per collection
+        batches = await fetch_by_ids(db.batches, [disposal["batch_id"] for disposal in disposals])
+        products = await fetch_by_ids(
+            db.products, [batch["product_id"] for batch in batches.values()],
+            {"brand_name": 1, "strength": 1, "form": 1, "chemical_name": 1}
+        )
         
-        async for disposal in disposals_cursor:
+        for disposal in disposals:
             disposal["id"] = str(disposal["_id"])
             
-            # Get batch and product details
-            batch = await db.batches.find_one({"_id": disposal["batch_id"]})
+            batch = batches.get(disposal["batch_id"])
             if batch:
-                product = await db.products.find_one({"_id": batch["product_id"]})
+                product = products.get(batch["product_id"])
                 if product:
                     disposal["product_name"] = f"{product['brand_name']} {product['strength']} {product['form']}"
                     disposal["chemical_name"] = product["chemical_name"]
@@ -70,8 +73,6 @@ async def get_disposals(
                     disposal["cost_per_unit"] = batch["effective_cost_per_unit"]
                     disposal["total_cost_value"] = round(disposal["qty"] * batch["effective_cost_per_unit"], 2)
                     disposal["total_mrp_value"] = round(disposal["qty"] * batch["mrp"], 2)
-            
-            disposals.append(disposal)
         
         return disposals
         
@@ -79,6 +80,109 @@ async def get_disposals(
         logging.error(f"Error fetching disposals: {e}")
         raise HTTPException(status_code=500, detail="Error fetching disposals")
 
+def purchase_line_expression() -> Dict:
+    """The purchase item that created the batch, from the purchases joined on batch_ids"""
+    return {"$let": {
+        "vars": {"items": {"$reduce": {
+            "input": "$purchases.items",
+            "initialValue": [],
+            "in": {"$concatArrays": ["$$value", "$$this"]}
+        }}},
+        "in": {"$arrayElemAt": [{"$filter": {
+            "input": "$$items",
+            "as": "item",
+            "cond": {"$eq": ["$$item.batch_id", "$_id"]}
+        }}, 0]}
+    }}
+
+def tax_paise_expression(prefix: str) -> Dict:
+    return {"$add": [stored_paise_expression(f"{prefix}.{head}") for head in ("cgst", "sgst", "igst")]}
+
+async def load_disposal_batches(match: Dict) -> List[Dict]:
+    """
+    Batches with their unreserved stock and the input tax to reverse, in one
+    aggregation: each batch joins its balance document and the purchase that
+    brought it in; ITC is taken from the batch's own purchase line (or the
+    invoice totals on purchases without one)
+    """
+    pipeline = [
+        {"$match": match},
+        {"$lookup": {
+            "from": "stock_balances",
+            "localField": "_id",
+            "foreignField": "batch_id",
+            "as": "balance"
+        }},
+        {"$lookup": {
+            "from": "purchases",
+            "localField": "_id",
+            "foreignField": "batch_ids",
+            "as": "purchases"
+        }},
+        {"$addFields": {
+            "purchase_line": purchase_line_expression(),
+            "purchase_totals": {"$arrayElemAt": ["$purchases.totals", 0]}
+        }},
+        {"$project": {
+            "product_id": 1,
+            "batch_no": 1,
+            "expiry": 1,
+            "mrp": 1,
+            "effective_cost_per_unit": 1,
+            "received_qty": 1,
+            "free_qty": 1,
+            "current_stock": {"$ifNull": [{"$arrayElemAt": [
+                {"$map": {
+                    "input": "$balance",
+                    "as": "b",
+                    "in": {"$subtract": ["$$b.qty", {"$ifNull": ["$$b.reserved", 0]}]}
+                }}, 0
+            ]}, 0]},
+            "purchase_tax_paise": {"$cond": [
+                {"$ifNull": ["$purchase_line", False]},
+                tax_paise_expression("$purchase_line"),
+                tax_paise_expression("$purchase_totals")
+            ]}
+        }}
+    ]
+    return await db.batches.aggregate(pipeline).to_list(length=None)
+
+async def load_disposable_batches(batch_ids: List[str]) -> List[Dict]:
+    """Expired approved batches among batch_ids (see load_disposal_batches)"""
+    current_month = datetime.utcnow().strftime("%Y-%m")
+    return await load_disposal_batches(
+        {"_id": {"$in": batch_ids}, "expiry": {"$lt": current_month}, "status": "APPROVED"}
+    )
+
+def itc_reversal_for(batch: Dict, qty: int) -> int:
+    """Proportional ITC reversal (paise) for disposing qty units of a batch from load_disposal_batches"""
+    total_received = batch["received_qty"] + batch.get("free_qty", 0)
+    if total_received <= 0:
+        return 0
+    return div_round(batch["purchase_tax_paise"] * qty, total_received)
+
+async def commit_disposals(disposal_docs: List[Dict], stock_entries: List[Dict], audit_entries: List[Dict]):
+    """Guarded stock decrements, ledger rows, disposals and audits together
+    
+    Raises InsufficientStockError (nothing written) when a batch no longer
+    has the stock to dispose.
+    """
+    async def commit(session):
+        await post_outgoing_ledger_entries(stock_entries, session=session)
+        try:
+            await db.disposals.insert_many(disposal_docs, session=session)
+        except Exception:
+            if session is None:
+                # No transaction to roll back; take the ledger rows out and put the stock back
+                await db.stock_ledger.delete_many({"id": {"$in": [entry["id"] for entry in stock_entries]}})
+                await db.stock_balances.bulk_write(build_balance_updates([
+                    dict(entry, qty_in=entry["qty_out"], qty_out=0) for entry in stock_entries
+                ]), ordered=False)
+            raise
+        await db.audits.insert_many(audit_entries, session=session)
+    
+    await db.run_in_transaction(commit)
+
 @router.post("", response_model=dict, status_code=201)
 async def create_disposal(disposal: DisposalCreate, current_user: dict = Depends(get_current_user)):
     """Create disposal record (requires approval)"""
@@ -87,57 +191,30 @@ async def create_disposal(disposal: DisposalCreate, current_user: dict = Depends
     
     try:
         # Validate batch exists and get details
-        batch = await db.batches.find_one({"_id": disposal.batch_id})
-        if not batch:
+        batches = await load_disposal_batches({"_id": disposal.batch_id})
+        if not batches:
             raise HTTPException(status_code=404, detail="Batch not found")
+        batch = batches[0]
         
-        # Check current stock for the batch
-        stock_cursor = db.stock_ledger.find({"batch_id": disposal.batch_id})
-        current_stock = 0
-        async for stock_entry in stock_cursor:
-            current_stock += stock_entry.get("qty_in", 0) - stock_entry.get("qty_out", 0)
-        
-        if current_stock < disposal.qty:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Insufficient stock for disposal. Available: {current_stock}, Requested: {disposal.qty}"
-            )
-        
-        # Get product details for reference
-        product = await db.products.find_one({"_id": batch["product_id"]})
-        
-        # Calculate ITC reversal (for tax compliance)
-        # This is a simplified calculation - in practice, you'd need the original purchase tax details
-        original_purchase = await db.purchases.find_one({"batch_ids": disposal.batch_id})
-        itc_reversal = 0.0
-        
-        if original_purchase:
-            # Calculate proportional ITC reversal
-            total_received = batch["received_qty"] + batch.get("free_qty", 0)
-            if total_received > 0:
-                # Simplified - assume equal GST distribution
-                purchase_tax_per_unit = (
-                    original_purchase["totals"]["cgst"] + 
-                    original_purchase["totals"]["sgst"] + 
-                    original_purchase["totals"]["igst"]
-                ) / total_received
-                itc_reversal = round(purchase_tax_per_unit * disposal.qty, 2)
+        # ITC reversal on the batch's own purchase line (for tax compliance)
+        itc_reversal_paise = itc_reversal_for(batch, disposal.qty)
+        itc_reversal = to_rupees(itc_reversal_paise)
         
         # Create disposal record
+        disposal_id = str(uuid.uuid4())
         disposal_doc = {
-            "id": str(uuid.uuid4()),
+            "_id": disposal_id,
+            "id": disposal_id,
             "batch_id": disposal.batch_id,
             "qty": disposal.qty,
             "reason": disposal.reason,
             "remark": disposal.remark,
             "itc_reversal_tax": itc_reversal,
+            "itc_reversal_tax_paise": itc_reversal_paise,
             "approved_by": current_user["user_id"],
             "created_at": datetime.utcnow()
         }
         
-        result = await db.disposals.insert_one(disposal_doc)
-        disposal_id = str(result.inserted_id)
-        
         # Create stock ledger entry (remove from inventory)
         stock_entry = {
             "id": str(uuid.uuid4()),
@@ -152,11 +229,10 @@ async def create_disposal(disposal: DisposalCreate, current_user: dict = Depends
             "ref_id": disposal_id,
             "created_at": datetime.utcnow()
         }
-        await db.stock_ledger.insert_one(stock_entry)
         
         # Calculate disposal costs
-        cost_value = disposal.qty * batch["effective_cost_per_unit"]
-        mrp_value = disposal.qty * batch["mrp"]
+        cost_value = to_rupees(to_paise(disposal.qty * batch["effective_cost_per_unit"]))
+        mrp_value = to_rupees(to_paise(disposal.qty * batch["mrp"]))
         
         # Create audit entry
         audit_entry = {
@@ -169,17 +245,25 @@ async def create_disposal(disposal: DisposalCreate, current_user: dict = Depends
                 "batch_id": disposal.batch_id,
                 "qty": disposal.qty,
                 "reason": disposal.reason,
-                "cost_value": round(cost_value, 2),
+                "cost_value": cost_value,
                 "itc_reversal": itc_reversal
             },
             "created_at": datetime.utcnow()
         }
-        await db.audits.insert_one(audit_entry)
+        
+        try:
+            await commit_disposals([disposal_doc], [stock_entry], [audit_entry])
+        except InsufficientStockError as e:
+            current_stock = await get_batch_stock(e.batch_id)
+            raise HTTPException(
+                status_code=400,
+                detail=f"Insufficient stock for disposal. Available: {current_stock}, Requested: {e.requested}"
+            )
         
         return {
             "id": disposal_id,
-            "cost_value": round(cost_value, 2),
-            "mrp_value": round(mrp_value, 2),
+            "cost_value": cost_value,
+            "mrp_value": mrp_value,
             "itc_reversal_tax": itc_reversal,
             "message": "Disposal created successfully"
         }
@@ -190,6 +274,137 @@ async def create_disposal(disposal: DisposalCreate, current_user: dict = Depends
         logging.error(f"Error creating disposal: {e}")
         raise HTTPException(status_code=500, detail="Error creating disposal")
 
+# Most batches one bulk disposal request may carry
+MAX_BULK_DISPOSALS = 500
+
+@router.post("/bulk", response_model=dict, status_code=201)
+async def create_bulk_disposal(
+    batch_ids: List[str] = Body(..., embed=True),
+    reason: str = Body("expiry", embed=True),
+    remark: Optional[str] = Body(None, embed=True),
+    current_user: dict = Depends(get_current_user)
+):
+    """Dispose the whole remaining stock of expired batches in one request
+    
+    Takes batch ids from /expired-batches. Batches that are not expired or
+    have no stock left are reported as skipped; the rest are disposed together.
+    """
+    check_approval_rights(current_user["role"])
+    
+    batch_ids = list(dict.fromkeys(batch_ids))
+    if not batch_ids:
+        raise HTTPException(status_code=400, detail="No batches selected")
+    if len(batch_ids) > MAX_BULK_DISPOSALS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BULK_DISPOSALS} batches can be disposed at once"
+        )
+    
+    try:
+        batches = {batch["_id"]: batch for batch in await load_disposable_batches(batch_ids)}
+        
+        now = datetime.utcnow()
+        disposal_docs = []
+        stock_entries = []
+        audit_entries = []
+        disposed = []
+        skipped = []
+        for batch_id in batch_ids:
+            batch = batches.get(batch_id)
+            if not batch:
+                skipped.append({"batch_id": batch_id, "reason": "Batch not found, not approved or not expired"})
+                continue
+            qty = batch["current_stock"]
+            if qty <= 0:
+                skipped.append({"batch_id": batch_id, "reason": "No stock left to dispose"})
+                continue
+            
+            itc_reversal_paise = itc_reversal_for(batch, qty)
+            cost_value_paise = to_paise(qty * batch["effective_cost_per_unit"])
+            mrp_value_paise = to_paise(qty * batch["mrp"])
+            
+            disposal_id = str(uuid.uuid4())
+            disposal_docs.append({
+                "_id": disposal_id,
+                "id": disposal_id,
+                "batch_id": batch_id,
+                "qty": qty,
+                "reason": reason,
+                "remark": remark,
+                "itc_reversal_tax": to_rupees(itc_reversal_paise),
+                "itc_reversal_tax_paise": itc_reversal_paise,
+                "approved_by": current_user["user_id"],
+                "created_at": now
+            })
+            
+            # Create stock ledger entry (remove from inventory)
+            stock_entries.append({
+                "id": str(uuid.uuid4()),
+                "product_id": batch["product_id"],
+                "batch_id": batch_id,
+                "txn_type": "DISPOSAL",
+                "qty_in": 0,
+                "qty_out": qty,
+                "cost_per_unit": batch["effective_cost_per_unit"],
+                "mrp": batch["mrp"],
+                "ref_type": "DISPOSAL",
+                "ref_id": disposal_id,
+                "created_at": now
+            })
+            
+            audit_entries.append({
+                "actor_id": current_user["user_id"],
+                "role": current_user["role"],
+                "action": "CREATE_DISPOSAL",
+                "entity": "DISPOSAL",
+                "entity_id": disposal_id,
+                "after": {
+                    "batch_id": batch_id,
+                    "qty": qty,
+                    "reason": reason,
+                    "cost_value": to_rupees(cost_value_paise),
+                    "itc_reversal": to_rupees(itc_reversal_paise)
+                },
+                "created_at": now
+            })
+            
+            disposed.append({
+                "id": disposal_id,
+                "batch_id": batch_id,
+                "batch_no": batch["batch_no"],
+                "qty": qty,
+                **money_fields({
+                    "cost_value": cost_value_paise,
+                    "mrp_value": mrp_value_paise,
+                    "itc_reversal_tax": itc_reversal_paise
+                })
+            })
+        
+        if disposal_docs:
+            try:
+                await commit_disposals(disposal_docs, stock_entries, audit_entries)
+            except InsufficientStockError as e:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Stock of batch {e.batch_id} changed while disposing; reload expired batches and retry"
+                )
+        
+        return {
+            "disposed": disposed,
+            "skipped": skipped,
+            "totals": money_fields({
+                field: sum(line[f"{field}_paise"] for line in disposed)
+                for field in ("cost_value", "mrp_value", "itc_reversal_tax")
+            }),
+            "message": f"Disposed {len(disposed)} batch(es)"
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error creating bulk disposal: {e}")
+        raise HTTPException(status_code=500, detail="Error creating bulk disposal")
+
 @router.get("/summary", response_model=dict)
 async def get_disposal_summary(
     start_date: Optional[str] = None,
@@ -223,18 +438,20 @@ async def get_disposal_summary(
             },
             {"$unwind": "$batch"},
             {
+                # Values are summed as integer paise
                 "$addFields": {
-                    "cost_value": {"$multiply": ["$qty", "$batch.effective_cost_per_unit"]},
-                    "mrp_value": {"$multiply": ["$qty", "$batch.mrp"]}
+                    "cost_paise": paise_expression({"$multiply": ["$qty", "$batch.effective_cost_per_unit"]}),
+                    "mrp_paise": paise_expression({"$multiply": ["$qty", "$batch.mrp"]}),
+                    "itc_reversal_paise": stored_paise_expression("$itc_reversal_tax")
                 }
             },
             {
                 "$group": {
                     "_id": "$reason",
                     "total_qty": {"$sum": "$qty"},
-                    "total_cost_value": {"$sum": "$cost_value"},
-                    "total_mrp_value": {"$sum": "$mrp_value"},
-                    "total_itc_reversal": {"$sum": "$itc_reversal_tax"},
+                    "total_cost_paise": {"$sum": "$cost_paise"},
+                    "total_mrp_paise": {"$sum": "$mrp_paise"},
+                    "total_itc_reversal_paise": {"$sum": "$itc_reversal_paise"},
                     "count": {"$sum": 1}
                 }
             }
@@ -242,39 +459,37 @@ async def get_disposal_summary(
         
         cursor = db.disposals.aggregate(pipeline)
         reason_summary = []
-        total_summary = {
-            "total_qty": 0,
-            "total_cost_value": 0.0,
-            "total_mrp_value": 0.0,
-            "total_itc_reversal": 0.0,
-            "total_disposals": 0
-        }
+        totals_paise = {"cost": 0, "mrp": 0, "itc_reversal": 0}
+        total_qty = 0
+        total_disposals = 0
         
         async for item in cursor:
             reason_data = {
                 "reason": item["_id"],
                 "qty": item["total_qty"],
-                "cost_value": round(item["total_cost_value"], 2),
-                "mrp_value": round(item["total_mrp_value"], 2),
-                "itc_reversal": round(item["total_itc_reversal"], 2),
+                "cost_value": to_rupees(item["total_cost_paise"]),
+                "mrp_value": to_rupees(item["total_mrp_paise"]),
+                "itc_reversal": to_rupees(item["total_itc_reversal_paise"]),
                 "count": item["count"]
             }
             reason_summary.append(reason_data)
             
             # Accumulate totals
-            total_summary["total_qty"] += item["total_qty"]
-            total_summary["total_cost_value"] += item["total_cost_value"]
-            total_summary["total_mrp_value"] += item["total_mrp_value"]
-            total_summary["total_itc_reversal"] += item["total_itc_reversal"]
-            total_summary["total_disposals"] += item["count"]
-        
-        # Round totals
-        for key in ["total_cost_value", "total_mrp_value", "total_itc_reversal"]:
-            total_summary[key] = round(total_summary[key], 2)
+            total_qty += item["total_qty"]
+            totals_paise["cost"] += item["total_cost_paise"]
+            totals_paise["mrp"] += item["total_mrp_paise"]
+            totals_paise["itc_reversal"] += item["total_itc_reversal_paise"]
+            total_disposals += item["count"]
         
         return {
             "by_reason": reason_summary,
-            "totals": total_summary
+            "totals": {
+                "total_qty": total_qty,
+                "total_cost_value": to_rupees(totals_paise["cost"]),
+                "total_mrp_value": to_rupees(totals_paise["mrp"]),
+                "total_itc_reversal": to_rupees(totals_paise["itc_reversal"]),
+                "total_disposals": total_disposals
+            }
         }
         
     except Exception as e:
@@ -282,35 +497,35 @@ async def get_disposal_summary(
         raise HTTPException(status_code=500, detail="Error getting disposal summary")
 
 @router.get("/expired-batches", response_model=List[dict])
-async def get_expired_batches(current_user: dict = Depends(get_current_user)):
-    """Get batches that have expired and can be disposed"""
+async def get_expired_batches(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get batches that have expired and can be disposed
+    
+    Pass limit to page; the next page's cursor is returned in X-Next-Cursor
+    """
     check_pharmacy_access(current_user["role"])
     
     try:
         current_month = datetime.utcnow().strftime("%Y-%m")
         
-        # Find expired batches with current stock
+        # Find expired batches with current stock; each batch joins its single balance document
         pipeline = [
             {"$match": {"expiry": {"$lt": current_month}, "status": "APPROVED"}},
             {
                 "$lookup": {
-                    "from": "stock_ledger",
+                    "from": "stock_balances",
                     "localField": "_id",
                     "foreignField": "batch_id",
-                    "as": "movements"
-                }
-            },
-            {
-                "$addFields": {
-                    "current_stock": {
-                        "$subtract": [
-                            {"$sum": "$movements.qty_in"},
-                            {"$sum": "$movements.qty_out"}
-                        ]
-                    }
+                    "as": "balance"
                 }
             },
+            {"$addFields": {"current_stock": {"$ifNull": [{"$arrayElemAt": ["$balance.qty", 0]}, 0]}}},
             {"$match": {"current_stock": {"$gt": 0}}},
+            *ascending_page_stages("expiry", limit, cursor),
             {
                 "$lookup": {
                     "from": "products",
@@ -322,10 +537,13 @@ async def get_expired_batches(current_user: dict = Depends(get_current_user)):
             {"$unwind": "$product"}
         ]
         
-        cursor = db.batches.aggregate(pipeline)
-        expired_batches = []
+        rows = await db.batches.aggregate(pipeline).to_list(length=None)
+        rows, next_cursor = split_page(rows, "expiry", limit, cursor)
+        if next_cursor:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
         
-        async for batch in cursor:
+        expired_batches = []
+        for batch in rows:
             cost_value = batch["current_stock"] * batch["effective_cost_per_unit"]
             mrp_value = batch["current_stock"] * batch["mrp"]
             
@@ -344,11 +562,10 @@ async def get_expired_batches(current_user: dict = Depends(get_current_user)):
             }
             expired_batches.append(expired_batch)
         
-        # Sort by expiry date (oldest first)
-        expired_batches.sort(key=lambda x: x["expiry"])
-        
         return expired_batches
         
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logging.error(f"Error fetching expired batches: {e}")
         raise HTTPException(status_code=500, detail="Error fetching expired batches")
\ No newline at end of file
@@ -0,0 +1,175 @@
+# routers/exports.py
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Dict, List, Optional
+from datetime import datetime
+import csv
+import io
+import json
+import logging
+import zlib
+
+from deps.auth import get_current_user
+from deps.db import db
+from utils.pagination import InvalidDateRangeError, parse_date_range
+
+router = APIRouter(prefix="/api/pharmacy/exports", tags=["exports"])
+
+# Rows pulled from MongoDB per round trip and written per response chunk
+EXPORT_BATCH_SIZE = 1000
+
+# Exportable datasets: collection, date field used for the range filter and
+# the columns written (dotted paths reach into embedded documents)
+EXPORTS: Dict[str, Dict] = {
+    "sales": {
+        "collection": "sales",
+        "date_field": "date_time",
+        "columns": [
+            "_id", "bill_no", "date_time", "mode", "patient.name", "patient.phone",
+            "doctor_name", "opd_no", "totals.mrp_total", "totals.discount_on_mrp",
+            "totals.taxable", "totals.cgst", "totals.sgst", "totals.igst", "totals.net",
+            "created_by"
+        ]
+    },
+    "sale_items": {
+        "collection": "sale_items",
+        "date_field": "created_at",
+        "columns": [
+            "_id", "sale_id", "product_id", "batch_id", "nos", "pricing_mode", "mrp",
+            "mrp_discount_pct", "rate_ex_tax", "gst_rate", "schedule_symbol",
+            "base_ex_tax", "cgst", "sgst", "igst", "net", "created_at"
+        ]
+    },
+    "purchases": {
+        "collection": "purchases",
+        "date_field": "created_at",
+        "columns": [
+            "_id", "invoice_no", "invoice_date", "supplier_id", "type", "status",
+            "totals.taxable", "totals.cgst", "totals.sgst", "totals.igst",
+            "totals.post_tax_discount", "totals.net_payable", "created_by",
+            "approved_by", "approved_at", "created_at"
+        ]
+    },
+    "stock_ledger": {
+        "collection": "stock_ledger",
+        "date_field": "created_at",
+        "columns": [
+            "_id", "product_id", "batch_id", "txn_type", "qty_in", "qty_out",
+            "cost_per_unit", "mrp", "ref_type", "ref_id", "created_at"
+        ]
+    },
+}
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+}
+
+def check_export_access(user_role: str):
+    """Check export access"""
+    if user_role not in ["admin", "pharmacist"]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+
+def get_path(document: Dict, path: str):
+    """Value at a dotted path, or None when any part is missing"""
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+async def export_rows(collection, query: Dict, date_field: str, columns: List[str]) -> AsyncIterator[list]:
+    """Projected rows in date order, read in batches from one cursor"""
+    projection = {column: 1 for column in columns}
+    cursor = collection.find(query, projection).sort(
+        [(date_field, 1), ("_id", 1)]
+    ).batch_size(EXPORT_BATCH_SIZE)
+    async for document in cursor:
+        yield [export_value(get_path(document, column)) for column in columns]
+
+async def csv_chunks(rows: AsyncIterator[list], columns: List[str]) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    count = 0
+    async for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+async def jsonl_chunks(rows: AsyncIterator[list], columns: List[str]) -> AsyncIterator[str]:
+    lines = []
+    async for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row))))
+        if len(lines) == EXPORT_BATCH_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+async def encode_chunks(chunks: AsyncIterator[str], compress: bool) -> AsyncIterator[bytes]:
+    """UTF-8 encode, optionally gzip-compressing on the fly"""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    async for chunk in chunks:
+        data = chunk.encode("utf-8")
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor:
+        yield compressor.flush()
+
+@router.get("/{dataset}")
+async def export_dataset(
+    dataset: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    format: str = Query("csv", pattern="^(csv|jsonl)$"),
+    gzip: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stream a dataset over a date range as CSV or JSON lines
+    
+    Rows are written as they are read from the cursor, so memory use stays
+    flat however many rows the range covers
+    """
+    check_export_access(current_user["role"])
+    
+    export = EXPORTS.get(dataset)
+    if not export:
+        raise HTTPException(status_code=404, detail=f"Unknown export: {dataset}")
+    
+    try:
+        date_range = parse_date_range(start_date, end_date)
+    except InvalidDateRangeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    query = {export["date_field"]: date_range} if date_range else {}
+    columns = export["columns"]
+    rows = export_rows(getattr(db, export["collection"]), query, export["date_field"], columns)
+    chunks = csv_chunks(rows, columns) if format == "csv" else jsonl_chunks(rows, columns)
+    
+    media_type, extension = EXPORT_FORMATS[format]
+    filename = f"{dataset}_{start_date or 'all'}_{end_date or 'all'}.{extension}"
+    if gzip:
+        media_type = "application/gzip"
+        filename += ".gz"
+    
+    logging.info(f"Export {dataset} ({format}) requested by {current_user['username']}")
+    return StreamingResponse(
+        encode_chunks(chunks, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
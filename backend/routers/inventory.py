@@ -1,24 +1,22 @@
 # routers/inventory.py
-from fastapi import APIRouter, HTTPException, Depends, status
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi import APIRouter, HTTPException, Depends, Response, status
 from typing import List, Optional
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
 
+from deps.auth import get_current_user
 from deps.db import db
+from deps.expiry import (
+    NEAR_EXPIRY_HORIZON_MONTHS, ensure_near_expiry_snapshot, expiry_color_expression, expiry_today,
+    rebuild_near_expiry_snapshot
+)
+from deps.stock import BATCH_SCOPE
 from models import BatchResponse, ProductResponse, ScheduleSymbol
-from utils.gst import get_expiry_color
+from utils.gst import expiry_cutoff
+from utils.money import paise_expression, to_rupees
+from utils.pagination import NEXT_CURSOR_HEADER, InvalidCursorError, ascending_page_stages, split_page
 
 router = APIRouter(prefix="/api/pharmacy/inventory", tags=["inventory"])
-security = HTTPBearer()
-
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get current user from JWT token"""
-    return {
-        "user_id": "current_user_id",
-        "username": "current_user",
-        "role": "pharmacist"
-    }
 
 def check_pharmacy_access(user_role: str):
     """Check pharmacy access"""
@@ -27,101 +25,93 @@ def check_pharmacy_access(user_role: str):
 
 @router.get("/stock", response_model=List[dict])
 async def get_current_stock(
+    response: Response,
     product_id: Optional[str] = None,
     rack_id: Optional[str] = None,
     expiry_color: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
-    """Get current stock levels by product and batch"""
+    """Get current stock levels by product and batch, earliest expiry first
+    
+    Pass limit to page; the next page's cursor is returned in X-Next-Cursor
+    """
     check_pharmacy_access(current_user["role"])
     
     try:
-        # Build aggregation pipeline
+        # Start from batch balances with stock, so the ledger is never scanned
+        balance_match = {"scope": BATCH_SCOPE, "qty": {"$gt": 0}}
+        if product_id:
+            balance_match["product_id"] = product_id
+        
+        batch_match = {}
+        if rack_id:
+            batch_match["batch.rack_id"] = rack_id
+        
         pipeline = [
+            {"$match": balance_match},
             {
                 "$lookup": {
-                    "from": "products",
-                    "localField": "product_id",
+                    "from": "batches",
+                    "localField": "batch_id",
                     "foreignField": "_id",
-                    "as": "product"
+                    "as": "batch"
                 }
             },
-            {"$unwind": "$product"},
+            {"$unwind": "$batch"},
+            {"$match": batch_match},
+            {"$addFields": {"expiry_color": expiry_color_expression("$batch.expiry", expiry_today())}}
+        ]
+        if expiry_color:
+            pipeline.append({"$match": {"expiry_color": expiry_color}})
+        
+        # Page before joining products so only the returned rows are looked up
+        pipeline += ascending_page_stages("batch.expiry", limit, cursor)
+        pipeline += [
             {
                 "$lookup": {
-                    "from": "stock_ledger",
-                    "localField": "_id",
-                    "foreignField": "batch_id",
-                    "as": "stock_movements"
-                }
-            },
-            {
-                "$addFields": {
-                    "current_stock": {
-                        "$subtract": [
-                            {"$sum": "$stock_movements.qty_in"},
-                            {"$sum": "$stock_movements.qty_out"}
-                        ]
-                    },
-                    "expiry_color": {
-                        "$switch": {
-                            "branches": [
-                                {
-                                    "case": {"$lte": ["$expiry", {"$dateToString": {"format": "%Y-%m", "date": {"$add": [datetime.utcnow(), timedelta(days=90)]}}}]},
-                                    "then": "red"
-                                },
-                                {
-                                    "case": {"$lte": ["$expiry", {"$dateToString": {"format": "%Y-%m", "date": {"$add": [datetime.utcnow(), timedelta(days=180)]}}}]},
-                                    "then": "orange"
-                                },
-                                {
-                                    "case": {"$lte": ["$expiry", {"$dateToString": {"format": "%Y-%m", "date": {"$add": [datetime.utcnow(), timedelta(days=365)]}}}]},
-                                    "then": "yellow"
-                                }
-                            ],
-                            "default": "ok"
-                        }
-                    }
+                    "from": "products",
+                    "localField": "product_id",
+                    "foreignField": "_id",
+                    "as": "product"
                 }
             },
-            {"$match": {"current_stock": {"$gt": 0}}}  # Only show items with stock
+            {"$unwind": "$product"}
         ]
         
-        # Add filters
-        if product_id:
-            pipeline.insert(0, {"$match": {"product_id": product_id}})
-        if rack_id:
-            pipeline.insert(0, {"$match": {"rack_id": rack_id}})
-        
         # Execute aggregation
-        cursor = db.batches.aggregate(pipeline)
-        stock_items = []
+        rows = await db.stock_balances.aggregate(pipeline).to_list(length=None)
+        rows, next_cursor = split_page(rows, "batch.expiry", limit, cursor)
+        if next_cursor:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
         
-        async for item in cursor:
-            # Apply expiry color filter if specified
-            if expiry_color and item.get("expiry_color") != expiry_color:
-                continue
-            
+        stock_items = []
+        for item in rows:
+            batch = item["batch"]
             stock_item = {
-                "batch_id": str(item["_id"]),
-                "batch_no": item["batch_no"],
-                "product_id": str(item["product_id"]),
+                "batch_id": item["batch_id"],
+                "batch_no": batch["batch_no"],
+                "product_id": item["product_id"],
                 "product_name": f"{item['product']['brand_name']} {item['product']['strength']} {item['product']['form']}",
                 "chemical_name": item["product"]["chemical_name"],
                 "company_name": item["product"].get("company_name", ""),
                 "schedule_symbol": item["product"]["schedule_symbol"],
-                "expiry": item["expiry"],
+                "expiry": batch["expiry"],
                 "expiry_color": item["expiry_color"],
-                "mrp": item["mrp"],
-                "current_stock": item["current_stock"],
-                "effective_cost_per_unit": item["effective_cost_per_unit"],
-                "rack_id": item.get("rack_id"),
-                "gst_rate": item["gst_rate"]
+                "mrp": batch["mrp"],
+                "current_stock": item["qty"],
+                "reserved": item.get("reserved", 0),
+                "effective_cost_per_unit": batch["effective_cost_per_unit"],
+                "rack_id": batch.get("rack_id"),
+                "gst_rate": batch["gst_rate"]
             }
             stock_items.append(stock_item)
         
         return stock_items
         
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logging.error(f"Error fetching stock: {e}")
         raise HTTPException(status_code=500, detail="Error fetching stock")
@@ -133,81 +123,55 @@ async def get_near_expiry_items(
     schedule: Optional[ScheduleSymbol] = None,
     current_user: dict = Depends(get_current_user)
 ):
-    """Get items nearing expiry"""
+    """Get items nearing expiry
+    
+    Served from near_expiry_snapshot, rebuilt nightly (or by the first
+    request of the day); stock is as of snapshot_at
+    """
     check_pharmacy_access(current_user["role"])
     
+    if months is not None and months > NEAR_EXPIRY_HORIZON_MONTHS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Near-expiry lookups cover at most {NEAR_EXPIRY_HORIZON_MONTHS} months"
+        )
+    
     try:
-        # Calculate cutoff date
-        cutoff_date = (datetime.utcnow() + timedelta(days=months*30)).strftime("%Y-%m")
+        await ensure_near_expiry_snapshot()
+        
+        # Calculate cutoff month (calendar months, as the snapshot's colours are)
+        cutoff_date = expiry_cutoff(expiry_today(), months or 0)
         
         # Build query
-        query = {
-            "expiry": {"$lte": cutoff_date},
-            "status": "APPROVED"
-        }
+        query = {"expiry": {"$lte": cutoff_date}}
         
         if rack_id:
             query["rack_id"] = rack_id
-        
-        # Get batches
-        batches_cursor = db.batches.find(query)
-        near_expiry_items = []
-        
-        async for batch in batches_cursor:
-            # Get current stock
-            stock_cursor = db.stock_ledger.find({"batch_id": str(batch["_id"])})
-            current_stock = 0
-            async for stock_entry in stock_cursor:
-                current_stock += stock_entry.get("qty_in", 0) - stock_entry.get("qty_out", 0)
-            
-            if current_stock <= 0:
-                continue  # Skip items with no stock
-            
-            # Get product details
-            product = await db.products.find_one({"_id": batch["product_id"]})
-            if not product:
-                continue
-            
-            # Apply schedule filter
-            if schedule and product.get("schedule_symbol") != schedule:
-                continue
-            
-            # Calculate expiry color
-            expiry_color = get_expiry_color(batch["expiry"])
-            
-            # Calculate value at cost and MRP
-            cost_value = current_stock * batch["effective_cost_per_unit"]
-            mrp_value = current_stock * batch["mrp"]
-            
-            near_expiry_item = {
-                "batch_id": str(batch["_id"]),
-                "batch_no": batch["batch_no"],
-                "product_name": f"{product['brand_name']} {product['strength']} {product['form']}",
-                "chemical_name": product["chemical_name"],
-                "company_name": product.get("company_name", ""),
-                "schedule_symbol": product["schedule_symbol"],
-                "expiry": batch["expiry"],
-                "expiry_color": expiry_color,
-                "days_to_expiry": (datetime.strptime(batch["expiry"], "%Y-%m") - datetime.utcnow()).days,
-                "current_stock": current_stock,
-                "mrp": batch["mrp"],
-                "cost_per_unit": batch["effective_cost_per_unit"],
-                "cost_value": round(cost_value, 2),
-                "mrp_value": round(mrp_value, 2),
-                "rack_id": batch.get("rack_id"),
-                "supplier_id": batch["supplier_id"]
-            }
-            near_expiry_items.append(near_expiry_item)
+        if schedule:
+            query["schedule_symbol"] = schedule
         
         # Sort by expiry date (earliest first)
-        near_expiry_items.sort(key=lambda x: x["expiry"])
-        
-        return near_expiry_items
+        cursor = db.near_expiry_snapshot.find(query, {"_id": 0}).sort([("expiry", 1), ("batch_id", 1)])
+        return await cursor.to_list(length=None)
         
     except Exception as e:
         logging.error(f"Error fetching near-expiry items: {e}")
         raise HTTPException(status_code=500, detail="Error fetching near-expiry items")
 
+@router.post("/near-expiry/refresh", response_model=dict)
+async def refresh_near_expiry_snapshot(current_user: dict = Depends(get_current_user)):
+    """Rebuild the near-expiry snapshot now (e.g. after a large purchase or disposal)"""
+    if current_user["role"] not in ["admin", "pharmacist"]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    
+    try:
+        count = await rebuild_near_expiry_snapshot()
+        return {"batches": count, "message": "Near-expiry snapshot rebuilt"}
+    
+    except Exception as e:
+        logging.error(f"Error rebuilding near-expiry snapshot: {e}")
+        raise HTTPException(status_code=500, detail="Error rebuilding near-expiry snapshot")
+
 @router.get("/movements/{batch_id}", response_model=List[dict])
 async def get_batch_movements(batch_id: str, current_user: dict = Depends(get_current_user)):
     """Get stock movement history for a specific batch"""
@@ -301,55 +265,41 @@ async def get_inventory_valuation(current_user: dict = Depends(get_current_user)
     check_pharmacy_access(current_user["role"])
     
     try:
-        # Aggregate stock values
+        # Aggregate stock values from batch balances; each balance joins one batch by _id
         pipeline = [
+            {"$match": {"scope": BATCH_SCOPE, "qty": {"$gt": 0}}},
             {
                 "$lookup": {
-                    "from": "stock_ledger",
-                    "localField": "_id",
-                    "foreignField": "batch_id",
-                    "as": "movements"
-                }
-            },
-            {
-                "$addFields": {
-                    "current_stock": {
-                        "$subtract": [
-                            {"$sum": "$movements.qty_in"},
-                            {"$sum": "$movements.qty_out"}
-                        ]
-                    }
-                }
-            },
-            {"$match": {"current_stock": {"$gt": 0}}},
-            {
-                "$addFields": {
-                    "cost_value": {"$multiply": ["$current_stock", "$effective_cost_per_unit"]},
-                    "mrp_value": {"$multiply": ["$current_stock", "$mrp"]}
+                    "from": "batches",
+                    "localField": "batch_id",
+                    "foreignField": "_id",
+                    "as": "batch"
                 }
             },
+            {"$unwind": "$batch"},
             {
                 "$group": {
                     "_id": None,
-                    "total_cost_value": {"$sum": "$cost_value"},
-                    "total_mrp_value": {"$sum": "$mrp_value"},
+                    # Each batch's value is rounded to whole paise so the sums are exact integers
+                    "total_cost_paise": {"$sum": paise_expression({"$multiply": ["$qty", "$batch.effective_cost_per_unit"]})},
+                    "total_mrp_paise": {"$sum": paise_expression({"$multiply": ["$qty", "$batch.mrp"]})},
                     "total_items": {"$sum": 1},
-                    "total_quantity": {"$sum": "$current_stock"}
+                    "total_quantity": {"$sum": "$qty"}
                 }
             }
         ]
         
-        cursor = db.batches.aggregate(pipeline)
+        cursor = db.stock_balances.aggregate(pipeline)
         result = await cursor.to_list(length=1)
         
         if result:
             valuation = result[0]
             return {
-                "total_cost_value": round(valuation["total_cost_value"], 2),
-                "total_mrp_value": round(valuation["total_mrp_value"], 2),
+                "total_cost_value": to_rupees(valuation["total_cost_paise"]),
+                "total_mrp_value": to_rupees(valuation["total_mrp_paise"]),
                 "total_items": valuation["total_items"],
                 "total_quantity": valuation["total_quantity"],
-                "potential_profit": round(valuation["total_mrp_value"] - valuation["total_cost_value"], 2)
+                "potential_profit": to_rupees(valuation["total_mrp_paise"] - valuation["total_cost_paise"])
             }
         else:
             return {
@@ -1,12 +1,14 @@
 # routers/pharmacy.py
 from fastapi import APIRouter, HTTPException, Depends, status
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from typing import List, Optional
 from datetime import datetime
 import uuid
 import logging
 
+from deps.auth import get_current_user
 from deps.db import db
+from deps.product_search import index_product, invalidate_search_index, search_product_ids
+from deps.stock import get_product_stocks
 from models import (
     Product, ProductCreate, ProductResponse,
     Supplier, 
@@ -30,18 +32,6 @@ from utils.schedule import (
 
 router = APIRouter(prefix="/api/pharmacy", tags=["pharmacy"])
 
-# Security
-security = HTTPBearer()
-
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get current user from JWT token - placeholder implementation"""
-    # In real implementation, decode JWT and get user info
-    return {
-        "user_id": "current_user_id",
-        "username": "current_user",
-        "role": "pharmacist"  # or "admin", "assistant"
-    }
-
 def check_pharmacy_access(user_role: str):
     """Check if user has pharmacy access"""
     allowed_roles = ["admin", "pharmacist", "assistant"]
@@ -102,54 +92,106 @@ async def create_supplier(supplier: Supplier, current_user: dict = Depends(get_c
         raise HTTPException(status_code=500, detail="Error creating supplier")
 
 # Products
+# Most products a search query returns on the product listing
+MAX_SEARCH_RESULTS = 200
+
+async def find_ranked_products(search: str, limit: int, schedule: Optional[ScheduleSymbol] = None) -> list:
+    """Products matching a search query, best match first"""
+    # Filter inside the index so the limit counts only matching products
+    product_ids = await search_product_ids(search, limit, {"schedule_symbol": schedule} if schedule else None)
+    if not product_ids:
+        return []
+    
+    query = {"_id": {"$in": product_ids}}
+    if schedule:
+        query["schedule_symbol"] = schedule
+    
+    by_id = {product["_id"]: product async for product in db.products.find(query)}
+    return [by_id[product_id] for product_id in product_ids if product_id in by_id]
+
+async def count_near_expiry_batches(product_ids: List[str]) -> dict:
+    """Near-expiry batch counts for many products with one grouped aggregation"""
+    pipeline = [
+        {"$match": {
+            "product_id": {"$in": product_ids},
+            "expiry": {"$lte": datetime.now().strftime("%Y-%m")}
+        }},
+        {"$group": {"_id": "$product_id", "count": {"$sum": 1}}}
+    ]
+    counts = {}
+    async for row in db.batches.aggregate(pipeline):
+        counts[row["_id"]] = row["count"]
+    return counts
+
+async def build_product_responses(products: list, include_stock: bool = True) -> List[ProductResponse]:
+    """
+    Build product responses, attaching current stock and near-expiry batch counts
+    Stock comes from two queries for the whole page rather than two per product
+    """
+    product_ids = [str(product["_id"]) for product in products]
+    if include_stock and product_ids:
+        stocks = await get_product_stocks(product_ids)
+        near_expiry_counts = await count_near_expiry_batches(product_ids)
+    
+    responses = []
+    for product_id, product in zip(product_ids, products):
+        product["id"] = product_id
+        product_response = ProductResponse(**product)
+        
+        if include_stock:
+            product_response.current_stock = stocks.get(product_id, 0)
+            product_response.near_expiry_batches = near_expiry_counts.get(product_id, 0)
+        
+        responses.append(product_response)
+    
+    return responses
+
 @router.get("/products", response_model=List[ProductResponse])
 async def get_products(
     search: Optional[str] = None,
     schedule: Optional[ScheduleSymbol] = None,
+    include_stock: bool = True,
     current_user: dict = Depends(get_current_user)
 ):
-    """Get all products with optional search and filtering"""
+    """Get all products with optional search and filtering
+    
+    Pass include_stock=false when only names are needed to skip stock lookups
+    """
     check_pharmacy_access(current_user["role"])
     
     try:
-        query = {}
         if search:
-            query["$or"] = [
-                {"brand_name": {"$regex": search, "$options": "i"}},
-                {"chemical_name": {"$regex": search, "$options": "i"}}
-            ]
-        if schedule:
-            query["schedule_symbol"] = schedule
-        
-        products_cursor = db.products.find(query)
-        products = []
-        
-        async for product in products_cursor:
-            product["id"] = str(product["_id"])
-            
-            # Get current stock
-            stock_cursor = db.stock_ledger.find({"product_id": product["id"]})
-            current_stock = 0
-            async for entry in stock_cursor:
-                current_stock += entry.get("qty_in", 0) - entry.get("qty_out", 0)
-            
-            # Count near-expiry batches
-            near_expiry_count = await db.batches.count_documents({
-                "product_id": product["id"],
-                "expiry": {"$lte": datetime.now().strftime("%Y-%m")}
-            })
-            
-            product_response = ProductResponse(**product)
-            product_response.current_stock = current_stock
-            product_response.near_expiry_batches = near_expiry_count
-            
-            products.append(product_response)
+            products = await find_ranked_products(search, MAX_SEARCH_RESULTS, schedule)
+        else:
+            query = {}
+            if schedule:
+                query["schedule_symbol"] = schedule
+            products = await db.products.find(query).to_list(length=None)
         
-        return products
+        return await build_product_responses(products, include_stock)
     except Exception as e:
         logging.error(f"Error fetching products: {e}")
         raise HTTPException(status_code=500, detail="Error fetching products")
 
+@router.get("/products/search", response_model=List[ProductResponse])
+async def search_products(
+    q: str,
+    limit: int = 20,
+    schedule: Optional[ScheduleSymbol] = None,
+    include_stock: bool = True,
+    current_user: dict = Depends(get_current_user)
+):
+    """Ranked prefix/substring product search for the billing screen search box"""
+    check_pharmacy_access(current_user["role"])
+    
+    try:
+        limit = min(max(limit, 1), MAX_SEARCH_RESULTS)
+        products = await find_ranked_products(q, limit, schedule)
+        return await build_product_responses(products, include_stock)
+    except Exception as e:
+        logging.error(f"Error searching products: {e}")
+        raise HTTPException(status_code=500, detail="Error searching products")
+
 @router.post("/products", response_model=ProductResponse, status_code=201)
 async def create_product(product: ProductCreate, current_user: dict = Depends(get_current_user)):
     """Create new product with schedule validation"""
@@ -194,6 +236,7 @@ async def create_product(product: ProductCreate, current_user: dict = Depends(ge
         
         result = await db.products.insert_one(product_dict)
         product_dict["id"] = str(result.inserted_id)
+        index_product(product_dict)
         
         # Return with additional fields
         product_response = ProductResponse(**product_dict)
@@ -244,6 +287,8 @@ async def set_chemical_schedule(
             {"chemical_name": {"$regex": f"^{chemical_name}$", "$options": "i"}},
             [propagation_query]
         )
+        if result.modified_count:
+            invalidate_search_index()
         
         return {
             "message": f"Schedule {schedule} set for {chemical_name}",
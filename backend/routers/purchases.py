@@ -1,26 +1,30 @@
 # routers/purchases.py
-from fastapi import APIRouter, HTTPException, Depends, status
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Depends, Body, File, UploadFile, status
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
+import asyncio
 import uuid
 import logging
+import os
+import re
+from bson import ObjectId
 
+from deps.auth import get_current_user
 from deps.db import db
+from deps.stock import build_balance_updates, post_ledger_entries
+from utils.joins import fetch_by_ids, ordered_by_ids
 from models import Purchase, PurchaseCreate, PurchaseResponse, BatchCreate
-from utils.gst import calc_purchase_line, is_supplier_intra_kerala, validate_gst_rate
+from utils.gst import calc_purchase_invoice, is_supplier_intra_kerala, validate_gst_rate
+from utils.money import money_fields
+from utils.purchase_import import (
+    PurchaseFileError, parse_einvoice_json, parse_purchase_csv,
+    product_name_keys, validate_purchase_lines
+)
+from utils.search import normalize_text
 from utils.schedule import validate_schedule_compliance
 
 router = APIRouter(prefix="/api/pharmacy/purchases", tags=["purchases"])
-security = HTTPBearer()
-
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get current user from JWT token"""
-    return {
-        "user_id": "current_user_id",
-        "username": "current_user",
-        "role": "pharmacist"
-    }
 
 def check_pharmacy_access(user_role: str):
     """Check pharmacy access"""
@@ -48,14 +52,18 @@ async def get_purchases(
         if supplier_id:
             query["supplier_id"] = supplier_id
         
-        purchases_cursor = db.purchases.find(query).sort("created_at", -1)
-        purchases = []
+        purchase_docs = await db.purchases.find(query).sort("created_at", -1).to_list(length=None)
+        
+        # Get supplier names with one query
+        suppliers = await fetch_by_ids(
+            db.suppliers, [purchase["supplier_id"] for purchase in purchase_docs], {"name": 1}
+        )
         
-        async for purchase in purchases_cursor:
+        purchases = []
+        for purchase in purchase_docs:
             purchase["id"] = str(purchase["_id"])
             
-            # Get supplier name
-            supplier = await db.suppliers.find_one({"_id": purchase["supplier_id"]})
+            supplier = suppliers.get(purchase["supplier_id"])
             supplier_name = supplier["name"] if supplier else "Unknown"
             
             purchase_response = PurchaseResponse(**purchase)
@@ -69,6 +77,111 @@ async def get_purchases(
         logging.error(f"Error fetching purchases: {e}")
         raise HTTPException(status_code=500, detail="Error fetching purchases")
 
+PURCHASE_TOTAL_FIELDS = ("taxable", "cgst", "sgst", "igst", "post_tax_discount", "net_payable")
+
+def build_purchase_documents(
+    is_intra: bool,
+    lines: List[Dict],
+    header: Dict,
+    current_user: dict
+) -> Tuple[Dict, List[Dict]]:
+    """
+    PENDING purchase and batch documents for validated lines
+    Ids are pre-generated so the batches and the purchase can be written
+    with one insert_many and one insert_one
+    """
+    now = datetime.utcnow()
+    
+    # Calculate every line and the invoice totals in one pass (exact paise)
+    invoice = calc_purchase_invoice(is_intra, [
+        {
+            "billed_qty": line["billed_qty"],
+            "free_qty": line["free_qty"],
+            "trade_price_ex": line["trade_price_ex_tax"],
+            "gst_rate": line["gst_rate"],
+            "scheme_pct": line["scheme_pct"],
+            "cash_pct": line["cash_pct"]
+        }
+        for line in lines
+    ])
+    
+    batch_docs = []
+    processed_items = []
+    for line, line_calc in zip(lines, invoice["lines"]):
+        batch_id = str(uuid.uuid4())
+        batch_docs.append({
+            "_id": batch_id,
+            "id": batch_id,
+            "product_id": line["product_id"],
+            "batch_no": line["batch_no"],
+            "expiry": line["expiry"],
+            "gst_rate": line["gst_rate"],
+            "mrp": line["mrp"],
+            "trade_price_ex_tax": line["trade_price_ex_tax"],
+            "scheme_pct": line["scheme_pct"],
+            "cash_pct": line["cash_pct"],
+            "received_qty": line["billed_qty"],
+            "free_qty": line["free_qty"],
+            "effective_cost_per_unit": float(line_calc["effective_cost_per_unit"]),
+            "supplier_id": header["supplier_id"],
+            "received_at": now,
+            "rack_id": line.get("rack_id"),
+            "status": "PENDING"
+        })
+        
+        # Store processed item (create PurchaseItem structure)
+        processed_items.append({
+            "product_id": line["product_id"],
+            "batch_id": batch_id,
+            "billed_qty": line["billed_qty"],
+            "free_qty": line["free_qty"],
+            "gst_rate": line["gst_rate"],
+            "scheme_pct": line["scheme_pct"],
+            "cash_pct": line["cash_pct"],
+            "mrp": line["mrp"],
+            "trade_price_ex_tax": line["trade_price_ex_tax"],
+            "hsn": line.get("hsn"),
+            "rack_id": line.get("rack_id"),
+            "schedule_symbol": line.get("schedule_symbol"),
+            **money_fields({
+                "taxable": line_calc["taxable"],
+                "cgst": line_calc["cgst"],
+                "sgst": line_calc["sgst"],
+                "igst": line_calc["igst"],
+                "row_net": line_calc["net_payable"]
+            })
+        })
+    
+    purchase_id = str(uuid.uuid4())
+    purchase_doc = {
+        "_id": purchase_id,
+        "id": purchase_id,
+        **header,
+        "is_intra": is_intra,
+        "items": processed_items,
+        "batch_ids": [batch["_id"] for batch in batch_docs],
+        "totals": money_fields({key: invoice["totals"][key] for key in PURCHASE_TOTAL_FIELDS}),
+        "created_by": current_user["user_id"],
+        "status": "PENDING",
+        "created_at": now,
+        "updated_at": now
+    }
+    return purchase_doc, batch_docs
+
+async def insert_purchase(purchase_doc: Dict, batch_docs: List[Dict]):
+    """Write a pending purchase and its batches together"""
+    async def commit_purchase(session):
+        await db.batches.insert_many(batch_docs, session=session)
+        try:
+            await db.purchases.insert_one(purchase_doc, session=session)
+        except Exception:
+            if session is None:
+                # No transaction to roll back; do not leave orphan batches behind
+                await db.batches.delete_many({"_id": {"$in": purchase_doc["batch_ids"]}})
+            raise
+    
+    await db.run_in_transaction(commit_purchase)
+
 @router.post("", response_model=dict, status_code=201)
 async def create_purchase(purchase: PurchaseCreate, current_user: dict = Depends(get_current_user)):
     """Create new purchase (PENDING status)"""
@@ -83,18 +196,6 @@ async def create_purchase(purchase: PurchaseCreate, current_user: dict = Depends
         # Determine if intra-state for GST calculation
         is_intra = is_supplier_intra_kerala(supplier.get("state", ""))
         
-        # Process each item and create batches
-        processed_items = []
-        batch_ids = []
-        purchase_totals = {
-            "taxable": 0.0,
-            "cgst": 0.0,
-            "sgst": 0.0,
-            "igst": 0.0,
-            "post_tax_discount": 0.0,
-            "net_payable": 0.0
-        }
-        
         for item in purchase.items:
             # Validate GST rate
             if not validate_gst_rate(item.gst_rate):
@@ -107,98 +208,24 @@ async def create_purchase(purchase: PurchaseCreate, current_user: dict = Depends
                     raise HTTPException(status_code=400, detail="Expiry date must be in future")
             except ValueError:
                 raise HTTPException(status_code=400, detail="Invalid expiry date format (YYYY-MM)")
-            
-            # Calculate line totals
-            line_calc = calc_purchase_line(
-                is_intra=is_intra,
-                billed_qty=item.billed_qty,
-                free_qty=item.free_qty,
-                trade_price_ex=item.trade_price_ex_tax,
-                gst_rate=item.gst_rate,
-                scheme_pct=item.scheme_pct,
-                cash_pct=item.cash_pct
-            )
-            
-            # Create batch record (PENDING)
-            batch_doc = {
-                "id": str(uuid.uuid4()),
-                "product_id": item.product_id,
-                "batch_no": item.batch_no,
-                "expiry": item.expiry,
-                "gst_rate": item.gst_rate,
-                "mrp": item.mrp,
-                "trade_price_ex_tax": item.trade_price_ex_tax,
-                "scheme_pct": item.scheme_pct,
-                "cash_pct": item.cash_pct,
-                "received_qty": item.billed_qty,
-                "free_qty": item.free_qty,
-                "effective_cost_per_unit": line_calc["effective_cost_per_unit"],
-                "supplier_id": purchase.supplier_id,
-                "received_at": datetime.utcnow(),
-                "rack_id": item.rack_id,
-                "status": "PENDING"
-            }
-            
-            result = await db.batches.insert_one(batch_doc)
-            batch_ids.append(str(result.inserted_id))
-            
-            # Accumulate totals
-            purchase_totals["taxable"] += line_calc["taxable"]
-            purchase_totals["cgst"] += line_calc["cgst"]
-            purchase_totals["sgst"] += line_calc["sgst"]
-            purchase_totals["igst"] += line_calc["igst"]
-            purchase_totals["post_tax_discount"] += line_calc["post_tax_discount"]
-            purchase_totals["net_payable"] += line_calc["row_net"]
-            
-            # Store processed item (create PurchaseItem structure)
-            processed_item = {
-                "product_id": item.product_id,
-                "batch_id": str(result.inserted_id),
-                "billed_qty": item.billed_qty,
-                "free_qty": item.free_qty,
-                "gst_rate": item.gst_rate,
-                "scheme_pct": item.scheme_pct,
-                "cash_pct": item.cash_pct,
-                "mrp": item.mrp,
-                "trade_price_ex_tax": item.trade_price_ex_tax,
-                "hsn": item.hsn,
-                "rack_id": item.rack_id,
-                "schedule_symbol": item.schedule_symbol,
-                "taxable": line_calc["taxable"],
-                "cgst": line_calc["cgst"],
-                "sgst": line_calc["sgst"], 
-                "igst": line_calc["igst"],
-                "row_net": line_calc["row_net"]
-            }
-            processed_items.append(processed_item)
-        
-        # Round totals
-        for key in purchase_totals:
-            purchase_totals[key] = round(purchase_totals[key], 2)
-        
-        # Create purchase record
-        purchase_doc = {
-            "id": str(uuid.uuid4()),
-            "invoice_no": purchase.invoice_no,
-            "invoice_date": purchase.invoice_date,
-            "supplier_id": purchase.supplier_id,
-            "type": purchase.type,
-            "items": processed_items,
-            "batch_ids": batch_ids,
-            "totals": purchase_totals,
-            "created_by": current_user["user_id"],
-            "status": "PENDING",
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
-        }
         
-        result = await db.purchases.insert_one(purchase_doc)
-        purchase_doc["id"] = str(result.inserted_id)
+        purchase_doc, batch_docs = build_purchase_documents(
+            is_intra,
+            [item.dict() for item in purchase.items],
+            {
+                "invoice_no": purchase.invoice_no,
+                "invoice_date": purchase.invoice_date,
+                "supplier_id": purchase.supplier_id,
+                "type": purchase.type
+            },
+            current_user
+        )
+        await insert_purchase(purchase_doc, batch_docs)
         
         return {
             "id": purchase_doc["id"],
             "status": "PENDING",
-            "totals": purchase_totals,
+            "totals": purchase_doc["totals"],
             "message": "Purchase created successfully. Awaiting approval."
         }
         
@@ -208,31 +235,260 @@ async def create_purchase(purchase: PurchaseCreate, current_user: dict = Depends
         logging.error(f"Error creating purchase: {e}")
         raise HTTPException(status_code=500, detail="Error creating purchase")
 
-@router.post("/{purchase_id}/approve", status_code=200)
-async def approve_purchase(purchase_id: str, current_user: dict = Depends(get_current_user)):
-    """Approve purchase and commit to inventory"""
-    check_approval_rights(current_user["role"])
+# Largest distributor file accepted by the import endpoint
+MAX_IMPORT_BYTES = 10 * 1024 * 1024
+MAX_IMPORT_LINES = 5000
+IMPORT_READ_CHUNK = 64 * 1024
+
+# Lines per validation task; files up to one chunk are validated in-process
+IMPORT_VALIDATION_CHUNK = 250
+PURCHASE_IMPORT_WORKERS = int(os.environ.get("PURCHASE_IMPORT_WORKERS", "2"))
+
+# Most line errors reported back for a rejected file
+MAX_REPORTED_IMPORT_ERRORS = 100
+
+_import_pool: Optional[ProcessPoolExecutor] = None
+
+def get_import_pool() -> ProcessPoolExecutor:
+    global _import_pool
+    if _import_pool is None:
+        _import_pool = ProcessPoolExecutor(max_workers=PURCHASE_IMPORT_WORKERS)
+    return _import_pool
+
+def shutdown_import_pool():
+    global _import_pool
+    if _import_pool is not None:
+        _import_pool.shutdown(wait=False, cancel_futures=True)
+        _import_pool = None
+
+async def read_upload(file: UploadFile) -> bytes:
+    """Read an upload in chunks, refusing it as soon as it passes MAX_IMPORT_BYTES"""
+    chunks = []
+    size = 0
+    while True:
+        chunk = await file.read(IMPORT_READ_CHUNK)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_IMPORT_BYTES:
+            raise HTTPException(status_code=413, detail="File exceeds the 10MB import limit")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+async def validate_import_rows(rows: List[Dict]) -> List[Tuple[int, Optional[Dict], List[str]]]:
+    """Validate file rows (numbered from 1), spreading large files over the worker pool"""
+    numbered = list(enumerate(rows, start=1))
+    if len(numbered) <= IMPORT_VALIDATION_CHUNK:
+        return validate_purchase_lines(numbered)
+    
+    loop = asyncio.get_running_loop()
+    pool = get_import_pool()
+    chunks = await asyncio.gather(*[
+        loop.run_in_executor(pool, validate_purchase_lines, numbered[start:start + IMPORT_VALIDATION_CHUNK])
+        for start in range(0, len(numbered), IMPORT_VALIDATION_CHUNK)
+    ])
+    return [result for chunk in chunks for result in chunk]
+
+# Brand first words per regex when looking products up by name
+IMPORT_NAME_QUERY_CHUNK = 200
+
+def brand_prefix_query(names: List[str]) -> List[Dict]:
+    """
+    brand_name conditions matching every product whose brand starts with the
+    first word of one of the names (case-insensitive), chunked so no single
+    regex grows with the file
+    """
+    first_words = sorted({name.split()[0] for name in names if name})
+    conditions = []
+    for start in range(0, len(first_words), IMPORT_NAME_QUERY_CHUNK):
+        words = "|".join(re.escape(word) for word in first_words[start:start + IMPORT_NAME_QUERY_CHUNK])
+        conditions.append({"brand_name": {"$regex": f"^[^a-zA-Z0-9]*(?:{words})", "$options": "i"}})
+    return conditions
+
+async def resolve_import_products(lines: List[Tuple[int, Dict]]) -> List[str]:
+    """
+    Fill product_id on validated lines from the product master in bulk
+    Lines are matched by normalized "brand strength form" or brand name;
+    when several products share a name the line's HSN picks between them.
+    Only products named on the file are read: given ids, plus products whose
+    brand starts with a line's first word. Returns an error per line that
+    could not be matched or carries a malformed product id.
+    """
+    product_ids = []
+    names = []
+    for _, line in lines:
+        if not line["product_id"]:
+            names.append(normalize_text(line["product_name"]))
+        elif ObjectId.is_valid(str(line["product_id"])):
+            product_ids.append(ObjectId(str(line["product_id"])))
+    
+    conditions = brand_prefix_query(names)
+    if product_ids:
+        conditions.append({"_id": {"$in": product_ids}})
+    
+    known_ids = set()
+    by_name: Dict[str, List[Dict]] = {}
+    if conditions:
+        projection = {"brand_name": 1, "strength": 1, "form": 1, "hsn": 1}
+        async for product in db.products.find({"$or": conditions}, projection):
+            known_ids.add(str(product["_id"]))
+            for key in product_name_keys(product):
+                by_name.setdefault(key, []).append(product)
+    
+    errors = []
+    for line_no, line in lines:
+        if line["product_id"]:
+            if not ObjectId.is_valid(str(line["product_id"])):
+                errors.append(f"Line {line_no}: invalid product_id {line['product_id']}")
+            elif str(line["product_id"]) not in known_ids:
+                errors.append(f"Line {line_no}: product {line['product_id']} not found")
+            continue
+        
+        candidates = by_name.get(normalize_text(line["product_name"]), [])
+        if line["hsn"]:
+            candidates = [product for product in candidates if product.get("hsn") == line["hsn"]]
+        if len(candidates) == 1:
+            line["product_id"] = str(candidates[0]["_id"])
+        elif not candidates:
+            errors.append(f"Line {line_no}: no product matches '{line['product_name']}'")
+        else:
+            errors.append(f"Line {line_no}: '{line['product_name']}' matches {len(candidates)} products")
+    return errors
+
+@router.post("/import", response_model=dict, status_code=201)
+async def import_purchase(
+    supplier_id: str,
+    file: UploadFile = File(...),
+    invoice_no: Optional[str] = None,
+    invoice_date: Optional[str] = None,
+    purchase_type: str = "CREDIT",
+    dry_run: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Create a PENDING purchase from a distributor CSV or GST e-invoice JSON file
+    
+    CSV needs a header row (product/hsn/batch/expiry/qty/free/mrp/rate/gst
+    columns); e-invoice JSON supplies invoice_no and invoice_date from
+    DocDtls unless given. Nothing is written unless every line validates and
+    resolves to a product; dry_run=true only reports the outcome.
+    """
+    check_pharmacy_access(current_user["role"])
     
     try:
-        # Get purchase
-        purchase = await db.purchases.find_one({"_id": purchase_id})
-        if not purchase:
-            raise HTTPException(status_code=404, detail="Purchase not found")
+        supplier = await db.suppliers.find_one({"_id": supplier_id})
+        if not supplier:
+            raise HTTPException(status_code=404, detail="Supplier not found")
         
-        if purchase.get("status") != "PENDING":
-            raise HTTPException(status_code=400, detail="Purchase is not pending approval")
+        content = await read_upload(file)
+        try:
+            text = content.decode("utf-8-sig")
+            if (file.filename or "").lower().endswith(".json") or text.lstrip().startswith("{"):
+                rows, file_header = parse_einvoice_json(text)
+            else:
+                rows, file_header = parse_purchase_csv(text), {}
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="File must be UTF-8 encoded")
+        except PurchaseFileError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        # Commit all batches to inventory via stock ledger
-        for batch_id in purchase["batch_ids"]:
-            batch = await db.batches.find_one({"_id": batch_id})
-            if not batch:
-                continue
-            
-            # Create stock ledger entry
-            stock_entry = {
+        if not rows:
+            raise HTTPException(status_code=400, detail="File has no purchase lines")
+        if len(rows) > MAX_IMPORT_LINES:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_IMPORT_LINES} lines per import")
+        
+        invoice_no = invoice_no or file_header.get("invoice_no")
+        invoice_date = invoice_date or file_header.get("invoice_date")
+        if not invoice_no or not invoice_date:
+            raise HTTPException(status_code=400, detail="invoice_no and invoice_date are required")
+        
+        errors = []
+        lines = []
+        for line_no, line, line_errors in await validate_import_rows(rows):
+            if line_errors:
+                errors.append(f"Line {line_no}: {'; '.join(line_errors)}")
+            else:
+                lines.append((line_no, line))
+        errors.extend(await resolve_import_products(lines))
+        
+        if errors:
+            raise HTTPException(status_code=422, detail={
+                "message": f"{len(errors)} line error(s); nothing was imported",
+                "errors": errors[:MAX_REPORTED_IMPORT_ERRORS]
+            })
+        
+        purchase_doc, batch_docs = build_purchase_documents(
+            is_supplier_intra_kerala(supplier.get("state", "")),
+            [line for _, line in lines],
+            {
+                "invoice_no": invoice_no,
+                "invoice_date": invoice_date,
+                "supplier_id": supplier_id,
+                "type": purchase_type,
+                "source_file": file.filename
+            },
+            current_user
+        )
+        if dry_run:
+            return {
+                "id": None,
+                "status": "VALIDATED",
+                "lines": len(batch_docs),
+                "totals": purchase_doc["totals"],
+                "message": "File is valid. Nothing was imported (dry run)."
+            }
+        
+        await insert_purchase(purchase_doc, batch_docs)
+        
+        return {
+            "id": purchase_doc["id"],
+            "status": "PENDING",
+            "lines": len(batch_docs),
+            "totals": purchase_doc["totals"],
+            "message": "Purchase imported successfully. Awaiting approval."
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error importing purchase: {e}")
+        raise HTTPException(status_code=500, detail="Error importing purchase")
+
+# Most purchases one bulk approval request may carry
+MAX_BULK_APPROVALS = 100
+
+class PurchaseNotPendingError(Exception):
+    """Raised when a purchase was approved or rejected by someone else first"""
+
+async def commit_purchase_approval(purchase_id: str, current_user: dict) -> int:
+    """
+    Commit a pending purchase's batches to inventory in one transaction
+    Returns the number of batches posted to the stock ledger
+    """
+    async def commit_approval(session):
+        now = datetime.utcnow()
+        
+        # Flip the status first so two approvers can never post the same invoice twice
+        purchase = await db.purchases.find_one_and_update(
+            {"_id": purchase_id, "status": "PENDING"},
+            {
+                "$set": {
+                    "status": "APPROVED",
+                    "approved_by": current_user["user_id"],
+                    "approved_at": now,
+                    "updated_at": now
+                }
+            },
+            session=session
+        )
+        if not purchase:
+            raise PurchaseNotPendingError(purchase_id)
+        
+        batches = await fetch_by_ids(db.batches, purchase["batch_ids"], session=session)
+        stock_entries = [
+            {
                 "id": str(uuid.uuid4()),
                 "product_id": batch["product_id"],
-                "batch_id": batch_id,
+                "batch_id": batch["_id"],
                 "txn_type": "PURCHASE",
                 "qty_in": batch["received_qty"] + batch.get("free_qty", 0),
                 "qty_out": 0,
@@ -240,41 +496,106 @@ async def approve_purchase(purchase_id: str, current_user: dict = Depends(get_cu
                 "mrp": batch["mrp"],
                 "ref_type": "PURCHASE",
                 "ref_id": purchase_id,
-                "created_at": datetime.utcnow()
+                "created_at": now
             }
+            for batch in ordered_by_ids(batches, purchase["batch_ids"])
+        ]
+        
+        posted = False
+        try:
+            await post_ledger_entries(stock_entries, session=session)
+            posted = True
             
-            await db.stock_ledger.insert_one(stock_entry)
+            if batches:
+                await db.batches.update_many(
+                    {"_id": {"$in": list(batches)}},
+                    {"$set": {"status": "APPROVED", "updated_at": now}},
+                    session=session
+                )
             
-            # Update batch status
-            await db.batches.update_one(
-                {"_id": batch_id},
-                {"$set": {"status": "APPROVED", "updated_at": datetime.utcnow()}}
-            )
+            await db.audits.insert_one({
+                "actor_id": current_user["user_id"],
+                "role": current_user["role"],
+                "action": "APPROVE_PURCHASE",
+                "entity": "PURCHASE",
+                "entity_id": purchase_id,
+                "after": {"status": "APPROVED"},
+                "created_at": now
+            }, session=session)
+        except Exception:
+            if session is None:
+                # No transaction to roll back; undo every step so the purchase can be approved again
+                await db.stock_ledger.delete_many({"id": {"$in": [entry["id"] for entry in stock_entries]}})
+                if posted and stock_entries:
+                    await db.stock_balances.bulk_write(build_balance_updates([
+                        dict(entry, qty_in=0, qty_out=entry["qty_in"]) for entry in stock_entries
+                    ]), ordered=False)
+                if batches:
+                    await db.batches.update_many(
+                        {"_id": {"$in": list(batches)}},
+                        {"$set": {"status": "PENDING", "updated_at": now}}
+                    )
+                await db.purchases.update_one(
+                    {"_id": purchase_id},
+                    {"$set": {"status": "PENDING"}, "$unset": {"approved_by": "", "approved_at": ""}}
+                )
+            raise
         
-        # Update purchase status
-        await db.purchases.update_one(
-            {"_id": purchase_id},
-            {
-                "$set": {
-                    "status": "APPROVED",
-                    "approved_by": current_user["user_id"],
-                    "approved_at": datetime.utcnow(),
-                    "updated_at": datetime.utcnow()
-                }
-            }
+        return len(stock_entries)
+    
+    return await db.run_in_transaction(commit_approval)
+
+@router.post("/approve", status_code=200)
+async def bulk_approve_purchases(
+    purchase_ids: List[str] = Body(..., embed=True),
+    current_user: dict = Depends(get_current_user)
+):
+    """Approve several pending purchases
+    
+    Each purchase commits in its own transaction, so one failure does not
+    hold back the rest
+    """
+    check_approval_rights(current_user["role"])
+    
+    purchase_ids = list(dict.fromkeys(purchase_ids))
+    if len(purchase_ids) > MAX_BULK_APPROVALS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BULK_APPROVALS} purchases can be approved at once"
         )
+    
+    approved = []
+    failed = []
+    for purchase_id in purchase_ids:
+        try:
+            batch_count = await commit_purchase_approval(purchase_id, current_user)
+            approved.append({"id": purchase_id, "batches": batch_count})
+        except PurchaseNotPendingError:
+            failed.append({"id": purchase_id, "detail": "Purchase not found or not pending approval"})
+        except Exception as e:
+            logging.error(f"Error approving purchase {purchase_id}: {e}")
+            failed.append({"id": purchase_id, "detail": "Error approving purchase"})
+    
+    return {"approved": approved, "failed": failed}
+
+@router.post("/{purchase_id}/approve", status_code=200)
+async def approve_purchase(purchase_id: str, current_user: dict = Depends(get_current_user)):
+    """Approve purchase and commit to inventory"""
+    check_approval_rights(current_user["role"])
+    
+    try:
+        # Get purchase
+        purchase = await db.purchases.find_one({"_id": purchase_id}, {"status": 1})
+        if not purchase:
+            raise HTTPException(status_code=404, detail="Purchase not found")
         
-        # Create audit entry
-        audit_entry = {
-            "actor_id": current_user["user_id"],
-            "role": current_user["role"],
-            "action": "APPROVE_PURCHASE",
-            "entity": "PURCHASE",
-            "entity_id": purchase_id,
-            "after": {"status": "APPROVED"},
-            "created_at": datetime.utcnow()
-        }
-        await db.audits.insert_one(audit_entry)
+        if purchase.get("status") != "PENDING":
+            raise HTTPException(status_code=400, detail="Purchase is not pending approval")
+        
+        try:
+            await commit_purchase_approval(purchase_id, current_user)
+        except PurchaseNotPendingError:
+            raise HTTPException(status_code=400, detail="Purchase is not pending approval")
         
         return {"message": "Purchase approved successfully"}
         
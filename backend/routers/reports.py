@@ -0,0 +1,348 @@
+# routers/reports.py
+from fastapi import APIRouter, HTTPException, Depends
+from typing import Dict, List, Optional
+from datetime import datetime, timedelta
+import logging
+from bson import ObjectId
+
+from deps.auth import get_current_user
+from deps.db import db
+from deps.rollups import REPORT_UTC_OFFSET_MINUTES, DAY_FORMAT, days_between, report_timezone
+from utils.joins import fetch_by_ids
+from utils.money import money_fields, stored_paise_expression
+
+router = APIRouter(prefix="/api/pharmacy/reports", tags=["reports"])
+
+# Longest range one GST summary request may cover
+MAX_REPORT_MONTHS = 24
+
+# Cached gst_monthly_rollups from another version are recomputed; bump it
+# whenever the way a month is summarised changes (2: supply type from is_intra)
+GST_ROLLUP_VERSION = 2
+
+# Longest range one sales dashboard request may cover
+MAX_DASHBOARD_DAYS = 731
+MAX_TOP_PRODUCTS = 50
+
+TAX_HEADS = ("taxable", "cgst", "sgst", "igst")
+
+# sales_daily counters and paise amounts (without the _paise suffix)
+DAY_COUNTERS = ("sales_count", "lines_count", "items_count", "returns_count", "returned_items_count")
+DAY_AMOUNTS = ("revenue", "taxable", "cgst", "sgst", "igst", "discount", "refund")
+
+def check_report_access(user_role: str):
+    """Check report access"""
+    if user_role not in ["admin", "pharmacist"]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+
+def parse_month(month: str) -> datetime:
+    return datetime.strptime(month, "%Y-%m")
+
+def next_month(month_start: datetime) -> datetime:
+    return (month_start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def month_bounds(start_month: str, end_month: str):
+    """UTC instants covering local start_month through end_month inclusive"""
+    offset = timedelta(minutes=REPORT_UTC_OFFSET_MINUTES)
+    return parse_month(start_month) - offset, next_month(parse_month(end_month)) - offset
+
+def months_between(start_month: str, end_month: str) -> List[str]:
+    months = []
+    current = parse_month(start_month)
+    last = parse_month(end_month)
+    while current <= last:
+        months.append(current.strftime("%Y-%m"))
+        current = next_month(current)
+    return months
+
+def current_month() -> str:
+    return (datetime.utcnow() + timedelta(minutes=REPORT_UTC_OFFSET_MINUTES)).strftime("%Y-%m")
+
+def month_expression(date_field: str) -> Dict:
+    return {"$dateToString": {"format": "%Y-%m", "date": date_field, "timezone": report_timezone()}}
+
+def tax_head_sums(paths: Dict[str, str]) -> Dict:
+    """$group accumulators summing each tax head as integer paise"""
+    return {head: {"$sum": stored_paise_expression(path)} for head, path in paths.items()}
+
+def supply_type_expression(is_intra_path: str, igst_path: str) -> Dict:
+    """
+    INTRA (CGST + SGST) or INTER from the invoice's stored is_intra, so
+    zero-rated and exempt lines land on the right side; documents written
+    before is_intra was stored fall back to whether the line carries IGST
+    """
+    return {"$switch": {
+        "branches": [
+            {"case": {"$eq": [is_intra_path, True]}, "then": "INTRA"},
+            {"case": {"$eq": [is_intra_path, False]}, "then": "INTER"}
+        ],
+        "default": {"$cond": [{"$gt": [stored_paise_expression(igst_path), 0]}, "INTER", "INTRA"]}
+    }}
+
+async def aggregate_outward(start: datetime, end: datetime) -> List[Dict]:
+    """Sales by month, GST rate and supply type"""
+    pipeline = [
+        {"$match": {"created_at": {"$gte": start, "$lt": end}}},
+        {"$group": {
+            "_id": {
+                "month": month_expression("$created_at"),
+                "gst_rate": "$gst_rate",
+                "supply": supply_type_expression("$is_intra", "$igst")
+            },
+            **tax_head_sums({
+                "taxable": "$base_ex_tax", "cgst": "$cgst", "sgst": "$sgst", "igst": "$igst"
+            }),
+            "lines": {"$sum": 1}
+        }}
+    ]
+    return await db.sale_items.aggregate(pipeline).to_list(length=None)
+
+async def aggregate_inward(start: datetime, end: datetime) -> List[Dict]:
+    """Approved purchases (input tax credit) by approval month, GST rate and supply type"""
+    pipeline = [
+        {"$match": {"status": "APPROVED", "approved_at": {"$gte": start, "$lt": end}}},
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": {
+                "month": month_expression("$approved_at"),
+                "gst_rate": "$items.gst_rate",
+                "supply": supply_type_expression("$is_intra", "$items.igst")
+            },
+            **tax_head_sums({
+                "taxable": "$items.taxable", "cgst": "$items.cgst",
+                "sgst": "$items.sgst", "igst": "$items.igst"
+            }),
+            "lines": {"$sum": 1}
+        }}
+    ]
+    return await db.purchases.aggregate(pipeline).to_list(length=None)
+
+async def aggregate_credit_notes(start: datetime, end: datetime) -> List[Dict]:
+    """Approved sales returns by month"""
+    pipeline = [
+        {"$match": {"status": "APPROVED", "date_time": {"$gte": start, "$lt": end}}},
+        {"$group": {
+            "_id": {"month": month_expression("$date_time")},
+            **tax_head_sums({
+                "taxable": "$totals.base_reversed", "cgst": "$totals.cgst_rev",
+                "sgst": "$totals.sgst_rev", "igst": "$totals.igst_rev"
+            }),
+            "returns": {"$sum": 1}
+        }}
+    ]
+    return await db.returns.aggregate(pipeline).to_list(length=None)
+
+def rate_rows(rows: List[Dict]) -> List[Dict]:
+    return sorted(
+        [
+            {
+                "gst_rate": row["_id"]["gst_rate"],
+                "supply": row["_id"]["supply"],
+                "lines": row["lines"],
+                **money_fields({head: row[head] for head in TAX_HEADS})
+            }
+            for row in rows
+        ],
+        key=lambda row: (row["supply"], row["gst_rate"] or 0)
+    )
+
+def head_totals(rows: List[Dict]) -> Dict[str, int]:
+    return {head: sum(row[head] for row in rows) for head in TAX_HEADS}
+
+async def compute_gst_months(start_month: str, end_month: str) -> Dict[str, Dict]:
+    """GST summary documents for every month in the range, computed in MongoDB"""
+    start, end = month_bounds(start_month, end_month)
+    outward = await aggregate_outward(start, end)
+    inward = await aggregate_inward(start, end)
+    credit_notes = await aggregate_credit_notes(start, end)
+    
+    months = {}
+    for month in months_between(start_month, end_month):
+        month_outward = [row for row in outward if row["_id"]["month"] == month]
+        month_inward = [row for row in inward if row["_id"]["month"] == month]
+        month_credits = [row for row in credit_notes if row["_id"]["month"] == month]
+        
+        outward_totals = head_totals(month_outward)
+        inward_totals = head_totals(month_inward)
+        credit_totals = head_totals(month_credits)
+        
+        months[month] = {
+            "_id": month,
+            "month": month,
+            "version": GST_ROLLUP_VERSION,
+            "outward": rate_rows(month_outward),
+            "outward_totals": money_fields(outward_totals),
+            "credit_notes": money_fields(credit_totals),
+            "credit_note_count": sum(row["returns"] for row in month_credits),
+            "inward": rate_rows(month_inward),
+            "inward_totals": money_fields(inward_totals),
+            # GSTR-3B style: output tax less credit notes less input tax credit
+            "net_tax_payable": money_fields({
+                head: outward_totals[head] - credit_totals[head] - inward_totals[head]
+                for head in ("cgst", "sgst", "igst")
+            }),
+            "computed_at": datetime.utcnow()
+        }
+    return months
+
+@router.get("/gst-summary", response_model=dict)
+async def get_gst_summary(
+    start_month: str,
+    end_month: str,
+    refresh: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """GST summary by month, GST rate and intra/inter-state supply (YYYY-MM months)
+    
+    Closed months are served from gst_monthly_rollups once computed; pass
+    refresh=true to recompute them (e.g. after a late purchase approval)
+    """
+    check_report_access(current_user["role"])
+    
+    try:
+        months = months_between(start_month, end_month)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Months must be in YYYY-MM format")
+    if not months:
+        raise HTTPException(status_code=400, detail="start_month must not be after end_month")
+    if len(months) > MAX_REPORT_MONTHS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_REPORT_MONTHS} months per report")
+    
+    try:
+        open_month = current_month()
+        summaries = {}
+        if not refresh:
+            cursor = db.gst_monthly_rollups.find({
+                "_id": {"$in": [m for m in months if m < open_month]},
+                "version": GST_ROLLUP_VERSION
+            })
+            async for rollup in cursor:
+                summaries[rollup["_id"]] = rollup
+        
+        missing = [month for month in months if month not in summaries]
+        if missing:
+            computed = await compute_gst_months(missing[0], missing[-1])
+            for month in missing:
+                summary = computed[month]
+                summaries[month] = summary
+                # Only closed months are final enough to cache
+                if month < open_month:
+                    await db.gst_monthly_rollups.replace_one({"_id": month}, summary, upsert=True)
+        
+        results = []
+        for month in months:
+            summary = dict(summaries[month])
+            summary.pop("_id", None)
+            summary.pop("version", None)
+            summary["closed"] = month < open_month
+            results.append(summary)
+        
+        return {"months": results}
+    
+    except Exception as e:
+        logging.error(f"Error building GST summary: {e}")
+        raise HTTPException(status_code=500, detail="Error building GST summary")
+
+def current_day() -> str:
+    return (datetime.utcnow() + timedelta(minutes=REPORT_UTC_OFFSET_MINUTES)).strftime(DAY_FORMAT)
+
+def rollup_summary(rollup: Dict) -> Dict:
+    """Counters and rupee/paise amounts of a sales_daily document (or a sum of them)"""
+    amounts = {field: rollup.get(f"{field}_paise", 0) for field in DAY_AMOUNTS}
+    amounts["net_revenue"] = amounts["revenue"] - amounts["refund"]
+    return {
+        **{field: rollup.get(field, 0) for field in DAY_COUNTERS},
+        **money_fields(amounts)
+    }
+
+@router.get("/sales-dashboard", response_model=dict)
+async def get_sales_dashboard(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    top: int = 10,
+    current_user: dict = Depends(get_current_user)
+):
+    """Daily revenue, item counts, payment-mode split and top products (YYYY-MM-DD dates)
+    
+    Reads only the sales_daily rollup, one document per day in the range;
+    defaults to the last 30 days
+    """
+    check_report_access(current_user["role"])
+    
+    end_date = end_date or current_day()
+    try:
+        start_date = start_date or (datetime.strptime(end_date, DAY_FORMAT) - timedelta(days=29)).strftime(DAY_FORMAT)
+        days = days_between(start_date, end_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be in YYYY-MM-DD format")
+    if not days:
+        raise HTTPException(status_code=400, detail="start_date must not be after end_date")
+    if len(days) > MAX_DASHBOARD_DAYS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_DASHBOARD_DAYS} days per dashboard")
+    top = max(0, min(top, MAX_TOP_PRODUCTS))
+    
+    try:
+        rollups = {}
+        async for rollup in db.sales_daily.find({"_id": {"$gte": start_date, "$lte": end_date}}):
+            rollups[rollup["_id"]] = rollup
+        
+        totals = {field: 0 for field in DAY_COUNTERS}
+        totals.update({f"{field}_paise": 0 for field in DAY_AMOUNTS})
+        payments: Dict[str, int] = {}
+        products: Dict[str, Dict[str, int]] = {}
+        for rollup in rollups.values():
+            for field in DAY_COUNTERS:
+                totals[field] += rollup.get(field, 0)
+            for field in DAY_AMOUNTS:
+                totals[f"{field}_paise"] += rollup.get(f"{field}_paise", 0)
+            for mode, paise in rollup.get("payments", {}).items():
+                payments[mode] = payments.get(mode, 0) + paise
+            for product_id, counts in rollup.get("products", {}).items():
+                product = products.setdefault(product_id, {})
+                for field, value in counts.items():
+                    product[field] = product.get(field, 0) + value
+        
+        # Best sellers by revenue net of refunds
+        ranked = sorted(
+            products.items(),
+            key=lambda entry: entry[1].get("net_paise", 0) - entry[1].get("refund_paise", 0),
+            reverse=True
+        )[:top]
+        # Rollups key products by str(_id); products created through the API
+        # have ObjectId _ids, so both forms are looked up
+        product_refs = []
+        for product_id, _ in ranked:
+            product_refs.append(product_id)
+            if ObjectId.is_valid(str(product_id)):
+                product_refs.append(ObjectId(str(product_id)))
+        found = await fetch_by_ids(
+            db.products, product_refs, projection={"brand_name": 1, "strength": 1, "form": 1}
+        )
+        names = {str(product_ref): product for product_ref, product in found.items()}
+        top_products = []
+        for product_id, counts in ranked:
+            product = names.get(product_id, {})
+            net_paise = counts.get("net_paise", 0)
+            refund_paise = counts.get("refund_paise", 0)
+            top_products.append({
+                "product_id": product_id,
+                "product_name": " ".join(
+                    str(product[field]) for field in ("brand_name", "strength", "form") if product.get(field)
+                ),
+                "qty": counts.get("qty", 0),
+                "returned_qty": counts.get("returned_qty", 0),
+                **money_fields({"net": net_paise, "refund": refund_paise, "net_revenue": net_paise - refund_paise})
+            })
+        
+        return {
+            "start_date": start_date,
+            "end_date": end_date,
+            "totals": rollup_summary(totals),
+            "days": [{"date": day, **rollup_summary(rollups.get(day, {}))} for day in days],
+            "payment_modes": money_fields(payments),
+            "top_products": top_products
+        }
+    
+    except Exception as e:
+        logging.error(f"Error building sales dashboard: {e}")
+        raise HTTPException(status_code=500, detail="Error building sales dashboard")
@@ -1,25 +1,22 @@
 # routers/returns.py
 from fastapi import APIRouter, HTTPException, Depends, status
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 import uuid
 import logging
+from pymongo import ReturnDocument
 
+from deps.auth import get_current_user
 from deps.db import db
+from deps.rollups import record_return
+from deps.stock import build_balance_updates, post_ledger_entries
+from utils.joins import fetch_by_ids, ordered_by_ids
 from models import Return, ReturnCreate, ReturnItem
+from utils.gst import calc_return_invoice
+from utils.money import money_fields
 from utils.schedule import requires_prescription, can_override_schedule
 
 router = APIRouter(prefix="/api/pharmacy/returns", tags=["returns"])
-security = HTTPBearer()
-
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get current user from JWT token"""
-    return {
-        "user_id": "current_user_id",
-        "username": "current_user", 
-        "role": "pharmacist"
-    }
 
 def check_pharmacy_access(user_role: str):
     """Check pharmacy access"""
@@ -48,21 +45,22 @@ async def get_returns(
                 "$lte": datetime.fromisoformat(end_date)
             }
         
-        returns_cursor = db.returns.find(query).sort("date_time", -1)
-        returns = []
+        returns = await db.returns.find(query).sort("date_time", -1).to_list(length=None)
+        
+        # Get original sale details with one query
+        sales = await fetch_by_ids(
+            db.sales, [return_doc["sale_id"] for return_doc in returns], {"patient.name": 1, "date_time": 1}
+        )
         
-        async for return_doc in returns_cursor:
+        for return_doc in returns:
             return_doc["id"] = str(return_doc["_id"])
             
-            # Get original sale details
-            sale = await db.sales.find_one({"_id": return_doc["sale_id"]})
+            sale = sales.get(return_doc["sale_id"])
             if sale:
                 return_doc["original_sale"] = {
                     "patient_name": sale["patient"]["name"],
                     "sale_date": sale["date_time"].isoformat()
                 }
-            
-            returns.append(return_doc)
         
         return returns
         
@@ -70,6 +68,46 @@ async def get_returns(
         logging.error(f"Error fetching returns: {e}")
         raise HTTPException(status_code=500, detail="Error fetching returns")
 
+class ReturnQuantityExceededError(Exception):
+    """Raised when a guarded returned_qty increment would exceed the quantity sold"""
+    
+    def __init__(self, sale_item_id: str):
+        self.sale_item_id = sale_item_id
+        super().__init__(f"Return exceeds quantity sold for sale item {sale_item_id}")
+
+async def claim_returned_quantities(quantities: Dict[str, int], session=None) -> Dict[str, int]:
+    """
+    Add to each sale item's returned_qty only while the total stays within nos
+    Concurrent returns against the same bill can therefore never refund more
+    than was sold. Returns each item's returned_qty as the claim found it,
+    which is where this return's share of the refund starts.
+    """
+    claimed = {}
+    try:
+        for sale_item_id, qty in quantities.items():
+            before = await db.sale_items.find_one_and_update(
+                {
+                    "_id": sale_item_id,
+                    "$expr": {"$lte": [{"$add": [{"$ifNull": ["$returned_qty", 0]}, qty]}, "$nos"]}
+                },
+                {"$inc": {"returned_qty": qty}},
+                projection={"returned_qty": 1},
+                return_document=ReturnDocument.BEFORE,
+                session=session
+            )
+            if before is None:
+                raise ReturnQuantityExceededError(sale_item_id)
+            claimed[sale_item_id] = before.get("returned_qty", 0)
+    except Exception:
+        if session is None:
+            await release_returned_quantities({sale_item_id: quantities[sale_item_id] for sale_item_id in claimed})
+        raise
+    return claimed
+
+async def release_returned_quantities(quantities: Dict[str, int]):
+    for sale_item_id, qty in quantities.items():
+        await db.sale_items.update_one({"_id": sale_item_id}, {"$inc": {"returned_qty": -qty}})
+
 @router.post("", response_model=dict, status_code=201)
 async def create_return(return_data: ReturnCreate, current_user: dict = Depends(get_current_user)):
     """Create sales return"""
@@ -86,94 +124,91 @@ async def create_return(return_data: ReturnCreate, current_user: dict = Depends(
         if sale.get("schedule_compliance", {}).get("required"):
             has_scheduled_items = True
         
-        # Process return items
-        return_items = []
-        return_totals = {
-            "base_reversed": 0.0,
-            "cgst_rev": 0.0,
-            "sgst_rev": 0.0,  
-            "igst_rev": 0.0,
-            "net_refund": 0.0
-        }
+        # Fetch every returned sale item with one query; membership is checked
+        # against the sale's own items list (older sale items carry no sale_id)
+        sale_item_ids = set(sale.get("items", []))
+        sale_items = await fetch_by_ids(
+            db.sale_items, [item_return["sale_item_id"] for item_return in return_data.items]
+        )
         
+        # Validate return items against the original sale items; a line may
+        # appear more than once, so limits are checked on the totals
+        sold_items = []
+        quantities: Dict[str, int] = {}
         for item_return in return_data.items:
             sale_item_id = item_return["sale_item_id"]
             qty_returned = item_return["qty_returned"]
-            batch_id = item_return["batch_id"]
             
-            # Get original sale item
-            sale_item = await db.sale_items.find_one({"_id": sale_item_id})
-            if not sale_item:
+            sale_item = sale_items.get(sale_item_id)
+            if not sale_item or sale_item_id not in sale_item_ids:
                 raise HTTPException(
                     status_code=404, 
                     detail=f"Sale item {sale_item_id} not found"
                 )
             
-            # Validate return quantity
-            if qty_returned > sale_item["nos"]:
+            if item_return.get("batch_id", sale_item["batch_id"]) != sale_item["batch_id"]:
                 raise HTTPException(
                     status_code=400,
-                    detail=f"Cannot return {qty_returned} items. Original quantity: {sale_item['nos']}"
+                    detail=f"Sale item {sale_item_id} was sold from batch {sale_item['batch_id']}"
                 )
             
-            # Calculate proportional refund amounts
-            proportion = qty_returned / sale_item["nos"]
-            base_reversed = sale_item["base_ex_tax"] * proportion
-            cgst_rev = sale_item["cgst"] * proportion
-            sgst_rev = sale_item["sgst"] * proportion
-            igst_rev = sale_item["igst"] * proportion
-            net_refund = sale_item["net"] * proportion
+            if qty_returned <= 0:
+                raise HTTPException(status_code=400, detail="Return quantity must be positive")
             
-            return_item = {
-                "sale_item_id": sale_item_id,
-                "batch_id": batch_id,
-                "qty_returned": qty_returned,
-                "base_reversed": round(base_reversed, 2),
-                "cgst_rev": round(cgst_rev, 2),
-                "sgst_rev": round(sgst_rev, 2),
-                "igst_rev": round(igst_rev, 2),
-                "net_refund": round(net_refund, 2)
-            }
-            return_items.append(return_item)
+            quantities[sale_item_id] = quantities.get(sale_item_id, 0) + qty_returned
             
-            # Accumulate totals
-            return_totals["base_reversed"] += base_reversed
-            return_totals["cgst_rev"] += cgst_rev
-            return_totals["sgst_rev"] += sgst_rev
-            return_totals["igst_rev"] += igst_rev
-            return_totals["net_refund"] += net_refund
+            sold_items.append(sale_item)
+        
+        # Validate return quantity against what is still returnable (checked
+        # again atomically when the return is committed)
+        for sale_item_id, qty in quantities.items():
+            sale_item = sale_items[sale_item_id]
+            returnable = sale_item["nos"] - sale_item.get("returned_qty", 0)
+            if qty > returnable:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Cannot return {qty} items. Original quantity: {sale_item['nos']}, returnable: {returnable}"
+                )
+        
+        # Pre-generate the return id so ledger rows carry it from the start
+        return_id = str(uuid.uuid4())
+        now = datetime.utcnow()
+        
+        # Process return items
+        return_items = []
+        stock_entries = []
+        for item_return, sale_item in zip(return_data.items, sold_items):
+            return_items.append({
+                "sale_item_id": sale_item["_id"],
+                "batch_id": sale_item["batch_id"],
+                "qty_returned": item_return["qty_returned"]
+            })
             
             # Create stock ledger entry (return to inventory)
-            stock_entry = {
+            stock_entries.append({
                 "id": str(uuid.uuid4()),
                 "product_id": sale_item["product_id"],
-                "batch_id": batch_id,
+                "batch_id": sale_item["batch_id"],
                 "txn_type": "RETURN_IN",
-                "qty_in": qty_returned,
+                "qty_in": item_return["qty_returned"],
                 "qty_out": 0,
                 "cost_per_unit": None,  # Not applicable for returns
                 "mrp": sale_item["mrp"],
                 "ref_type": "RETURN",
-                "ref_id": "",  # Will be set after return creation
-                "created_at": datetime.utcnow()
-            }
-            await db.stock_ledger.insert_one(stock_entry)
-        
-        # Round totals
-        for key in return_totals:
-            return_totals[key] = round(return_totals[key], 2)
+                "ref_id": return_id,
+                "created_at": now
+            })
         
-        # Create return record
+        # Create return record (refund amounts are added when the quantities are claimed)
         return_doc = {
-            "id": str(uuid.uuid4()),
+            "_id": return_id,
+            "id": return_id,
             "sale_id": return_data.sale_id,
             "bill_no": return_data.bill_no,
-            "date_time": datetime.utcnow(),
-            "items": return_items,
-            "totals": return_totals,
+            "date_time": now,
             "reason": return_data.reason,
             "created_by": current_user["user_id"],
-            "created_at": datetime.utcnow()
+            "created_at": now
         }
         
         # If scheduled items, require approval or link to original prescription
@@ -194,15 +229,6 @@ async def create_return(return_data: ReturnCreate, current_user: dict = Depends(
             return_doc["status"] = "APPROVED"
             return_doc["approved_by"] = current_user["user_id"]
         
-        result = await db.returns.insert_one(return_doc)
-        return_id = str(result.inserted_id)
-        
-        # Update stock ledger entries with return reference
-        await db.stock_ledger.update_many(
-            {"ref_type": "RETURN", "ref_id": ""},
-            {"$set": {"ref_id": return_id}}
-        )
-        
         # Create audit entry
         audit_entry = {
             "actor_id": current_user["user_id"],
@@ -210,15 +236,60 @@ async def create_return(return_data: ReturnCreate, current_user: dict = Depends(
             "action": "CREATE_RETURN",
             "entity": "RETURN",
             "entity_id": return_id,
-            "after": {"totals": return_totals, "status": return_doc["status"]},
-            "created_at": datetime.utcnow()
+            "after": {"status": return_doc["status"]},
+            "created_at": now
         }
-        await db.audits.insert_one(audit_entry)
+        
+        # Claim the quantities, restock and record the return together
+        async def commit_return(session):
+            returned_before = await claim_returned_quantities(quantities, session=session)
+            
+            # Calculate proportional refund amounts for every line in one pass (exact
+            # paise), starting from returned_qty as the guarded claim found it so
+            # a concurrent partial return cannot shift this one's allocation
+            refunds = calc_return_invoice([
+                dict(sale_item, qty_returned=return_item["qty_returned"], returned_qty=returned_before[sale_item["_id"]])
+                for return_item, sale_item in zip(return_items, sold_items)
+            ])
+            return_doc["items"] = [
+                dict(return_item, **money_fields(refund))
+                for return_item, refund in zip(return_items, refunds["lines"])
+            ]
+            return_doc["totals"] = audit_entry["after"]["totals"] = money_fields(refunds["totals"])
+            
+            posted = False
+            try:
+                await post_ledger_entries(stock_entries, session=session)
+                posted = True
+                await db.returns.insert_one(return_doc, session=session)
+            except Exception:
+                if session is None:
+                    # No transaction to roll back; take the ledger rows and restocked quantities out again
+                    await db.stock_ledger.delete_many({"id": {"$in": [entry["id"] for entry in stock_entries]}})
+                    if posted and stock_entries:
+                        await db.stock_balances.bulk_write(build_balance_updates([
+                            dict(entry, qty_in=0, qty_out=entry["qty_in"]) for entry in stock_entries
+                        ]), ordered=False)
+                    await release_returned_quantities(quantities)
+                raise
+            
+            # Pending returns reach the daily rollup when approved
+            if return_doc["status"] == "APPROVED":
+                await record_return(return_doc, sale_items, session=session)
+            await db.audits.insert_one(audit_entry, session=session)
+        
+        try:
+            await db.run_in_transaction(commit_return)
+        except ReturnQuantityExceededError as e:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Sale item {e.sale_item_id} was returned concurrently; not enough quantity left to return"
+            )
         
         return {
             "id": return_id,
             "status": return_doc["status"],
-            "totals": return_totals,
+            "totals": return_doc["totals"],
             "message": "Return created successfully" + (
                 " - Pending approval for scheduled items" if return_doc["status"] == "PENDING_APPROVAL" else ""
             )
@@ -244,9 +315,9 @@ async def approve_return(return_id: str, current_user: dict = Depends(get_curren
         if return_doc.get("status") != "PENDING_APPROVAL":
             raise HTTPException(status_code=400, detail="Return is not pending approval")
         
-        # Update return status
-        await db.returns.update_one(
-            {"_id": return_id},
+        # Update return status (guarded so a double approval is counted once)
+        result = await db.returns.update_one(
+            {"_id": return_id, "status": "PENDING_APPROVAL"},
             {
                 "$set": {
                     "status": "APPROVED",
@@ -255,6 +326,15 @@ async def approve_return(return_id: str, current_user: dict = Depends(get_curren
                 }
             }
         )
+        if result.modified_count == 0:
+            raise HTTPException(status_code=400, detail="Return is not pending approval")
+        
+        sold_items = await fetch_by_ids(
+            db.sale_items,
+            [item["sale_item_id"] for item in return_doc["items"]],
+            projection={"product_id": 1}
+        )
+        await record_return(return_doc, sold_items)
         
         # Create audit entry
         audit_entry = {
@@ -282,36 +362,44 @@ async def search_sale_for_return(bill_no: str, current_user: dict = Depends(get_
     check_pharmacy_access(current_user["role"])
     
     try:
-        # Find sale by bill number
-        sale = await db.sales.find_one({"bill_no": bill_no})
-        if not sale:
+        # Sale, its items and their products in one round trip; returned
+        # quantities come from the returned_qty counter on each sale item
+        results = await db.sales.aggregate([
+            {"$match": {"bill_no": bill_no}},
+            {"$limit": 1},
+            {"$lookup": {
+                "from": "sale_items",
+                "localField": "items",
+                "foreignField": "_id",
+                "as": "item_docs"
+            }},
+            {"$lookup": {
+                "from": "products",
+                "localField": "item_docs.product_id",
+                "foreignField": "_id",
+                "as": "product_docs"
+            }}
+        ]).to_list(length=1)
+        if not results:
             raise HTTPException(status_code=404, detail="Sale not found")
         
+        sale = results[0]
+        item_docs = sale.pop("item_docs")
+        products = {product["_id"]: product for product in sale.pop("product_docs")}
         sale["id"] = str(sale["_id"])
         
-        # Get sale items with product details
         items = []
-        for item_id in sale.get("items", []):
-            item = await db.sale_items.find_one({"_id": item_id})
-            if item:
-                item["id"] = str(item["_id"])
-                
-                # Get product details
-                product = await db.products.find_one({"_id": item["product_id"]})
-                if product:
-                    item["product_name"] = f"{product['brand_name']} {product['strength']} {product['form']}"
-                    item["chemical_name"] = product["chemical_name"]
-                
-                # Check if already returned (partial tracking)
-                existing_returns = await db.returns.find({"sale_id": str(sale["_id"])}).to_list(length=None)
-                returned_qty = 0
-                for ret in existing_returns:
-                    for ret_item in ret.get("items", []):
-                        if ret_item["sale_item_id"] == str(item["_id"]):
-                            returned_qty += ret_item["qty_returned"]
-                
-                item["available_for_return"] = item["nos"] - returned_qty
-                items.append(item)
+        for item in ordered_by_ids({item["_id"]: item for item in item_docs}, sale.get("items", [])):
+            item["id"] = str(item["_id"])
+            
+            product = products.get(item["product_id"])
+            if product:
+                item["product_name"] = f"{product['brand_name']} {product['strength']} {product['form']}"
+                item["chemical_name"] = product["chemical_name"]
+            
+            item["returned_qty"] = item.get("returned_qty", 0)
+            item["available_for_return"] = item["nos"] - item["returned_qty"]
+            items.append(item)
         
         return {
             "sale": sale,
@@ -1,26 +1,29 @@
 # routers/sales.py
 from fastapi import APIRouter, HTTPException, Depends, status
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 from datetime import datetime
 import uuid
 import logging
 
+from deps.auth import get_current_user
 from deps.db import db
+from deps.rollups import record_sale
+from deps.stock import (
+    InsufficientStockError, InsufficientProductStockError, allocate_fefo,
+    post_outgoing_ledger_entries, get_available_stocks,
+    claim_cart_reservations, held_quantities, release_expired_reservations,
+    reserve_stock, release_reservation, release_cart
+)
 from models import Sale, SaleCreate, SaleResponse, SaleItem, SaleItemCreate, Payment
-from utils.gst import calc_sale_mrp_inclusive, calc_sale_rate_exclusive, is_supplier_intra_kerala
+from utils.joins import fetch_by_ids, ordered_by_ids
+from utils.gst import calc_sale_invoice, split_sale_line, is_supplier_intra_kerala
+from utils.money import money_fields, to_paise, to_rupees
 from utils.schedule import requires_prescription, validate_schedule_compliance, can_override_schedule
 
 router = APIRouter(prefix="/api/pharmacy/sales", tags=["sales"])
-security = HTTPBearer()
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get current user from JWT token"""
-    return {
-        "user_id": "current_user_id",
-        "username": "current_user",
-        "role": "pharmacist"
-    }
+# How many times a sale re-allocates batches lost to a concurrent sale
+FEFO_ALLOCATION_ATTEMPTS = 3
 
 def check_pharmacy_access(user_role: str):
     """Check pharmacy access"""
@@ -78,9 +81,91 @@ async def get_sales(
         logging.error(f"Error fetching sales: {e}")
         raise HTTPException(status_code=500, detail="Error fetching sales")
 
+async def build_sale_lines(
+    sale: SaleCreate,
+    sale_id: str,
+    line_calcs: List[Dict],
+    splits: List[List[Tuple[str, int]]],
+    is_intra: bool,
+    now: datetime
+) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Sale item documents and outgoing ledger rows for a bill
+    Each requested line is written once per (batch_id, qty) in its split, with
+    its calculated amounts apportioned across the parts so totals do not move
+    """
+    # Fetch every batch on the bill with one query; stock itself is checked
+    # by the guarded decrement when the sale is committed
+    batch_ids = list({batch_id for split in splits for batch_id, _ in split})
+    batches = await fetch_by_ids(db.batches, batch_ids, projection={"effective_cost_per_unit": 1})
+    
+    for batch_id in batch_ids:
+        if batch_id not in batches:
+            raise HTTPException(status_code=400, detail=f"Batch {batch_id} not found")
+    
+    sale_items = []
+    stock_entries = []
+    
+    for item_data, line_calc, split in zip(sale.items, line_calcs, splits):
+        parts = split_sale_line(line_calc, [qty for _, qty in split])
+        for (batch_id, qty), part in zip(split, parts):
+            batch = batches[batch_id]
+            
+            # Create sale item
+            sale_item_id = str(uuid.uuid4())
+            sale_items.append({
+                "_id": sale_item_id,
+                "id": sale_item_id,
+                "sale_id": sale_id,
+                "product_id": item_data.product_id,
+                "batch_id": batch_id,
+                "nos": qty,
+                "pricing_mode": item_data.pricing_mode,
+                "rate_ex_tax": item_data.rate_ex_tax,
+                "mrp": item_data.mrp,
+                "mrp_discount_pct": item_data.mrp_discount_pct,
+                "gst_rate": item_data.gst_rate,
+                "is_intra": is_intra,
+                "schedule_symbol": item_data.schedule_symbol,
+                **money_fields({
+                    "base_ex_tax": part["taxable"],
+                    "cgst": part["cgst"],
+                    "sgst": part["sgst"],
+                    "igst": part["igst"],
+                    "net": part["net"]
+                }),
+                "created_at": now
+            })
+            
+            # Create stock ledger entry (reduce stock)
+            stock_entries.append({
+                "id": str(uuid.uuid4()),
+                "product_id": item_data.product_id,
+                "batch_id": batch_id,
+                "txn_type": "SALE",
+                "qty_in": 0,
+                "qty_out": qty,
+                "cost_per_unit": batch["effective_cost_per_unit"],
+                "mrp": item_data.mrp,
+                "ref_type": "SALE",
+                "ref_id": sale_id,
+                "created_at": now
+            })
+    
+    return sale_items, stock_entries
+
 @router.post("", response_model=dict, status_code=201)
-async def create_sale(sale: SaleCreate, current_user: dict = Depends(get_current_user)):
-    """Create new sale with schedule compliance validation"""
+async def create_sale(
+    sale: SaleCreate,
+    cart_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Create new sale with schedule compliance validation
+    
+    Pass the cart_id used for stock reservations to bill the stock it holds.
+    Items sent without a batch_id are allocated first-expiry-first-out and
+    may be split across several batches; the response lists the lines billed.
+    """
     check_pharmacy_access(current_user["role"])
     
     try:
@@ -117,162 +202,138 @@ async def create_sale(sale: SaleCreate, current_user: dict = Depends(get_current
                         detail=f"Compliance errors: {', '.join(compliance_errors)}"
                     )
         
-        # Validate payments equal net amount
-        payment_total = sum(sale.payments.values())
+        # Payments arrive in rupees; everything below is checked in integer paise
+        payments_paise = {payment_type: to_paise(amount) for payment_type, amount in sale.payments.items()}
         
-        # Calculate sale totals and process items
+        # Calculate every line and the sale totals in one pass (exact paise)
         is_intra = is_intra_customer()
-        sale_totals = {
-            "mrp_total": 0.0,
-            "discount_on_mrp": 0.0,
-            "taxable": 0.0,
-            "cgst": 0.0,
-            "sgst": 0.0,
-            "igst": 0.0,
-            "net": 0.0
-        }
-        
-        sale_item_ids = []
-        
-        for item_data in sale.items:
-            # Get batch information for stock validation
-            batch = await db.batches.find_one({"_id": item_data.batch_id})
-            if not batch:
-                raise HTTPException(status_code=400, detail=f"Batch {item_data.batch_id} not found")
-            
-            # Check stock availability
-            stock_cursor = db.stock_ledger.find({"batch_id": item_data.batch_id})
-            available_stock = 0
-            async for stock_entry in stock_cursor:
-                available_stock += stock_entry.get("qty_in", 0) - stock_entry.get("qty_out", 0)
-            
-            if available_stock < item_data.nos:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Insufficient stock for batch {item_data.batch_id}. Available: {available_stock}"
-                )
-            
-            # Calculate line totals
-            if item_data.pricing_mode == "MRP_INC":
-                line_calc = calc_sale_mrp_inclusive(
-                    is_intra=is_intra,
-                    qty=item_data.nos,
-                    mrp=item_data.mrp,
-                    mrp_discount_pct=item_data.mrp_discount_pct,
-                    gst_rate=item_data.gst_rate
-                )
-            else:
-                line_calc = calc_sale_rate_exclusive(
-                    is_intra=is_intra,
-                    qty=item_data.nos,
-                    rate_ex_tax=item_data.rate_ex_tax or 0,
-                    gst_rate=item_data.gst_rate
-                )
-            
-            # Create sale item
-            sale_item = {
-                "id": str(uuid.uuid4()),
-                "product_id": item_data.product_id,
-                "batch_id": item_data.batch_id,
-                "nos": item_data.nos,
+        invoice = calc_sale_invoice(is_intra, [
+            {
+                "qty": item_data.nos,
                 "pricing_mode": item_data.pricing_mode,
-                "rate_ex_tax": item_data.rate_ex_tax,
                 "mrp": item_data.mrp,
                 "mrp_discount_pct": item_data.mrp_discount_pct,
-                "gst_rate": item_data.gst_rate,
-                "schedule_symbol": item_data.schedule_symbol,
-                "base_ex_tax": line_calc["base_ex_tax"],
-                "cgst": line_calc["cgst"],
-                "sgst": line_calc["sgst"],
-                "igst": line_calc["igst"],
-                "net": line_calc["net"],
-                "created_at": datetime.utcnow()
-            }
-            
-            result = await db.sale_items.insert_one(sale_item)
-            sale_item_ids.append(str(result.inserted_id))
-            
-            # Accumulate totals
-            sale_totals["mrp_total"] += item_data.mrp * item_data.nos
-            if item_data.pricing_mode == "MRP_INC":
-                sale_totals["discount_on_mrp"] += line_calc.get("discount_amount", 0)
-            sale_totals["taxable"] += line_calc["base_ex_tax"]
-            sale_totals["cgst"] += line_calc["cgst"]
-            sale_totals["sgst"] += line_calc["sgst"]
-            sale_totals["igst"] += line_calc["igst"]
-            sale_totals["net"] += line_calc["net"]
-            
-            # Create stock ledger entry (reduce stock)
-            stock_entry = {
-                "id": str(uuid.uuid4()),
-                "product_id": item_data.product_id,
-                "batch_id": item_data.batch_id,
-                "txn_type": "SALE",
-                "qty_in": 0,
-                "qty_out": item_data.nos,
-                "cost_per_unit": batch["effective_cost_per_unit"],
-                "mrp": item_data.mrp,
-                "ref_type": "SALE",
-                "ref_id": "",  # Will be set after sale creation
-                "created_at": datetime.utcnow()
+                "rate_ex_tax": item_data.rate_ex_tax,
+                "gst_rate": item_data.gst_rate
             }
-            await db.stock_ledger.insert_one(stock_entry)
+            for item_data in sale.items
+        ])
+        sale_totals = money_fields(invoice["totals"])
         
-        # Round totals
-        for key in sale_totals:
-            sale_totals[key] = round(sale_totals[key], 2)
+        # Pre-generate ids so every document can reference the sale before it exists
+        sale_id = str(uuid.uuid4())
+        now = datetime.utcnow()
         
-        # Validate payment total matches net
-        if abs(payment_total - sale_totals["net"]) > 0.01:  # Allow 1 paisa difference for rounding
+        # Validate payment total matches net exactly
+        payment_total_paise = sum(payments_paise.values())
+        if payment_total_paise != invoice["totals"]["net"]:
             raise HTTPException(
                 status_code=400,
-                detail=f"Payment total ({payment_total}) must equal net amount ({sale_totals['net']})"
+                detail=f"Payment total ({to_rupees(payment_total_paise)}) must equal net amount ({sale_totals['net']})"
             )
         
         # Create payment records
-        payment_ids = []
-        for payment_type, amount in sale.payments.items():
-            if amount > 0:
-                payment = {
-                    "id": str(uuid.uuid4()),
+        payments = []
+        for payment_type, amount_paise in payments_paise.items():
+            if amount_paise > 0:
+                payment_id = str(uuid.uuid4())
+                amount = to_rupees(amount_paise)
+                payments.append({
+                    "_id": payment_id,
+                    "id": payment_id,
+                    "sale_id": sale_id,
                     "split": {payment_type: amount},
                     "amount": amount,
-                    "received_at": datetime.utcnow()
-                }
-                result = await db.payments.insert_one(payment)
-                payment_ids.append(str(result.inserted_id))
+                    "amount_paise": amount_paise,
+                    "received_at": now
+                })
         
-        # Create sale record
-        sale_doc = {
-            "id": str(uuid.uuid4()),
-            "bill_no": sale.bill_no,
-            "date_time": datetime.fromisoformat(sale.date_time),
-            "mode": sale.mode,
-            "doctor_name": sale.doctor_name,
-            "opd_no": sale.opd_no,
-            "patient": sale.patient.dict(),
-            "items": sale_item_ids,
-            "payments": payment_ids,
-            "schedule_compliance": sale.compliance.dict() if sale.compliance else None,
-            "totals": sale_totals,
-            "time_to_serve_seconds": sale.time_to_serve_seconds,
-            "created_by": current_user["user_id"],
-            "created_at": datetime.utcnow()
-        }
+        # Lines sent without a batch_id are filled first-expiry-first-out,
+        # split across as many batches as it takes
+        auto_lines = [index for index, item_data in enumerate(sale.items) if not item_data.batch_id]
         
-        result = await db.sales.insert_one(sale_doc)
-        sale_id = str(result.inserted_id)
+        # Lapsed carts still count against available stock until released
+        await release_expired_reservations()
         
-        # Update stock ledger entries with sale reference
-        await db.stock_ledger.update_many(
-            {"ref_type": "SALE", "ref_id": ""},
-            {"$set": {"ref_id": sale_id}}
-        )
+        for attempt in range(FEFO_ALLOCATION_ATTEMPTS):
+            splits = [[(item_data.batch_id, item_data.nos)] for item_data in sale.items]
+            allocated_batch_ids = set()
+            if auto_lines:
+                try:
+                    allocations = await allocate_fefo(
+                        [(sale.items[index].product_id, sale.items[index].nos) for index in auto_lines]
+                    )
+                except InsufficientProductStockError as e:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Insufficient stock for product {e.product_id}. Available: {e.available}"
+                    )
+                for index, allocation in zip(auto_lines, allocations):
+                    splits[index] = allocation
+                    allocated_batch_ids.update(batch_id for batch_id, _ in allocation)
+            
+            sale_items, stock_entries = await build_sale_lines(
+                sale, sale_id, invoice["lines"], splits, is_intra, now
+            )
+            
+            # Create sale record
+            sale_doc = {
+                "_id": sale_id,
+                "id": sale_id,
+                "bill_no": sale.bill_no,
+                "date_time": datetime.fromisoformat(sale.date_time),
+                "mode": sale.mode,
+                "doctor_name": sale.doctor_name,
+                "opd_no": sale.opd_no,
+                "patient": sale.patient.dict(),
+                "items": [item["_id"] for item in sale_items],
+                "payments": [payment["_id"] for payment in payments],
+                "schedule_compliance": sale.compliance.dict() if sale.compliance else None,
+                "is_intra": is_intra,
+                "totals": sale_totals,
+                "time_to_serve_seconds": sale.time_to_serve_seconds,
+                "created_by": current_user["user_id"],
+                "created_at": now
+            }
+            
+            # Commit items, ledger rows, payments, the sale and its daily rollup together
+            async def commit_sale(session):
+                claimed = await claim_cart_reservations(cart_id, session=session) if cart_id else []
+                try:
+                    await post_outgoing_ledger_entries(
+                        stock_entries, held=held_quantities(claimed), session=session
+                    )
+                except Exception:
+                    if session is None and claimed:
+                        await db.stock_reservations.insert_many(claimed)
+                    raise
+                await db.sale_items.insert_many(sale_items, session=session)
+                if payments:
+                    await db.payments.insert_many(payments, session=session)
+                await db.sales.insert_one(sale_doc, session=session)
+                await record_sale(sale_doc, sale_items, payments, session=session)
+            
+            try:
+                await db.run_in_transaction(commit_sale)
+                break
+            except InsufficientStockError as e:
+                # Another counter sold a batch we allocated since we read it; allocate again
+                if e.batch_id in allocated_batch_ids and attempt + 1 < FEFO_ALLOCATION_ATTEMPTS:
+                    continue
+                available = (await get_available_stocks([e.batch_id]))[e.batch_id]
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Insufficient stock for batch {e.batch_id}. Available: {available}"
+                )
         
         return {
             "id": sale_id,
             "bill_no": sale.bill_no,
             "totals": sale_totals,
+            "items": [
+                {"id": item["_id"], "product_id": item["product_id"], "batch_id": item["batch_id"], "nos": item["nos"]}
+                for item in sale_items
+            ],
             "message": "Sale created successfully"
         }
         
@@ -282,6 +343,65 @@ async def create_sale(sale: SaleCreate, current_user: dict = Depends(get_current
         logging.error(f"Error creating sale: {e}")
         raise HTTPException(status_code=500, detail="Error creating sale")
 
+@router.post("/reservations", response_model=dict, status_code=201)
+async def create_stock_reservation(
+    cart_id: str,
+    batch_id: str,
+    qty: int,
+    current_user: dict = Depends(get_current_user)
+):
+    """Hold stock of a batch for a cart being built at the billing counter"""
+    check_pharmacy_access(current_user["role"])
+    
+    if qty <= 0:
+        raise HTTPException(status_code=400, detail="Reservation quantity must be positive")
+    
+    try:
+        reservation = await reserve_stock(cart_id, batch_id, qty, current_user["user_id"])
+        return {
+            "id": reservation["id"],
+            "cart_id": cart_id,
+            "batch_id": batch_id,
+            "qty": qty,
+            "expires_at": reservation["expires_at"].isoformat()
+        }
+    except InsufficientStockError:
+        available = (await get_available_stocks([batch_id]))[batch_id]
+        raise HTTPException(
+            status_code=400,
+            detail=f"Insufficient stock for batch {batch_id}. Available: {available}"
+        )
+    except Exception as e:
+        logging.error(f"Error reserving stock: {e}")
+        raise HTTPException(status_code=500, detail="Error reserving stock")
+
+@router.delete("/reservations/{reservation_id}", status_code=200)
+async def delete_stock_reservation(reservation_id: str, current_user: dict = Depends(get_current_user)):
+    """Release a single reservation (item removed from cart)"""
+    check_pharmacy_access(current_user["role"])
+    
+    try:
+        if not await release_reservation(reservation_id):
+            raise HTTPException(status_code=404, detail="Reservation not found or already released")
+        return {"message": "Reservation released"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error releasing reservation: {e}")
+        raise HTTPException(status_code=500, detail="Error releasing reservation")
+
+@router.delete("/reservations/cart/{cart_id}", status_code=200)
+async def delete_cart_reservations(cart_id: str, current_user: dict = Depends(get_current_user)):
+    """Release everything a cart holds (cart cleared or abandoned)"""
+    check_pharmacy_access(current_user["role"])
+    
+    try:
+        released = await release_cart(cart_id)
+        return {"message": f"Released {released} reservation(s)", "released": released}
+    except Exception as e:
+        logging.error(f"Error releasing cart reservations: {e}")
+        raise HTTPException(status_code=500, detail="Error releasing cart reservations")
+
 @router.get("/{sale_id}", response_model=dict)
 async def get_sale_details(sale_id: str, current_user: dict = Depends(get_current_user)):
     """Get detailed sale information including items"""
@@ -295,28 +415,29 @@ async def get_sale_details(sale_id: str, current_user: dict = Depends(get_curren
         
         sale["id"] = str(sale["_id"])
         
-        # Get sale items
+        # Get sale items, their products and payments with one query per collection
+        item_docs = await fetch_by_ids(db.sale_items, sale.get("items", []))
+        products = await fetch_by_ids(
+            db.products, [item["product_id"] for item in item_docs.values()],
+            {"brand_name": 1, "strength": 1, "form": 1, "chemical_name": 1}
+        )
+        payment_docs = await fetch_by_ids(db.payments, sale.get("payments", []))
+        
         items = []
-        for item_id in sale.get("items", []):
-            item = await db.sale_items.find_one({"_id": item_id})
-            if item:
-                item["id"] = str(item["_id"])
-                
-                # Get product details
-                product = await db.products.find_one({"_id": item["product_id"]})
-                if product:
-                    item["product_name"] = f"{product['brand_name']} {product['strength']} {product['form']}"
-                    item["chemical_name"] = product["chemical_name"]
-                
-                items.append(item)
+        for item in ordered_by_ids(item_docs, sale.get("items", [])):
+            item["id"] = str(item["_id"])
+            
+            product = products.get(item["product_id"])
+            if product:
+                item["product_name"] = f"{product['brand_name']} {product['strength']} {product['form']}"
+                item["chemical_name"] = product["chemical_name"]
+            
+            items.append(item)
         
-        # Get payments
         payments = []
-        for payment_id in sale.get("payments", []):
-            payment = await db.payments.find_one({"_id": payment_id})
-            if payment:
-                payment["id"] = str(payment["_id"])
-                payments.append(payment)
+        for payment in ordered_by_ids(payment_docs, sale.get("payments", [])):
+            payment["id"] = str(payment["_id"])
+            payments.append(payment)
         
         return {
             "sale": sale,
@@ -17,7 +17,7 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from models import UserNew, UserCreateNew, UserUpdateNew, Doctor, DoctorCreate, Nurse, NurseCreate
-from auth import get_admin_user
+from auth import get_admin_user, run_password_job
 
 # Get the admin dependency function
 verify_admin_role = get_admin_user()
@@ -29,10 +29,13 @@ def get_database():
     from server import database
     return database
 
-def hash_password(password: str) -> str:
-    """Hash a password using bcrypt"""
+def _hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
+async def hash_password(password: str) -> str:
+    """Hash a password using bcrypt on the password hashing pool"""
+    return await run_password_job(_hash_password, password)
+
 @router.get("/", response_model=List[dict])
 async def get_users(
     role: Optional[str] = None,
@@ -181,7 +184,7 @@ async def create_user(
             raise HTTPException(status_code=400, detail=f"Invalid department ID: {dept_id}")
     
     # Hash password
-    password_hash = hash_password(user_data.password)
+    password_hash = await hash_password(user_data.password)
     
     # Create user document
     user_doc = {
@@ -394,7 +397,7 @@ async def reset_password(
         raise HTTPException(status_code=404, detail="User not found")
     
     # Hash new password
-    password_hash = hash_password(new_password)
+    password_hash = await hash_password(new_password)
     
     # Update password
     await db.users.update_one(
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Stress test for the sequence allocator
+Fires many concurrent allocations from several simulated workers against a
+scratch counter and checks that every issued number is unique.
+Usage: python sequence_stress_test.py [--calls N] [--workers N] [--block-size N]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from motor.motor_asyncio import AsyncIOMotorClient
+
+# Add backend directory to path
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, backend_dir)
+
+from deps.sequences import SequenceAllocator
+
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/unicare_ehr")
+
+async def run(database, counter: dict, calls: int, workers: int, block_size: int) -> bool:
+    # Each allocator stands in for one server process with its own leases
+    allocators = [
+        SequenceAllocator(block_size=block_size, leased_types={counter["type"]}, database=database)
+        for _ in range(workers)
+    ]
+    
+    started = time.perf_counter()
+    values = await asyncio.gather(*[
+        allocators[i % workers].next_value(counter) for i in range(calls)
+    ])
+    elapsed = time.perf_counter() - started
+    
+    duplicates = len(values) - len(set(values))
+    mode = f"leased blocks of {block_size}" if block_size > 1 else "single increments"
+    print(f"{mode}: {calls} numbers from {workers} workers in {elapsed:.2f}s "
+          f"({calls / elapsed:.0f}/s), {duplicates} duplicate(s)")
+    return duplicates == 0
+
+async def main(args) -> int:
+    client = AsyncIOMotorClient(MONGO_URL)
+    database = client.get_default_database()
+    counter_type = f"stress-{uuid.uuid4().hex[:8]}"
+    
+    try:
+        ok = await run(database, {"type": counter_type, "year": 1}, args.calls, args.workers, 1)
+        ok &= await run(database, {"type": counter_type, "year": 2}, args.calls, args.workers, args.block_size)
+        print("✅ All numbers unique" if ok else "❌ Duplicate numbers issued")
+        return 0 if ok else 1
+    finally:
+        await database.sequences.delete_many({"type": counter_type})
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--block-size", type=int, default=50)
+    sys.exit(asyncio.run(main(parser.parse_args())))
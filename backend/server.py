@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
@@ -16,8 +16,13 @@ from pathlib import Path
 # Import our models and auth
 from models import *
 from auth import *
+from utils.pagination import (
+    NEXT_CURSOR_HEADER, InvalidPageRequestError, fetch_page, parse_date_range
+)
+from deps.auth import invalidate_user_cache
+from deps.sequences import next_sequence
 # Import pharmacy routers
-from routers import pharmacy, purchases, sales, inventory, returns, disposals
+from routers import pharmacy, purchases, sales, inventory, returns, disposals, exports, reports
 # Import new comprehensive system routers - temporarily disabled due to import issues
 try:
     from routers import departments_new, users_new
@@ -39,6 +44,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 # Include pharmacy routers
@@ -48,6 +54,8 @@ app.include_router(sales.router)
 app.include_router(inventory.router)
 app.include_router(returns.router)
 app.include_router(disposals.router)
+app.include_router(exports.router)
+app.include_router(reports.router)
 
 # Include new comprehensive system routers - temporarily disabled due to import issues
 if ADMIN_ROUTERS_AVAILABLE:
@@ -93,13 +101,37 @@ async def create_db_client():
         except Exception as e:
             logging.warning(f"Could not set database for pharmacy routers: {e}")
         
+        # Apply the index registry and report anything that still differs
+        try:
+            from deps.indexes import ensure_indexes
+            index_drift = await ensure_indexes(database)
+            for collection, report in index_drift.items():
+                logging.warning(f"Index drift on {collection}: {report}")
+            logging.info("Index registry applied")
+        except Exception as e:
+            logging.warning(f"Could not apply index registry: {e}")
+        
+        # Existing databases keep stock in stock_ledger only until balances are built
+        try:
+            from deps.stock import ensure_stock_balances
+            await ensure_stock_balances()
+        except Exception as e:
+            logging.error(f"Could not build stock_balances; run rebuild_stock_balances.py before billing: {e}")
+        
+        # Nightly near-expiry snapshot for the pharmacy
+        try:
+            from deps.expiry import start_near_expiry_scheduler
+            start_near_expiry_scheduler()
+        except Exception as e:
+            logging.warning(f"Could not start near-expiry snapshot job: {e}")
+        
         # Initialize default admin user
         existing_admin = await database.users.find_one({"username": "admin"})
         if not existing_admin:
             admin_user = {
                 "id": str(uuid.uuid4()),
                 "username": "admin",
-                "password_hash": get_password_hash("admin_007"),
+                "password_hash": await get_password_hash_async("admin_007"),
                 "full_name": "System Administrator",
                 "role": UserRole.ADMIN,
                 "department": "Administration",
@@ -270,6 +302,13 @@ async def shutdown_db_client():
     global mongodb_client
     if mongodb_client:
         mongodb_client.close()
+    shutdown_password_pool()
+    purchases.shutdown_import_pool()
+    try:
+        from deps.expiry import stop_near_expiry_scheduler
+        stop_near_expiry_scheduler()
+    except Exception as e:
+        logging.warning(f"Could not stop near-expiry snapshot job: {e}")
 
 # Auth dependency
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -288,17 +327,7 @@ async def get_next_opd_number():
     current_year = datetime.utcnow().year
     year_suffix = str(current_year)[-2:]
     
-    sequence_doc = await database.sequences.find_one({"type": "opd", "year": current_year})
-    
-    if not sequence_doc:
-        next_number = 1
-        await database.sequences.insert_one({"type": "opd", "year": current_year, "current": next_number})
-    else:
-        next_number = sequence_doc["current"] + 1
-        await database.sequences.update_one(
-            {"type": "opd", "year": current_year},
-            {"$set": {"current": next_number}}
-        )
+    next_number = await next_sequence({"type": "opd", "year": current_year})
     
     return f"{str(next_number).zfill(3)}/{year_suffix}"
 
@@ -306,36 +335,33 @@ async def get_next_token_number():
     """Generate next token number for today"""
     today = datetime.utcnow().date()
     
-    sequence_doc = await database.sequences.find_one({"type": "token", "date": today.isoformat()})
-    
-    if not sequence_doc:
-        next_number = 1
-        await database.sequences.insert_one({"type": "token", "date": today.isoformat(), "current": next_number})
-    else:
-        next_number = sequence_doc["current"] + 1
-        await database.sequences.update_one(
-            {"type": "token", "date": today.isoformat()},
-            {"$set": {"current": next_number}}
-        )
+    next_number = await next_sequence({"type": "token", "date": today.isoformat()})
     
     return str(next_number)
 
 async def get_next_bill_number():
     """Generate next bill number"""
-    sequence_doc = await database.sequences.find_one({"type": "bill"})
-    
-    if not sequence_doc:
-        next_number = 1
-        await database.sequences.insert_one({"type": "bill", "current": next_number})
-    else:
-        next_number = sequence_doc["current"] + 1
-        await database.sequences.update_one(
-            {"type": "bill"},
-            {"$set": {"current": next_number}}
-        )
+    next_number = await next_sequence({"type": "bill"})
     
     return f"BILL{str(next_number).zfill(6)}"
 
+async def fetch_list_page(collection, sort_field: str, response: Response, limit: Optional[int],
+                          cursor: Optional[str], start_date: Optional[str] = None,
+                          end_date: Optional[str] = None, query: Optional[dict] = None):
+    """
+    Fetch one keyset page newest first; the next page's cursor goes in a response header
+    Requests without limit or cursor get the whole list, as before paging
+    """
+    query = dict(query or {})
+    date_range = parse_date_range(start_date, end_date)
+    if date_range:
+        query[sort_field] = date_range
+    
+    documents, next_cursor = await fetch_page(collection, query, sort_field, limit, cursor)
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return documents
+
 # ===================
 # AUTHENTICATION APIS
 # ===================
@@ -344,12 +370,20 @@ async def get_next_bill_number():
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.utcnow()}
 
+@app.get("/api/admin/metrics/password-hashing")
+async def get_password_hashing_metrics(current_user: dict = Depends(get_current_user)):
+    """Password hashing pool activity (queue depth, wait and run times)"""
+    if not has_admin_access(current_user["role"]):
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    return password_hash_metrics()
+
 @app.post("/api/auth/login", response_model=Token)
 async def login(user_data: UserLogin):
     # Check if user exists
     user = await database.users.find_one({"username": user_data.username, "status": "active"})
     
-    if not user or not verify_password(user_data.password, user["password_hash"]):
+    if not user or not await verify_password_async(user_data.password, user["password_hash"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid username or password",
@@ -410,7 +444,7 @@ async def create_user(user_data: UserCreate, current_user: dict = Depends(get_cu
         # Create new user
         user_dict = user_data.dict()
         user_dict["id"] = str(uuid.uuid4())
-        user_dict["password_hash"] = get_password_hash(user_data.password)
+        user_dict["password_hash"] = await get_password_hash_async(user_data.password)
         del user_dict["password"]  # Remove plain password
         user_dict["created_at"] = datetime.utcnow()
         user_dict["updated_at"] = datetime.utcnow()
@@ -440,6 +474,9 @@ async def update_user_status(user_id: str, status: UserStatus, current_user: dic
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="User not found")
         
+        # Pharmacy routers cache user status; drop the stale entry right away
+        invalidate_user_cache(user_id)
+        
         return {"message": f"User status updated to {status}"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error updating user status: {str(e)}")
@@ -449,16 +486,26 @@ async def update_user_status(user_id: str, status: UserStatus, current_user: dic
 # ===================
 
 @app.get("/api/patients", response_model=List[Patient])
-async def get_patients(current_user: dict = Depends(get_current_user)):
+async def get_patients(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    status: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     if not has_reception_access(current_user["role"]):
         raise HTTPException(status_code=403, detail="Access denied")
     
     try:
-        patients_cursor = database.patients.find({}).sort("created_at", -1)
-        patients = []
-        async for patient in patients_cursor:
-            patients.append(Patient(**patient))
-        return patients
+        patients = await fetch_list_page(
+            database.patients, "created_at", response, limit, cursor, start_date, end_date,
+            query={"status": status} if status else None
+        )
+        return [Patient(**patient) for patient in patients]
+    except InvalidPageRequestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching patients: {str(e)}")
 
@@ -779,16 +826,26 @@ async def add_lab_test(test: LabTest, current_user: dict = Depends(get_current_u
         raise HTTPException(status_code=500, detail=f"Error adding lab test: {str(e)}")
 
 @app.get("/api/lab/orders", response_model=List[LabOrder])
-async def get_lab_orders(current_user: dict = Depends(get_current_user)):
+async def get_lab_orders(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    status: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     if not has_lab_access(current_user["role"]):
         raise HTTPException(status_code=403, detail="Access denied")
     
     try:
-        orders_cursor = database.lab_orders.find({}).sort("created_at", -1)
-        orders = []
-        async for order in orders_cursor:
-            orders.append(LabOrder(**order))
-        return orders
+        orders = await fetch_list_page(
+            database.lab_orders, "created_at", response, limit, cursor, start_date, end_date,
+            query={"status": status} if status else None
+        )
+        return [LabOrder(**order) for order in orders]
+    except InvalidPageRequestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching lab orders: {str(e)}")
 
@@ -841,16 +898,24 @@ async def update_lab_order_status(order_id: str, status: TestStatus, current_use
         raise HTTPException(status_code=500, detail=f"Error updating lab order status: {str(e)}")
 
 @app.get("/api/lab/results", response_model=List[LabResult])
-async def get_lab_results(current_user: dict = Depends(get_current_user)):
+async def get_lab_results(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     if not has_lab_access(current_user["role"]):
         raise HTTPException(status_code=403, detail="Access denied")
     
     try:
-        results_cursor = database.lab_results.find({}).sort("created_at", -1)
-        results = []
-        async for result in results_cursor:
-            results.append(LabResult(**result))
-        return results
+        results = await fetch_list_page(
+            database.lab_results, "created_at", response, limit, cursor, start_date, end_date
+        )
+        return [LabResult(**result) for result in results]
+    except InvalidPageRequestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching lab results: {str(e)}")
 
@@ -922,16 +987,26 @@ async def update_medication_stock(med_id: str, quantity: int, current_user: dict
         raise HTTPException(status_code=500, detail=f"Error updating stock: {str(e)}")
 
 @app.get("/api/pharmacy/prescriptions", response_model=List[Prescription])
-async def get_prescriptions(current_user: dict = Depends(get_current_user)):
+async def get_prescriptions(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    status: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     if not has_pharmacy_access(current_user["role"]):
         raise HTTPException(status_code=403, detail="Access denied")
     
     try:
-        prescriptions_cursor = database.prescriptions.find({}).sort("prescribed_date", -1)
-        prescriptions = []
-        async for prescription in prescriptions_cursor:
-            prescriptions.append(Prescription(**prescription))
-        return prescriptions
+        prescriptions = await fetch_list_page(
+            database.prescriptions, "prescribed_date", response, limit, cursor, start_date, end_date,
+            query={"status": status} if status else None
+        )
+        return [Prescription(**prescription) for prescription in prescriptions]
+    except InvalidPageRequestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching prescriptions: {str(e)}")
 
@@ -990,16 +1065,24 @@ async def dispense_prescription(prescription_id: str, current_user: dict = Depen
 # ===================
 
 @app.get("/api/nursing/vitals", response_model=List[VitalSigns])
-async def get_vitals(current_user: dict = Depends(get_current_user)):
+async def get_vitals(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     if not has_nursing_access(current_user["role"]):
         raise HTTPException(status_code=403, detail="Access denied")
     
     try:
-        vitals_cursor = database.vital_signs.find({}).sort("recorded_at", -1)
-        vitals = []
-        async for vital in vitals_cursor:
-            vitals.append(VitalSigns(**vital))
-        return vitals
+        vitals = await fetch_list_page(
+            database.vital_signs, "recorded_at", response, limit, cursor, start_date, end_date
+        )
+        return [VitalSigns(**vital) for vital in vitals]
+    except InvalidPageRequestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching vitals: {str(e)}")
 
@@ -1052,16 +1135,24 @@ async def record_nursing_procedure(procedure: NursingProcedure, current_user: di
 # ===================
 
 @app.get("/api/emr/consultations", response_model=List[Consultation])
-async def get_consultations(current_user: dict = Depends(get_current_user)):
+async def get_consultations(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     if not has_doctor_access(current_user["role"]):
         raise HTTPException(status_code=403, detail="Access denied")
     
     try:
-        consultations_cursor = database.consultations.find({}).sort("consultation_date", -1)
-        consultations = []
-        async for consultation in consultations_cursor:
-            consultations.append(Consultation(**consultation))
-        return consultations
+        consultations = await fetch_list_page(
+            database.consultations, "consultation_date", response, limit, cursor, start_date, end_date
+        )
+        return [Consultation(**consultation) for consultation in consultations]
+    except InvalidPageRequestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching consultations: {str(e)}")
 
@@ -1085,16 +1176,26 @@ async def create_consultation(consultation: Consultation, current_user: dict = D
 # ===================
 
 @app.get("/api/billing/bills", response_model=List[Bill])
-async def get_bills(current_user: dict = Depends(get_current_user)):
+async def get_bills(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    status: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     if not has_reception_access(current_user["role"]):
         raise HTTPException(status_code=403, detail="Access denied")
     
     try:
-        bills_cursor = database.bills.find({}).sort("created_at", -1)
-        bills = []
-        async for bill in bills_cursor:
-            bills.append(Bill(**bill))
-        return bills
+        bills = await fetch_list_page(
+            database.bills, "created_at", response, limit, cursor, start_date, end_date,
+            query={"status": status} if status else None
+        )
+        return [Bill(**bill) for bill in bills]
+    except InvalidPageRequestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching bills: {str(e)}")
 
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for per-request token verification
+Compares full JWT verification (python-jose, and PyJWT when installed)
+with the verified-token cache used by verify_token.
+Usage: python token_cache_benchmark.py [--iterations N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+# Add backend directory to path
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, backend_dir)
+
+import auth
+
+def report(label: str, seconds: float, iterations: int):
+    print(f"{label:<32} {seconds / iterations * 1e6:8.2f} µs/request")
+
+def main(iterations: int):
+    token = auth.create_access_token({"sub": "pharmacy1", "role": "pharmacy", "user_id": "bench"})
+    
+    jose_time = timeit.timeit(
+        lambda: auth.jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM]), number=iterations
+    )
+    report("python-jose decode", jose_time, iterations)
+    
+    if auth.pyjwt is not None:
+        pyjwt_time = timeit.timeit(
+            lambda: auth.pyjwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM]), number=iterations
+        )
+        report("PyJWT decode", pyjwt_time, iterations)
+    else:
+        print("PyJWT not installed; skipping")
+    
+    def uncached():
+        auth.clear_token_cache()
+        auth.verify_token(token)
+    report("verify_token (cache miss)", timeit.timeit(uncached, number=iterations), iterations)
+    
+    auth.verify_token(token)
+    report("verify_token (cache hit)", timeit.timeit(lambda: auth.verify_token(token), number=iterations), iterations)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20000)
+    main(parser.parse_args().iterations)
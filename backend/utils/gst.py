@@ -1,5 +1,10 @@
 # utils/gst.py
-from typing import Tuple, Dict
+import calendar
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Tuple, Dict, Iterable, List, Optional, Sequence
+
+from utils.money import div_round, scale_decimal, stored_paise
 
 def split_tax_intra_inter(is_intra: bool, gst_rate: float, taxable: float) -> Tuple[float, float, float]:
     """
@@ -105,6 +110,194 @@ def calc_sale_rate_exclusive(is_intra: bool, qty: int, rate_ex_tax: float,
         "net": round(net, 2)
     }
 
+# ===== Invoice-level engine =====
+# Whole invoices are computed in integer paise: inputs are converted once,
+# every line is rounded half-up to the paisa and totals are exact integer
+# sums, so a bill's total always equals the sum of its printed lines.
+# Each step runs over a whole column of the invoice (one integer list per
+# field) rather than line by line, and a repeated rate or price is converted
+# from rupees only once per invoice.
+
+INVOICE_SALE_FIELDS = ("mrp_total", "discount_on_mrp", "taxable", "cgst", "sgst", "igst", "net")
+INVOICE_PURCHASE_FIELDS = ("taxable", "scheme_amount", "cgst", "sgst", "igst", "post_tax_discount", "net_payable")
+INVOICE_RETURN_FIELDS = ("base_reversed", "cgst_rev", "sgst_rev", "igst_rev", "net_refund")
+
+def _scaled_column(values: Iterable, scale: int) -> List[int]:
+    """scale_decimal over a column, converting each distinct value once"""
+    scaled = {}
+    column = []
+    for value in values:
+        if value not in scaled:
+            scaled[value] = scale_decimal(value, scale)
+        column.append(scaled[value])
+    return column
+
+def _round_column(numerators: Iterable[int], denominator: int) -> List[int]:
+    """div_round of every numerator in a column by one denominator"""
+    twice = 2 * denominator
+    return [
+        (2 * n + denominator) // twice if n >= 0 else -((denominator - 2 * n) // twice)
+        for n in numerators
+    ]
+
+def _round_pairs(numerators: Iterable[int], denominators: Iterable[int]) -> List[int]:
+    """div_round of every numerator in a column by its own denominator"""
+    return [
+        (2 * n + d) // (2 * d) if n >= 0 else -((d - 2 * n) // (2 * d))
+        for n, d in zip(numerators, denominators)
+    ]
+
+def _invoice(fields: Sequence[str], columns: Sequence[List[int]]) -> Dict[str, list]:
+    """Line dicts and exact totals from one column per field"""
+    return {
+        "lines": [dict(zip(fields, row)) for row in zip(*columns)],
+        "totals": dict(zip(fields, map(sum, columns)))
+    }
+
+def calc_sale_invoice(is_intra: bool, lines: Sequence[Dict]) -> Dict[str, list]:
+    """
+    Calculate every line of a sale and the invoice totals in one pass
+    Each line needs qty, pricing_mode ("MRP_INC" or rate-exclusive), mrp,
+    mrp_discount_pct, rate_ex_tax and gst_rate. Returns {"lines": [...],
+    "totals": {...}} with all amounts in integer paise.
+    """
+    qty = [line["qty"] for line in lines]
+    inclusive = [line.get("pricing_mode", "MRP_INC") == "MRP_INC" for line in lines]
+    gst_bp = _scaled_column((line["gst_rate"] for line in lines), 100)
+    mrp_total = [paise * q for paise, q in zip(_scaled_column((line["mrp"] for line in lines), 100), qty)]
+    
+    # MRP-inclusive lines: patient pays MRP less discount; GST is back-calculated
+    discount_bp = _scaled_column((
+        line.get("mrp_discount_pct", 0) if inc else 0 for line, inc in zip(lines, inclusive)
+    ), 100)
+    discount = _round_column((total * bp for total, bp in zip(mrp_total, discount_bp)), 10000)
+    paid = [total - off for total, off in zip(mrp_total, discount)]
+    back_calculated = _round_pairs(
+        (net * 10000 if inc else 0 for net, inc in zip(paid, inclusive)),
+        (10000 + bp for bp in gst_bp)
+    )
+    
+    # Rate-exclusive lines: base amount is given, GST is added on top
+    rate_ex = _scaled_column((
+        0 if inc else line.get("rate_ex_tax") for line, inc in zip(lines, inclusive)
+    ), 10000)
+    rated = _round_column((rate * q for rate, q in zip(rate_ex, qty)), 100)
+    
+    taxable = [back if inc else base for back, base, inc in zip(back_calculated, rated, inclusive)]
+    tax_in_price = [net - base if inc else 0 for net, base, inc in zip(paid, taxable, inclusive)]
+    tax_on_top = _round_column((
+        0 if inc else base * bp for base, bp, inc in zip(taxable, gst_bp, inclusive)
+    ), 20000 if is_intra else 10000)
+    
+    zeros = [0] * len(qty)
+    if is_intra:
+        # Odd paise of back-calculated tax go to SGST so the line still adds up to what the patient pays
+        cgst = [tax // 2 if inc else half for tax, half, inc in zip(tax_in_price, tax_on_top, inclusive)]
+        sgst = [tax - c if inc else half for tax, c, half, inc in zip(tax_in_price, cgst, tax_on_top, inclusive)]
+        igst = zeros
+    else:
+        cgst = sgst = zeros
+        igst = [tax if inc else added for tax, added, inc in zip(tax_in_price, tax_on_top, inclusive)]
+    
+    # For MRP-inclusive lines this is MRP less discount by construction
+    net = [base + c + s + i for base, c, s, i in zip(taxable, cgst, sgst, igst)]
+    
+    return _invoice(INVOICE_SALE_FIELDS, (mrp_total, discount, taxable, cgst, sgst, igst, net))
+
+def split_sale_line(line: Dict[str, int], quantities: Sequence[int]) -> List[Dict[str, int]]:
+    """
+    Split one calculated sale line (paise) across batches by quantity
+    Every amount but net is apportioned cumulatively, so no part goes
+    negative and the parts add up to the line exactly; each part's net is
+    its taxable plus its tax, so net = taxable + cgst + sgst + igst still
+    holds per part and the bill total does not move.
+    """
+    if len(quantities) == 1:
+        return [dict(line)]
+    
+    qty = sum(quantities)
+    apportioned = [field for field in INVOICE_SALE_FIELDS if field != "net"]
+    
+    parts = []
+    previous = dict.fromkeys(apportioned, 0)
+    sold = 0
+    for part_qty in quantities:
+        sold += part_qty
+        cumulative = {field: div_round(line[field] * sold, qty) for field in apportioned}
+        part = {field: cumulative[field] - previous[field] for field in apportioned}
+        part["net"] = part["taxable"] + part["cgst"] + part["sgst"] + part["igst"]
+        parts.append(part)
+        previous = cumulative
+    return parts
+
+def calc_purchase_invoice(is_intra: bool, lines: Sequence[Dict]) -> Dict[str, list]:
+    """
+    Calculate every line of a purchase invoice and its totals in one pass
+    Each line needs billed_qty, free_qty, trade_price_ex, gst_rate, scheme_pct
+    and cash_pct. Amounts are integer paise; effective_cost_per_unit is a
+    Decimal in rupees to 4 places.
+    """
+    billed_qty = [line["billed_qty"] for line in lines]
+    gst_bp = _scaled_column((line["gst_rate"] for line in lines), 100)
+    trade_price = _scaled_column((line["trade_price_ex"] for line in lines), 10000)
+    gross = _round_column((price * q for price, q in zip(trade_price, billed_qty)), 100)
+    
+    # Scheme discount is pre-tax (reduces taxable value)
+    scheme_bp = _scaled_column((line.get("scheme_pct", 0) for line in lines), 100)
+    scheme = _round_column((amount * bp for amount, bp in zip(gross, scheme_bp)), 10000)
+    taxable = [max(0, amount - off) for amount, off in zip(gross, scheme)]
+    tax = _round_column((base * bp for base, bp in zip(taxable, gst_bp)), 20000 if is_intra else 10000)
+    zeros = [0] * len(tax)
+    cgst, sgst, igst = (tax, tax, zeros) if is_intra else (zeros, zeros, tax)
+    
+    # Cash discount is post-tax by default (doesn't reduce GST base)
+    gross_with_tax = [base + c + s + i for base, c, s, i in zip(taxable, cgst, sgst, igst)]
+    cash_bp = _scaled_column((line.get("cash_pct", 0) for line in lines), 100)
+    post_tax_discount = _round_column((amount * bp for amount, bp in zip(gross_with_tax, cash_bp)), 10000)
+    row_net = [amount - off for amount, off in zip(gross_with_tax, post_tax_discount)]
+    
+    # Cost per unit in 1/10000 rupee, rounded half-up like quantize(0.0001)
+    effective_qty = [billed + line.get("free_qty", 0) for billed, line in zip(billed_qty, lines)]
+    unit_cost = _round_pairs((net * 100 for net in row_net), (max(1, q) for q in effective_qty))
+    
+    invoice = _invoice(
+        INVOICE_PURCHASE_FIELDS, (taxable, scheme, cgst, sgst, igst, post_tax_discount, row_net)
+    )
+    for result, q, cost in zip(invoice["lines"], effective_qty, unit_cost):
+        result["effective_qty"] = q
+        result["effective_cost_per_unit"] = Decimal(cost).scaleb(-4)
+    return invoice
+
+def calc_return_invoice(lines: Sequence[Dict]) -> Dict[str, list]:
+    """
+    Reverse sold lines in proportion to the quantity returned
+    Each line needs qty_returned, nos (quantity sold) and the sold line's
+    base_ex_tax, cgst, sgst, igst and net (stored paise, or rupees on older
+    sale items), plus returned_qty when earlier returns took some of it.
+    Amounts are allocated cumulatively (charged x returned so far, less what
+    earlier returns refunded), so partial returns of a line add up to
+    exactly what was charged. A line listed twice (same _id) continues
+    from its first entry.
+    """
+    returned_so_far: Dict = {}
+    before = []
+    after = []
+    for position, line in enumerate(lines):
+        key = line.get("_id", position)
+        before.append(returned_so_far.get(key, line.get("returned_qty", 0)))
+        after.append(before[-1] + line["qty_returned"])
+        returned_so_far[key] = after[-1]
+    nos = [line["nos"] for line in lines]
+    
+    columns = []
+    for source in ("base_ex_tax", "cgst", "sgst", "igst", "net"):
+        charged = [stored_paise(line, source) for line in lines]
+        to_date = _round_pairs((amount * q for amount, q in zip(charged, after)), nos)
+        earlier = _round_pairs((amount * q for amount, q in zip(charged, before)), nos)
+        columns.append([now - then for now, then in zip(to_date, earlier)])
+    
+    return _invoice(INVOICE_RETURN_FIELDS, columns)
+
 def validate_gst_rate(gst_rate: int) -> bool:
     """Validate GST rate is one of the standard rates"""
     return gst_rate in [0, 5, 12, 18, 28]
@@ -167,25 +360,34 @@ def validate_expiry_date(expiry_str: str) -> bool:
     except ValueError:
         return False
 
-def get_expiry_color(expiry_str: str) -> str:
+# Expiry colour bands: (colour, months ahead), nearest first
+EXPIRY_COLOR_BANDS = (("red", 3), ("orange", 6), ("yellow", 12))
+
+def add_months(moment: datetime, months: int) -> datetime:
+    """Same day-of-month `months` later, clamped to the end of shorter months"""
+    month_index = moment.month - 1 + months
+    year, month = moment.year + month_index // 12, month_index % 12 + 1
+    day = min(moment.day, calendar.monthrange(year, month)[1])
+    return moment.replace(year=year, month=month, day=day)
+
+def expiry_cutoff(today: datetime, months: int) -> str:
+    """Latest YYYY-MM expiry that falls within `months` calendar months of today"""
+    return add_months(today, months).strftime("%Y-%m")
+
+def get_expiry_color(expiry_str: str, today: Optional[datetime] = None) -> str:
     """
     Get color code for expiry date
     Red: ≤3 months, Orange: 3-6 months, Yellow: 6-12 months, OK: >12 months
+    Pass `today` (local date) to colour many batches against the same day;
+    aggregations use deps.expiry.expiry_color_expression with the same bands
     """
     try:
-        from datetime import datetime
-        from dateutil.relativedelta import relativedelta
-        
-        expiry_date = datetime.strptime(expiry_str, "%Y-%m")
-        today = datetime.now()
-        
-        if expiry_date <= today + relativedelta(months=3):
-            return "red"
-        elif expiry_date <= today + relativedelta(months=6):
-            return "orange"
-        elif expiry_date <= today + relativedelta(months=12):
-            return "yellow"
-        else:
-            return "ok"
-    except:
-        return "ok"
\ No newline at end of file
+        expiry = datetime.strptime(expiry_str, "%Y-%m").strftime("%Y-%m")
+    except (TypeError, ValueError):
+        return "ok"
+    
+    today = today or datetime.now()
+    for color, months in EXPIRY_COLOR_BANDS:
+        if expiry <= expiry_cutoff(today, months):
+            return color
+    return "ok"
@@ -0,0 +1,22 @@
+# utils/joins.py
+from typing import Any, Dict, Iterable, Optional
+
+async def fetch_by_ids(collection, ids: Iterable[Any], projection: Optional[Dict] = None,
+                       key: str = "_id", session=None) -> Dict[Any, Dict]:
+    """
+    Resolve many references with one $in query
+    Returns {id: document}; ids with no matching document are simply absent,
+    so callers keep their own "not found" handling
+    """
+    unique_ids = list({ref for ref in ids if ref is not None})
+    if not unique_ids:
+        return {}
+    
+    documents = {}
+    async for document in collection.find({key: {"$in": unique_ids}}, projection, session=session):
+        documents[document[key]] = document
+    return documents
+
+def ordered_by_ids(documents: Dict[Any, Dict], ids: Iterable[Any]) -> list:
+    """Documents in the order their ids were referenced, skipping missing ones"""
+    return [documents[ref] for ref in ids if ref in documents]
@@ -0,0 +1,69 @@
+# utils/money.py
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict
+
+PAISE_PER_RUPEE = 100
+
+# Money is stored in MongoDB as integer paise in fields ending with this suffix.
+# Arithmetic and aggregations use these; rupee floats are only for display
+PAISE_SUFFIX = "_paise"
+
+def scale_decimal(value, scale: int) -> int:
+    """Exact decimal value * scale rounded half-up (rupees -> paise with scale 100)"""
+    if not value:
+        return 0
+    if isinstance(value, int):
+        return value * scale
+    if isinstance(value, float):
+        # Fast path: the value has no more decimals than the scale keeps
+        scaled = value * scale
+        nearest = round(scaled)
+        if abs(scaled - nearest) < 1e-6:
+            return int(nearest)
+    # str and Decimal values (and floats with extra decimals) round exactly
+    return int((Decimal(str(value).strip()) * scale).to_integral_value(ROUND_HALF_UP))
+
+def div_round(numerator: int, denominator: int) -> int:
+    """Integer division rounded half-up (away from zero)"""
+    quotient, remainder = divmod(abs(numerator), denominator)
+    if remainder * 2 >= denominator:
+        quotient += 1
+    return quotient if numerator >= 0 else -quotient
+
+def to_paise(rupees) -> int:
+    """Rupee amount (float, int, str or Decimal) as integer paise"""
+    return scale_decimal(rupees, PAISE_PER_RUPEE)
+
+def to_rupees(paise: int) -> float:
+    """Integer paise as a rupee amount for API responses"""
+    return float(Decimal(paise or 0) / PAISE_PER_RUPEE)
+
+def money_fields(amounts: Dict[str, int]) -> Dict:
+    """
+    Stored form of amounts given in paise
+    {"net": 1050} -> {"net": 10.5, "net_paise": 1050}; the paise field is the
+    source of truth, the rupee field is kept for display and older readers
+    """
+    fields = {}
+    for field, paise in amounts.items():
+        fields[field] = to_rupees(paise)
+        fields[f"{field}{PAISE_SUFFIX}"] = int(paise)
+    return fields
+
+def stored_paise(document: Dict, field: str) -> int:
+    """
+    Read a money field from a stored document as paise
+    Documents written before paise storage only have the rupee field
+    """
+    paise_field = f"{field}{PAISE_SUFFIX}"
+    if paise_field in document:
+        return document[paise_field]
+    return to_paise(document.get(field))
+
+def paise_expression(rupee_expression) -> Dict:
+    """Aggregation expression rounding a rupee value to integer paise"""
+    return {"$toLong": {"$round": [{"$multiply": [rupee_expression, PAISE_PER_RUPEE]}, 0]}}
+
+def stored_paise_expression(field_path: str) -> Dict:
+    """Aggregation counterpart of stored_paise for a "$path.to.field" rupee path"""
+    return {"$ifNull": [f"{field_path}{PAISE_SUFFIX}", paise_expression({"$ifNull": [field_path, 0]})]}
@@ -0,0 +1,174 @@
+# utils/pagination.py
+import base64
+import json
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Response header carrying the cursor for the next page (absent on the last page)
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+class InvalidPageRequestError(ValueError):
+    """Raised for list parameters a client got wrong; routes answer 400 with its message"""
+
+class InvalidCursorError(InvalidPageRequestError):
+    """Raised when a client sends a cursor that was not produced by encode_cursor"""
+
+class InvalidDateRangeError(InvalidPageRequestError):
+    """Raised when start_date or end_date is not an ISO date"""
+
+def encode_cursor(sort_value: datetime, doc_id: Any) -> str:
+    """
+    Encode the position after the last document of a page as an opaque token
+    Keyset pagination resumes from (sort_value, _id) instead of skipping rows
+    """
+    # "d" marks a datetime sort value, the way "o" marks an ObjectId _id;
+    # strings and numbers are resumed from as they are
+    payload = {
+        "v": sort_value.isoformat() if isinstance(sort_value, datetime) else sort_value,
+        "d": isinstance(sort_value, datetime),
+        "i": str(doc_id),
+        "o": isinstance(doc_id, ObjectId)
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> Tuple[Any, Any]:
+    """Decode a cursor back into (sort_value, _id)"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        sort_value = payload["v"]
+        # Cursors issued before "d" existed always carried datetimes
+        if payload.get("d", isinstance(sort_value, str)):
+            sort_value = datetime.fromisoformat(sort_value)
+        doc_id = ObjectId(payload["i"]) if payload.get("o") else payload["i"]
+        return sort_value, doc_id
+    except Exception:
+        raise InvalidCursorError("Invalid pagination cursor")
+
+def clamp_page_size(limit: int) -> int:
+    """Keep client supplied page sizes within bounds"""
+    return min(max(limit, 1), MAX_PAGE_SIZE)
+
+def parse_date_range(start_date: Optional[str], end_date: Optional[str]) -> Dict[str, datetime]:
+    """
+    Build a range from optional ISO dates or datetimes
+    A date-only end_date includes that whole day ($lt the next midnight);
+    a full timestamp is an inclusive $lte bound
+    """
+    date_range = {}
+    for bound, value in (("start", start_date), ("end", end_date)):
+        if not value:
+            continue
+        try:
+            moment = datetime.fromisoformat(value)
+        except ValueError:
+            raise InvalidDateRangeError(f"Invalid date '{value}', expected YYYY-MM-DD")
+        if bound == "start":
+            date_range["$gte"] = moment
+        elif _is_date_only(value):
+            date_range["$lt"] = moment + timedelta(days=1)
+        else:
+            date_range["$lte"] = moment
+    return date_range
+
+def _is_date_only(value: str) -> bool:
+    try:
+        date.fromisoformat(value)
+        return True
+    except ValueError:
+        return False
+
+def build_page_query(query: Dict, sort_field: str, cursor: Optional[str]) -> Dict:
+    """Add the keyset condition for a cursor to a query sorted by (sort_field, _id) descending"""
+    if not cursor:
+        return query
+
+    sort_value, doc_id = decode_cursor(cursor)
+    # Documents without the sort field sort last; $lt never matches them,
+    # so they are reached through their own branch and paged by _id alone
+    if sort_value is None:
+        after_cursor = {sort_field: None, "_id": {"$lt": doc_id}}
+    else:
+        after_cursor = {"$or": [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, "_id": {"$lt": doc_id}},
+            {sort_field: None}
+        ]}
+    return {"$and": [query, after_cursor]} if query else after_cursor
+
+async def fetch_page(collection, query: Dict, sort_field: str, limit: Optional[int],
+                     cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Fetch one page newest first
+    Returns (documents, next_cursor); next_cursor is None on the last page.
+    With neither limit nor cursor every matching document is returned, as
+    list endpoints did before paging (clients that never follow the cursor)
+    """
+    if limit is None and not cursor:
+        documents = await collection.find(query).sort(
+            [(sort_field, -1), ("_id", -1)]
+        ).to_list(length=None)
+        return documents, None
+
+    limit = clamp_page_size(limit if limit is not None else DEFAULT_PAGE_SIZE)
+    page_query = build_page_query(query, sort_field, cursor)
+
+    # One extra row tells us whether another page exists
+    documents = await collection.find(page_query).sort(
+        [(sort_field, -1), ("_id", -1)]
+    ).limit(limit + 1).to_list(length=limit + 1)
+
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        last = documents[-1]
+        next_cursor = encode_cursor(last.get(sort_field), last["_id"])
+
+    return documents, next_cursor
+
+def _field_value(document: Dict, field: str) -> Any:
+    for part in field.split("."):
+        document = document.get(part) if isinstance(document, dict) else None
+    return document
+
+def ascending_page_stages(sort_field: str, limit: Optional[int], cursor: Optional[str]) -> List[Dict]:
+    """
+    Aggregation stages for one page of a listing sorted by (sort_field, _id)
+    ascending; with neither limit nor cursor the whole listing is returned.
+    Pass the rows to split_page, which drops the extra lookahead row
+    """
+    stages = []
+    if cursor:
+        sort_value, doc_id = decode_cursor(cursor)
+        # Documents without the sort field sort first, ahead of every value
+        if sort_value is None:
+            stages.append({"$match": {"$or": [
+                {sort_field: None, "_id": {"$gt": doc_id}},
+                {sort_field: {"$ne": None}}
+            ]}})
+        else:
+            stages.append({"$match": {"$or": [
+                {sort_field: {"$gt": sort_value}},
+                {sort_field: sort_value, "_id": {"$gt": doc_id}}
+            ]}})
+    stages.append({"$sort": {sort_field: 1, "_id": 1}})
+    if limit is not None or cursor:
+        stages.append({"$limit": clamp_page_size(limit if limit is not None else DEFAULT_PAGE_SIZE) + 1})
+    return stages
+
+def split_page(documents: List[Dict], sort_field: str, limit: Optional[int],
+               cursor: Optional[str]) -> Tuple[List[Dict], Optional[str]]:
+    """(page, next_cursor) from rows fetched with ascending_page_stages"""
+    if limit is None and not cursor:
+        return documents, None
+
+    limit = clamp_page_size(limit if limit is not None else DEFAULT_PAGE_SIZE)
+    if len(documents) <= limit:
+        return documents, None
+    documents = documents[:limit]
+    last = documents[-1]
+    return documents, encode_cursor(_field_value(last, sort_field), last["_id"])
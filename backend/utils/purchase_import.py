@@ -0,0 +1,234 @@
+# utils/purchase_import.py
+"""
+Distributor purchase files: parsing and line validation
+Everything here is pure (no database, no event loop) so large files can be
+validated in worker processes; routers/purchases.py resolves products and
+writes the purchase.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from utils.gst import validate_gst_rate
+from utils.search import normalize_text
+
+# Distributor CSV headers (normalized) -> purchase line field
+CSV_COLUMNS = {
+    "product_id": "product_id",
+    "product": "product_name",
+    "product_name": "product_name",
+    "item": "product_name",
+    "item_name": "product_name",
+    "description": "product_name",
+    "hsn": "hsn",
+    "hsn_code": "hsn",
+    "batch": "batch_no",
+    "batch_no": "batch_no",
+    "batch_number": "batch_no",
+    "expiry": "expiry",
+    "exp": "expiry",
+    "exp_date": "expiry",
+    "expiry_date": "expiry",
+    "qty": "billed_qty",
+    "quantity": "billed_qty",
+    "billed_qty": "billed_qty",
+    "free": "free_qty",
+    "free_qty": "free_qty",
+    "mrp": "mrp",
+    "rate": "trade_price_ex_tax",
+    "ptr": "trade_price_ex_tax",
+    "trade_price": "trade_price_ex_tax",
+    "trade_price_ex_tax": "trade_price_ex_tax",
+    "gst": "gst_rate",
+    "gst_rate": "gst_rate",
+    "gst_pct": "gst_rate",
+    "scheme_pct": "scheme_pct",
+    "cash_pct": "cash_pct",
+    "rack_id": "rack_id",
+    "schedule_symbol": "schedule_symbol",
+}
+
+# GST e-invoice (INV-01) item attributes -> purchase line field
+EINVOICE_ITEM_FIELDS = {
+    "PrdDesc": "product_name",
+    "HsnCd": "hsn",
+    "Qty": "billed_qty",
+    "FreeQty": "free_qty",
+    "UnitPrice": "trade_price_ex_tax",
+    "GstRt": "gst_rate",
+    "Mrp": "mrp",
+}
+
+# Expiry formats seen on distributor files; all are stored as YYYY-MM
+EXPIRY_FORMATS = ("%Y-%m", "%m/%Y", "%m-%Y", "%m/%y", "%m-%y", "%d/%m/%Y", "%Y-%m-%d")
+
+class PurchaseFileError(ValueError):
+    """Raised when a purchase file cannot be parsed at all"""
+
+def _column(header: str) -> Optional[str]:
+    return CSV_COLUMNS.get(normalize_text(header).replace(" ", "_"))
+
+def parse_purchase_csv(text: str) -> List[Dict]:
+    reader = csv.reader(io.StringIO(text))
+    try:
+        header = next(reader)
+    except StopIteration:
+        raise PurchaseFileError("File is empty")
+    columns = [_column(name) for name in header]
+    if "batch_no" not in columns:
+        raise PurchaseFileError("CSV must have a batch column")
+
+    rows = []
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        rows.append({
+            field: value.strip()
+            for field, value in zip(columns, values)
+            if field and value.strip()
+        })
+    return rows
+
+def parse_einvoice_json(text: str) -> Tuple[List[Dict], Dict]:
+    """Lines and header fields (invoice_no, invoice_date) of a GST e-invoice"""
+    try:
+        document = json.loads(text)
+    except ValueError as e:
+        raise PurchaseFileError(f"Invalid JSON: {e}")
+    if not isinstance(document, dict) or not isinstance(document.get("ItemList"), list):
+        raise PurchaseFileError("JSON must be an e-invoice with an ItemList")
+
+    rows = []
+    for item in document["ItemList"]:
+        row = {
+            field: item[attribute]
+            for attribute, field in EINVOICE_ITEM_FIELDS.items()
+            if item.get(attribute) not in (None, "")
+        }
+        batch = item.get("BchDtls") or {}
+        if batch.get("Nm"):
+            row["batch_no"] = batch["Nm"]
+        if batch.get("ExpDt"):
+            row["expiry"] = batch["ExpDt"]
+        rows.append(row)
+
+    doc_details = document.get("DocDtls") or {}
+    header = {}
+    if doc_details.get("No"):
+        header["invoice_no"] = doc_details["No"]
+    if doc_details.get("Dt"):
+        header["invoice_date"] = normalize_date(doc_details["Dt"])
+    return rows, header
+
+def normalize_date(value: str) -> str:
+    """DD/MM/YYYY (e-invoice) or YYYY-MM-DD -> YYYY-MM-DD"""
+    for date_format in ("%d/%m/%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return value
+
+def normalize_expiry(value) -> Optional[str]:
+    text = str(value).strip()
+    for expiry_format in EXPIRY_FORMATS:
+        try:
+            return datetime.strptime(text, expiry_format).strftime("%Y-%m")
+        except ValueError:
+            continue
+    return None
+
+def _number(row: Dict, field: str, cast, default=None):
+    value = row.get(field, default)
+    if value is None:
+        raise ValueError(f"{field} is required")
+    try:
+        return cast(str(value).replace(",", "").strip()) if isinstance(value, str) else cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be a number")
+
+def _whole(value: str) -> int:
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError
+    return int(number)
+
+def validate_purchase_line(row: Dict, now: datetime) -> Tuple[Optional[Dict], List[str]]:
+    """A purchase line ready to price, or the reasons it cannot be used"""
+    errors = []
+    line = {
+        "product_id": row.get("product_id"),
+        "product_name": row.get("product_name"),
+        "hsn": str(row["hsn"]).strip() if row.get("hsn") not in (None, "") else None,
+        "batch_no": str(row.get("batch_no") or "").strip(),
+        "rack_id": row.get("rack_id"),
+        "schedule_symbol": row.get("schedule_symbol") or "NONE",
+    }
+    if not line["product_id"] and not line["product_name"]:
+        errors.append("product name or product_id is required")
+    if not line["batch_no"]:
+        errors.append("batch_no is required")
+
+    for field, cast, default in (
+        ("billed_qty", _whole, None),
+        ("free_qty", _whole, 0),
+        ("mrp", float, None),
+        ("trade_price_ex_tax", float, None),
+        ("gst_rate", _whole, None),
+        ("scheme_pct", float, 0),
+        ("cash_pct", float, 0),
+    ):
+        try:
+            line[field] = _number(row, field, cast, default)
+        except ValueError as e:
+            errors.append(str(e))
+
+    if line.get("billed_qty") is not None and line["billed_qty"] <= 0:
+        errors.append("billed_qty must be positive")
+    if line.get("free_qty") is not None and line["free_qty"] < 0:
+        errors.append("free_qty must not be negative")
+    if line.get("mrp") is not None and line["mrp"] <= 0:
+        errors.append("mrp must be positive")
+    if line.get("trade_price_ex_tax") is not None and line["trade_price_ex_tax"] < 0:
+        errors.append("trade_price_ex_tax must not be negative")
+    if line.get("gst_rate") is not None and not validate_gst_rate(line["gst_rate"]):
+        errors.append(f"Invalid GST rate: {line['gst_rate']}")
+    for field in ("scheme_pct", "cash_pct"):
+        if line.get(field) is not None and not 0 <= line[field] <= 100:
+            errors.append(f"{field} must be between 0 and 100")
+
+    if row.get("expiry") in (None, ""):
+        errors.append("expiry is required")
+    else:
+        line["expiry"] = normalize_expiry(row["expiry"])
+        if line["expiry"] is None:
+            errors.append("Invalid expiry date format (YYYY-MM)")
+        elif datetime.strptime(line["expiry"], "%Y-%m") <= now:
+            errors.append("Expiry date must be in future")
+
+    return (None if errors else line), errors
+
+def validate_purchase_lines(rows: Sequence[Tuple[int, Dict]]) -> List[Tuple[int, Optional[Dict], List[str]]]:
+    """Validate (line_no, row) pairs; the unit of work handed to a worker process"""
+    now = datetime.now()
+    results = []
+    for line_no, row in rows:
+        line, errors = validate_purchase_line(row, now)
+        results.append((line_no, line, errors))
+    return results
+
+def product_name_keys(product: Dict) -> List[str]:
+    """Normalized names a distributor line may use for a product ("Dolo 650 Tablet", "DOLO 650 650MG TAB" ...)"""
+    brand = normalize_text(product.get("brand_name"))
+    strength = normalize_text(product.get("strength"))
+    form = normalize_text(product.get("form"))
+    names = (
+        f"{brand} {strength} {form}",
+        f"{brand} {strength}",
+        f"{brand} {form}",
+        brand,
+    )
+    return [key for key in dict.fromkeys(" ".join(name.split()) for name in names) if key]
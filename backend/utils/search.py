@@ -0,0 +1,184 @@
+# utils/search.py
+import bisect
+import heapq
+import re
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+# Field weights: a hit on the brand outranks one on the chemical name
+SEARCH_FIELDS = {
+    "brand_name": 3.0,
+    "chemical_name": 2.0,
+    "strength": 1.0,
+    "form": 1.0,
+}
+
+# Product fields kept alongside the tokens so searches can filter on them
+FILTER_FIELDS = ("schedule_symbol",)
+
+# Match quality multipliers for a query token against an indexed token
+EXACT_MATCH = 2.0
+PREFIX_MATCH = 1.5
+INFIX_MATCH = 1.0
+
+# Infix (substring) matching needs at least one trigram
+MIN_INFIX_LENGTH = 3
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+def normalize_text(text: Optional[str]) -> str:
+    """Lowercase and replace punctuation with spaces ("Amoxy-Clav 625" -> "amoxy clav 625")"""
+    return _NON_ALNUM.sub(" ", (text or "").lower()).strip()
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return normalize_text(text).split()
+
+def trigrams(token: str) -> Set[str]:
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+class ProductSearchIndex:
+    """
+    In-memory product search over normalized tokens
+    Prefix matches come from a sorted token vocabulary (bisect), substring
+    matches from a trigram index over the same vocabulary. Every query token
+    must match; results are ranked by field weight and match quality.
+    Filters (FILTER_FIELDS) are applied before results are cut to the limit.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[Any, float]] = {}
+        self._product_tokens: Dict[Any, Set[str]] = {}
+        self._names: Dict[Any, str] = {}
+        self._filters: Dict[Any, Dict[str, Any]] = {}
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._vocabulary: List[str] = []
+        self._vocabulary_dirty = False
+
+    @classmethod
+    def from_products(cls, products: Iterable[Dict]) -> "ProductSearchIndex":
+        index = cls()
+        for product in products:
+            index.add(product)
+        index._sort_vocabulary()
+        return index
+
+    def __len__(self) -> int:
+        return len(self._product_tokens)
+
+    def add(self, product: Dict):
+        """Index (or re-index) one product document"""
+        product_id = product["_id"]
+        self.remove(product_id)
+
+        weights: Dict[str, float] = {}
+        for field, weight in SEARCH_FIELDS.items():
+            for token in tokenize(product.get(field)):
+                weights[token] = max(weights.get(token, 0.0), weight)
+
+        for token, weight in weights.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                for trigram in trigrams(token):
+                    self._trigrams.setdefault(trigram, set()).add(token)
+                self._vocabulary_dirty = True
+            postings[product_id] = weight
+
+        self._product_tokens[product_id] = set(weights)
+        self._names[product_id] = normalize_text(product.get("brand_name"))
+        self._filters[product_id] = {field: product.get(field) for field in FILTER_FIELDS}
+
+    def remove(self, product_id: Any):
+        for token in self._product_tokens.pop(product_id, ()):
+            postings = self._postings[token]
+            postings.pop(product_id, None)
+            if not postings:
+                del self._postings[token]
+                for trigram in trigrams(token):
+                    tokens = self._trigrams.get(trigram)
+                    if tokens is not None:
+                        tokens.discard(token)
+                        if not tokens:
+                            del self._trigrams[trigram]
+                self._vocabulary_dirty = True
+        self._names.pop(product_id, None)
+        self._filters.pop(product_id, None)
+
+    def _sort_vocabulary(self):
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_dirty = False
+
+    def _matching_tokens(self, query_token: str, infix: bool) -> Dict[str, float]:
+        """Indexed tokens matching a query token, with their match quality"""
+        self._sort_vocabulary()
+
+        matches: Dict[str, float] = {}
+        position = bisect.bisect_left(self._vocabulary, query_token)
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(query_token):
+            token = self._vocabulary[position]
+            matches[token] = EXACT_MATCH if token == query_token else PREFIX_MATCH
+            position += 1
+
+        if infix and len(query_token) >= MIN_INFIX_LENGTH:
+            candidates = None
+            for trigram in trigrams(query_token):
+                tokens = self._trigrams.get(trigram)
+                if not tokens:
+                    candidates = set()
+                    break
+                candidates = set(tokens) if candidates is None else candidates & tokens
+            for token in candidates or ():
+                if token not in matches and query_token in token:
+                    matches[token] = INFIX_MATCH
+        return matches
+
+    def search(self, query: str, limit: int = 20, filters: Optional[Dict[str, Any]] = None) -> List[Any]:
+        """
+        _ids of the best matching products, best first
+        Substring matches are only looked up when prefix matches alone do not
+        fill the page; they always rank below prefix matches of the same field.
+        filters ({field: value} over FILTER_FIELDS) narrow the matches before
+        the limit is applied.
+        """
+        query_tokens = list(dict.fromkeys(tokenize(query)))
+        if not query_tokens:
+            return []
+
+        results = self._search(query_tokens, limit, False, filters)
+        if len(results) < limit:
+            results = self._search(query_tokens, limit, True, filters)
+        return results
+
+    def _search(
+        self, query_tokens: List[str], limit: int, infix: bool, filters: Optional[Dict[str, Any]] = None
+    ) -> List[Any]:
+        scores: Optional[Dict[Any, float]] = None
+        # Rarest-looking (longest) tokens first keeps the candidate set small
+        for query_token in sorted(query_tokens, key=len, reverse=True):
+            token_scores: Dict[Any, float] = {}
+            for token, quality in self._matching_tokens(query_token, infix).items():
+                for product_id, weight in self._postings[token].items():
+                    if scores is not None and product_id not in scores:
+                        continue
+                    score = weight * quality
+                    if score > token_scores.get(product_id, 0.0):
+                        token_scores[product_id] = score
+
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {product_id: scores[product_id] + score for product_id, score in token_scores.items()}
+            if not scores:
+                return []
+
+        if filters:
+            scores = {
+                product_id: score for product_id, score in scores.items()
+                if all(self._filters[product_id].get(field) == value for field, value in filters.items())
+            }
+
+        # Shorter brand names first on equal scores ("Dolo" before "Dolokind Plus")
+        return heapq.nsmallest(
+            limit, scores,
+            key=lambda product_id: (-scores[product_id], len(self._names[product_id]), self._names[product_id])
+        )